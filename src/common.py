@@ -2,6 +2,9 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 #
 # ==========================================================================
 #
@@ -28,6 +31,67 @@ mpu = MPU()
 # ==========================================================================
 #
 
+def _init_expert_thread( num_threads ):
+    # run one parallel op first so torch's lazy per-thread init does not
+    # later reset this thread back to the global thread count
+    torch.zeros( 1<<16 ).sum()
+    torch.set_num_threads( num_threads )
+
+class ExpertPool():
+    # Runs the forwards of several models concurrently, each on its own
+    # worker thread with its own intra-op thread budget.  torch releases
+    # the GIL inside ops, so the step takes as long as the slowest model.
+    def __init__( self, thread_budgets ):
+        self.executors = [ ThreadPoolExecutor( max_workers=1,
+                                               initializer=_init_expert_thread,
+                                               initargs=(num_threads,) )
+                           for num_threads in thread_budgets ]
+
+    def run( self, fns ):
+        # grad mode is thread-local, so carry the caller's over
+        grad_enabled = torch.is_grad_enabled()
+        def wrap( fn ):
+            def wrapped():
+                with torch.set_grad_enabled( grad_enabled ):
+                    return fn()
+            return wrapped
+        futures = [ ex.submit( wrap( fn ) ) for ex, fn in zip( self.executors, fns ) ]
+        return [ f.result() for f in futures ]
+
+_expert_pool = None
+def set_expert_pool( pool ):
+    global _expert_pool
+    _expert_pool = pool
+
+def run_all( fns ):
+    # runs the given model calls, concurrently if a pool is installed
+    if _expert_pool is None:
+        return [ fn() for fn in fns ]
+    return _expert_pool.run( fns )
+
+def get_all_next_logits( models ):
+    return run_all( [ m.get_next_logits for m in models ] )
+
+#
+# ==========================================================================
+#
+
+def module_view( module, cls ):
+    # Returns a module of class cls that shares all parameters, buffers and
+    # submodules with module, but can be given state of its own (e.g. a
+    # soft prefix) without touching the original
+    view = cls.__new__( cls )
+    view.__dict__.update( module.__dict__ )
+    view._parameters = OrderedDict( module._parameters )
+    view._buffers = OrderedDict( module._buffers )
+    view._non_persistent_buffers_set = set( module._non_persistent_buffers_set )
+    view._modules = OrderedDict( module._modules )
+    return view
+
+#
+# ==========================================================================
+#
+
 def analyze_text( raw_text ):
     tmp = {}
     for a in ATTRS:
@@ -56,134 +120,960 @@ def clean_detok( tokenizer, tokens ):
         result = "<error decoding>"
     return result
 
-def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
-    """ This function has been mostly taken from huggingface conversational
-     ai code at
-         https://medium.com/huggingface/how-to-build-a-state-of-the-art-
-              conversational-ai-with-transfer-learning-2d818ac26313 """
-
-    if top_k > 0:
-        # Remove all tokens with a probability less than the
-        # last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-
-    if top_p > 0.0:
-        # Cconvert to 1D
-        sorted_logits, sorted_indices = torch.sort(
-            logits, descending=True, dim=-1)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1),
-                                        dim=-1)
-
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token
-        # above the threshold
-        sorted_indices_to_remove[..., 1:] \
-            = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-        for i in range(sorted_indices.size(0)):
-            indices_to_remove = sorted_indices[i][sorted_indices_to_remove[i]]
-            logits[i][indices_to_remove] = filter_value
-
-    return logits, indices_to_remove
+class StreamDetokenizer():
+    # Incremental, batched detokenizer for the generated part of each row.
+    # Every row keeps two offsets into its tokens: text is only emitted for
+    # the tokens after read_offset, by decoding from prefix_offset (a few
+    # tokens of context) and keeping what goes beyond the context's text.
+    # With byte-level BPE a character can be split over several tokens;
+    # until it is complete the decoded text ends in U+FFFD and nothing is
+    # emitted for that row yet.  All rows go through one batch_decode, and
+    # each row only keeps the tokens it still needs.
+
+    def __init__( self, tokenizer, prompt_tokens, context=5 ):
+        # prompt_tokens has one list of tokens per row
+        self.tokenizer = tokenizer
+        self.tokens = [ list( row[max( len(row) - context, 0 ):] ) for row in prompt_tokens ]
+        self.prefix_offsets = [ 0 ] * len( self.tokens )
+        self.read_offsets = [ len( row ) for row in self.tokens ]
+        self.texts = [ "" ] * len( self.tokens )
+
+    def add_tokens( self, new_tokens, final=False ):
+        # new_tokens has a list of new tokens for each row; returns the new
+        # text of each row.  Rows that are final (a flag, or one per row)
+        # also emit incomplete characters.
+        if not isinstance( final, list ):
+            final = [ final ] * len( self.tokens )
+        for row, toks in zip( self.tokens, new_tokens ):
+            row.extend( toks )
+        prefix_texts = self.tokenizer.batch_decode( [ row[p:r] for row, p, r in zip( self.tokens, self.prefix_offsets, self.read_offsets ) ] )
+        full_texts = self.tokenizer.batch_decode( [ row[p:] for row, p in zip( self.tokens, self.prefix_offsets ) ] )
+
+        deltas = []
+        for ind, (prefix_text, full_text) in enumerate( zip( prefix_texts, full_texts ) ):
+            delta = ""
+            if len( full_text ) > len( prefix_text ) and ( final[ind] or not full_text.endswith( "\ufffd" ) ):
+                delta = full_text[len( prefix_text ):]
+                self.tokens[ind] = self.tokens[ind][self.read_offsets[ind]:]
+                self.prefix_offsets[ind] = 0
+                self.read_offsets[ind] = len( self.tokens[ind] )
+                self.texts[ind] += delta
+            deltas.append( delta )
+        return deltas
+
+    def flush( self ):
+        return self.add_tokens( [ [] for row in self.tokens ], final=True )
+
+    def add_rows( self, prompt_tokens, context=5 ):
+        for row in prompt_tokens:
+            self.tokens.append( list( row[max( len(row) - context, 0 ):] ) )
+            self.prefix_offsets.append( 0 )
+            self.read_offsets.append( len( self.tokens[-1] ) )
+            self.texts.append( "" )
+
+    def select_rows( self, rows ):
+        self.tokens = [ self.tokens[ind] for ind in rows ]
+        self.prefix_offsets = [ self.prefix_offsets[ind] for ind in rows ]
+        self.read_offsets = [ self.read_offsets[ind] for ind in rows ]
+        self.texts = [ self.texts[ind] for ind in rows ]
+
+_token_strings = {}
+def token_string( tokenizer, tok ):
+    # decoded text of a single token, cached
+    key = ( id( tokenizer ), tok )
+    if key not in _token_strings:
+        try:
+#            _token_strings[key] = tokenizer.detokenize( [tok] )
+            _token_strings[key] = tokenizer.decode( [tok] )
+        except:
+            _token_strings[key] = "!"+str(tok)+"!"
+    return _token_strings[key]
+
+def _per_row( value, num_rows, dtype ):
+    # sampling parameters can be given as scalars or with one value per row
+    value = torch.as_tensor( value, dtype=dtype )
+    if value.dim() == 0:
+        value = value.expand( num_rows )
+    return value
+
+def sample_logits( logits, temperature=1.0, top_k=0, top_p=0.0, num_candidates=256, uniforms=None ):
+    # Batched top-k / nucleus sampling over [B,V] logits.  temperature,
+    # top_k and top_p are scalars or (host) tensors with one value per row.
+    #
+    # Returns the sampled tokens [B], and the candidates [B,K] sorted by
+    # decreasing probability along with their filtered probabilities.
+    # uniforms optionally gives one U(0,1) draw per row.
+    cand_inds, cand_probs = filter_candidates( logits, temperature=temperature, top_k=top_k, top_p=top_p, num_candidates=num_candidates )
+    return _sample_candidates( cand_inds, cand_probs, uniforms ), cand_inds, cand_probs
+
+def filter_candidates( logits, temperature=1.0, top_k=0, top_p=0.0, num_candidates=256 ):
+    # Instead of sorting the whole vocabulary, only the best num_candidates
+    # tokens are selected; this gives the exact nucleus whenever they hold
+    # more than top_p of the mass, and we only fall back to a full sort
+    # when some row needs more.  top_k and top_p behave like the old
+    # top_k_logits: the nucleus is taken after renormalizing over the top k.
+    num_rows, vocab_size = logits.shape
+
+    temperature = _per_row( temperature, num_rows, logits.dtype )
+    top_k = _per_row( top_k, num_rows, torch.long )
+    top_p = _per_row( top_p, num_rows, torch.float32 )
+
+    k_eff = torch.where( (top_k > 0) & (top_k < vocab_size), top_k, vocab_size )
+    use_k = k_eff < vocab_size
+    use_p = ( top_p > 0.0 ) & ( top_p < 1.0 ) & ~use_k
+    use_kp = ( top_p > 0.0 ) & ( top_p < 1.0 ) & use_k
+    plain = ~use_k & ~use_p
+
+    num_cand = int( k_eff[use_k].max() ) if use_k.any() else 0
+    if use_p.any():
+        num_cand = max( num_cand, min( num_candidates, vocab_size ) )
+    if plain.any():
+        num_cand = vocab_size
+
+    logits = logits / temperature.to( logits.device ).view(-1,1)
+    if num_cand == vocab_size and not ( use_k | use_p | use_kp ).any():
+        # plain sampling, nothing to select
+        cand_inds = torch.arange( vocab_size, device=logits.device ).expand( num_rows, -1 )
+        cand_probs = F.softmax( logits, dim=-1 )
+        return cand_inds, cand_probs
+
+    k_eff = k_eff.to( logits.device ).view(-1,1)
+    top_p = top_p.to( logits.device ).view(-1,1)
+    use_p = use_p.to( logits.device ).view(-1,1)
+    use_kp = use_kp.to( logits.device ).view(-1,1)
+
+    full_lse = torch.logsumexp( logits, dim=-1, keepdim=True )
+    while True:
+        cand_logits, cand_inds = torch.topk( logits, num_cand, dim=-1 )
+        rank = torch.arange( num_cand, device=logits.device ).view(1,-1)
+        in_k = rank < k_eff
+
+        # top-k rows are renormalized over their k tokens first
+        k_lse = torch.logsumexp( cand_logits.masked_fill( ~in_k, -float('Inf') ), dim=-1, keepdim=True )
+        lse = torch.where( k_eff < vocab_size, k_lse, full_lse )
+        cand_probs = torch.exp( cand_logits - lse )
+
+        cumulative_probs = torch.cumsum( cand_probs, dim=-1 )
+        if num_cand == vocab_size:
+            break
+        # the nucleus of a row fits if the candidates hold more than top_p
+        # (this syncs with the device, but only once per step, and saves
+        # sorting the whole vocabulary on every step that doesn't need it)
+        missing = use_p & ( cumulative_probs[:,-1:] <= top_p )
+        if not missing.any():
+            break
+        num_cand = vocab_size
+
+    # keep every token whose preceding mass is within top_p, so that the
+    # first token crossing the threshold is kept too
+    keep = in_k
+    in_p = ( cumulative_probs - cand_probs ) <= top_p
+    keep = keep & torch.where( use_p | use_kp, in_p, True )
+
+    cand_probs = cand_probs * keep
+    cand_probs = cand_probs / cand_probs.sum( dim=-1, keepdim=True )
+
+    # unfiltered rows keep vocabulary order, as when the whole batch is
+    # unfiltered, so a row samples the same token whatever shares its batch
+    if plain.any():
+        plain = plain.to( logits.device ).view(-1,1)
+        cand_inds = torch.where( plain, torch.arange( vocab_size, device=logits.device ).view(1,-1), cand_inds )
+        cand_probs = torch.where( plain, F.softmax( logits, dim=-1 ), cand_probs )
+
+    return cand_inds, cand_probs
+
+def _sample_candidates( cand_inds, cand_probs, uniforms=None ):
+    # inverse-cdf sampling, one draw per row, or uniforms.shape[1] per row
+    # when uniforms is [B,n]
+    if uniforms is None:
+        uniforms = torch.rand( cand_probs.shape[0], device=cand_probs.device )
+    uniforms = uniforms.to( cand_probs.device )
+    cumulative_probs = torch.cumsum( cand_probs, dim=-1 )
+    # the float32 total can fall short of 1, so scale the draws by it, and
+    # never land past the last candidate with any probability
+    draws = uniforms.view( cand_probs.shape[0], -1 ) * cumulative_probs[:,-1:]
+    choice = torch.searchsorted( cumulative_probs, draws.contiguous(), right=True )
+    rank = torch.arange( cand_probs.shape[1], device=cand_probs.device )
+    last = torch.where( cand_probs > 0, rank, 0 ).amax( dim=-1, keepdim=True )
+    choice = torch.minimum( choice, last )
+    return torch.gather( cand_inds, 1, choice ).view( uniforms.shape )
+
+def filtered_probs( logits, temperature=1.0, top_k=0, top_p=0.0 ):
+    # the full [B,V] sampling distribution, zero outside the nucleus
+    cand_inds, cand_probs = filter_candidates( logits, temperature=temperature, top_k=top_k, top_p=top_p )
+    return torch.zeros_like( logits ).scatter_( 1, cand_inds, cand_probs )
+
+class SampleStreams():
+    # One RNG stream per row, derived from ( seed, prompt index, sample
+    # index ), so a sample draws the same numbers no matter how prompts are
+    # split across processes or which other rows share its batch.  Rows are
+    # kept in batch order and follow the batch's compaction.
+    def __init__( self, seed, keys=[] ):
+        self.seed = seed
+        self.generators = []
+        self.add_rows( keys )
+
+    def add_rows( self, keys ):
+        for key in keys:
+            state = np.random.SeedSequence( [ self.seed, *key ] ).generate_state( 2 )
+            self.generators.append( torch.Generator().manual_seed( ( int(state[0]) << 32 ) | int(state[1]) ) )
+
+    def select_rows( self, rows ):
+        self.generators = [ self.generators[ind] for ind in rows ]
+
+    def uniforms( self, num=None, rows=None ):
+        # one U(0,1) draw per row [B], or num of them [B,num]; only from the
+        # given rows' streams if rows is set
+        generators = self.generators if rows is None else [ self.generators[ind] for ind in rows ]
+        if num is None:
+            return torch.cat( [ torch.rand( 1, generator=g ) for g in generators ] )
+        return torch.stack( [ torch.rand( num, generator=g ) for g in generators ] )
+
+_sample_streams = None
+def set_sample_streams( streams ):
+    global _sample_streams
+    _sample_streams = streams
+
+def get_sample_streams():
+    return _sample_streams
+
+def sample_uniforms( num=None, rows=None ):
+    # per-row draws from the current streams (see SampleStreams.uniforms),
+    # or None to use torch's RNG
+    if _sample_streams is None:
+        return None
+    return _sample_streams.uniforms( num=num, rows=rows )
+
+class RowSettings():
+    # Decoding settings (omega, tau, temperature, top_p) with one value per
+    # row, for sweeps that decode several configurations as rows of one
+    # batch.  configs holds each row's settings as a dict.  Follows the
+    # batch's compaction like SampleStreams.
+    NAMES = [ 'omega', 'tau', 'temperature', 'top_p' ]
+
+    def __init__( self, configs ):
+        self.values = { name: torch.tensor( [ float( c[name] ) for c in configs ] ) for name in self.NAMES }
+
+    def select_rows( self, rows ):
+        rows = torch.as_tensor( rows, dtype=torch.int64 )
+        self.values = { name: value[rows] for name, value in self.values.items() }
+
+_row_settings = None
+def set_row_settings( settings ):
+    global _row_settings
+    _row_settings = settings
+
+def row_setting( name, rows=None ):
+    # a decoding setting: the global one, or one value per row (optionally
+    # indexed by rows) when decoding a sweep
+    if _row_settings is None:
+        return getattr( get_args(), name )
+    value = _row_settings.values[name]
+    return value if rows is None else value[rows]
+
+_trace_recorder = None
+def set_trace_recorder( recorder ):
+    global _trace_recorder
+    _trace_recorder = recorder
+
+def trace_rows( keys ):
+    # names the rows of a new batch in the trace, if we are recording one
+    if _trace_recorder is not None:
+        _trace_recorder.start( keys )
+
+def tracing():
+    return _trace_recorder is not None
+
+def trace_step( stream_logits, tokens, step=None ):
+    # step defaults to the one after the last recorded step
+    if _trace_recorder is not None:
+        _trace_recorder.record( stream_logits, tokens, step=step )
+
+def select_rows( models, rows ):
+    # drops finished rows from every model, and from the sample streams,
+    # row settings and trace
+    for m in models:
+        m.select_rows( rows )
+    if _sample_streams is not None:
+        _sample_streams.select_rows( rows )
+    if _row_settings is not None:
+        _row_settings.select_rows( rows )
+    if _trace_recorder is not None:
+        _trace_recorder.select_rows( rows )
 
 def sample_tok( logits ):
     args = get_args()
+    # one token per row
+    return sample_logits( logits, temperature=row_setting('temperature'), top_k=args.top_k, top_p=row_setting('top_p'), uniforms=sample_uniforms() )
 
-    logits /= args.temperature
-    logits, itr = top_k_logits( logits, top_k=args.top_k, top_p=args.top_p )
-    probs = F.softmax( logits, dim=-1 )
+class ContrastiveCombiner():
+    # Fused, batch-aware version of
+    #
+    #   log_softmax( nor + omega*bonus ),
+    #   bonus = log_softmax( tau*log_softmax( experts ), over experts )[0]
+    #
+    # i.e. the normal logits plus omega times the log posterior of the
+    # first expert given each token.
+    #
+    # For two experts the bonus is log sigmoid of the tau-scaled log-ratio,
+    # i.e. -softplus( tau*(log p_neg - log p_pos) ), which needs a single
+    # pass once both normalizers are known.  All full-vocabulary work is
+    # done in place in buffers kept from step to step, so the returned
+    # tensor is only valid until the next call.  omega and tau can be
+    # scalars or have one value per row.
+
+    def __init__( self ):
+        self.buffers = {}
 
-    new_tok = torch.multinomial(probs, num_samples=1).view(-1)
-    new_tok = new_tok.item()
+    def _buffer( self, name, like, shape=None ):
+        shape = like.shape if shape is None else shape
+        buf = self.buffers.get( name )
+        if buf is None or buf.shape != shape or buf.dtype != like.dtype or buf.device != like.device:
+            buf = torch.empty( shape, dtype=like.dtype, device=like.device )
+            self.buffers[name] = buf
+        return buf
 
-    return new_tok, itr, probs #logits
+    def _per_row( self, value, like ):
+        if torch.is_tensor( value ) and value.dim() > 0:
+            return value.to( device=like.device, dtype=like.dtype ).view(-1,1)
+        return float( value )
 
-def normalize_logits( logits ):
-    # expects as input a tensor of shape [1,V]
-    if len( logits.shape ) != 2:
-        error('wrong logits shape!')
-    logits = logits - torch.max( logits )
-    logits = logits - torch.log( torch.sum( torch.exp( logits ) ) )
-    return logits
+    def bonus( self, expert_logits, tau, expert_lses=None ):
+        # log posterior of the first expert, in a work buffer.  expert_lses
+        # optionally gives each expert's log normalizer [B,1], for when the
+        # logits only cover part of the vocabulary.
+        tau = self._per_row( tau, expert_logits[0] )
+        lses = expert_lses
+        if lses is None:
+            lses = [ torch.logsumexp( e, dim=-1, keepdim=True ) for e in expert_logits ]
 
+        if len( expert_logits ) == 2:
+            buf = self._buffer( 'bonus', expert_logits[0] )
+            torch.sub( expert_logits[1], expert_logits[0], out=buf )
+            buf.add_( lses[0] - lses[1] ).mul_( tau )
+            torch.logaddexp( buf, buf.new_zeros(()), out=buf )
+            return buf.neg_()
 
-def create_bonus( nor_logits, pos_logits, neg_logits ):
+        tmp = self._buffer( 'experts', expert_logits[0], (len(expert_logits),) + expert_logits[0].shape )
+        for ind, e in enumerate( expert_logits ):
+            torch.sub( e, lses[ind], out=tmp[ind] )
+        tmp.mul_( tau )
+        buf = self._buffer( 'bonus', expert_logits[0] )
+        torch.logsumexp( tmp, dim=0, out=buf )
+        return torch.sub( tmp[0], buf, out=buf )
+
+    def combine( self, nor_logits, expert_logits, omega, tau, expert_lses=None ):
+        omega = self._per_row( omega, nor_logits )
+        final_logits = self.bonus( expert_logits, tau, expert_lses=expert_lses )
+        final_logits.mul_( omega ).add_( nor_logits )
+        final_logits.sub_( torch.logsumexp( final_logits, dim=-1, keepdim=True ) )
+        return final_logits
+
+def candidate_logits( hidden, weight, cand_inds ):
+    # LM head logits [B,C] of only the tokens in cand_inds; the weight rows
+    # are gathered once for the union of the candidates over the batch
+    union, inverse = torch.unique( cand_inds, return_inverse=True )
+    logits = hidden.to( weight.dtype ) @ weight[union].T
+    return torch.gather( logits, 1, inverse )
+
+def restricted_combine( combiner, nor_logits, experts, omega, tau, margin=50, num_samples=64 ):
+    # Contrastive combination over a candidate set only: each row's normal
+    # model sampling nucleus plus margin further tokens.  experts is a list of
+    # ( hidden [B,E], LM head weight [V,E] ) pairs whose heads are only
+    # evaluated on the candidates and on num_samples tokens drawn from the
+    # normal model's remaining tail.
+    #
+    # Those draws give an importance-sampling estimate of each expert's
+    # tail mass, sum_tail p_e = E_q[ p_e / q ], with the normal model's
+    # tail distribution q as proposal; it is unbiased, and has low variance
+    # wherever the experts roughly agree with the normal model.
+    #
+    # Tokens outside the candidate set are dropped, which is an
+    # approximation: a large negative bonus on the nucleus can in principle
+    # move mass beyond it.  Returns the candidates [B,K] and their final
+    # log-probabilities [B,K].
     args = get_args()
-    PTAU = args.tau
-
-#    pos_logits = torch.clone( pos_logits )
-#    neg_logits = torch.clone( neg_logits )
-#    pos_logits = normalize_logits( pos_logits )
-#    neg_logits = normalize_logits( neg_logits )
-#    bonus_1 = -nor_logits + PTAU* torch.minimum( nor_logits, nor_logits + (pos_logits - neg_logits) )
-#    return bonus_1, 0
-
-#    bonus_1 = -nor_logits + PTAU* pos_logits
-#    return bonus_1, 0
-
-    c1_logits = torch.clone( pos_logits )
-    c2_logits = torch.clone( neg_logits )
-    c1_logits = normalize_logits( c1_logits )
-    c2_logits = normalize_logits( c2_logits )
-    tmp = torch.cat( [c1_logits, c2_logits], axis=0)
-    bonus = F.log_softmax( PTAU*tmp, dim=0 )
-    bonus_1 = bonus[0:1,:]
-    bonus_2 = bonus[1:2,:]
-    return bonus_1, bonus_2
+    vocab_size = nor_logits.shape[-1]
+
+    cand_inds, cand_probs = filter_candidates( nor_logits, temperature=row_setting('temperature'), top_k=args.top_k, top_p=row_setting('top_p') )
+    num_own = ( (cand_probs > 0).sum( dim=-1, keepdim=True ) + margin ).clamp( max=vocab_size )
+    min_own, num_cand = int( num_own.min() ), int( num_own.max() )
+    if num_cand > cand_inds.shape[1]:
+        cand_inds = torch.topk( nor_logits, num_cand, dim=-1 )[1]
+    cand_inds = cand_inds[:,:num_cand]
+    # rows are padded to the largest candidate set; the padding belongs to
+    # the row's tail, so no row depends on what else is in the batch
+    own = torch.arange( num_cand, device=cand_inds.device ).view(1,-1) < num_own
+
+    nor_logprobs = nor_logits - torch.logsumexp( nor_logits, dim=-1, keepdim=True )
+    inds = cand_inds
+    if num_samples > 0:
+        # from the rows' sample streams, like the sampled token, and drawn
+        # on every step whether or not the row has a tail
+        uniforms = sample_uniforms( num=num_samples )
+        if uniforms is None:
+            uniforms = torch.rand( nor_logits.shape[0], num_samples )
+    if min_own < vocab_size and num_samples > 0:
+        tail_probs = torch.exp( nor_logprobs )
+        tail_probs.scatter_( 1, cand_inds, torch.where( own, 0.0, torch.gather( tail_probs, 1, cand_inds ) ) )
+        tail_mass = tail_probs.sum( dim=-1, keepdim=True )
+        samples = _sample_candidates( torch.arange( vocab_size, device=tail_probs.device ).expand( tail_probs.shape[0], -1 ),
+                                      tail_probs + 1e-30, uniforms )
+        inds = torch.cat( (cand_inds, samples), dim=1 )
+
+    expert_logits = []
+    expert_lses = []
+    for hidden, weight in experts:
+        logits = candidate_logits( hidden, weight, inds ).to( nor_logits.dtype )
+        lse = torch.logsumexp( logits[:,:num_cand].masked_fill( ~own, -float('Inf') ), dim=-1, keepdim=True )
+        if inds is not cand_inds:
+            log_weights = logits[:,num_cand:] - torch.gather( nor_logprobs, 1, samples )
+            tail_lse = torch.log( tail_mass ) + torch.logsumexp( log_weights, dim=-1, keepdim=True ) - np.log( num_samples )
+            lse = torch.logaddexp( lse, tail_lse )
+        expert_logits.append( logits[:,:num_cand] )
+        expert_lses.append( lse )
+
+    final_logits = combiner.combine( torch.gather( nor_logits, 1, cand_inds ), expert_logits, omega, tau, expert_lses=expert_lses )
+    if min_own < num_cand:
+        final_logits.masked_fill_( ~own, -float('Inf') )
+        final_logits.sub_( torch.logsumexp( final_logits, dim=-1, keepdim=True ) )
+    return cand_inds, final_logits
+
+def sample_restricted( cand_inds, final_logits ):
+    # samples from restricted_combine's output; returns vocabulary ids
+    new_tok, inds, probs = sample_tok( final_logits )
+    return torch.gather( cand_inds, 1, new_tok.view(-1,1) ).view(-1), torch.gather( cand_inds, 1, inds ), probs
+
+def print_top_tokens( tokenizer, nor_logits, cand_inds, cand_probs ):
+    args = get_args()
+
+    # only the first row is shown
+    print( f"  Tokens left: {int( (cand_probs[0] > 0).sum() )}\t", end="" )
+
+    tmp_normal_probs = filtered_probs( nor_logits[0:1], temperature=row_setting( 'temperature', rows=slice(0,1) ), top_k=args.top_k, top_p=row_setting( 'top_p', rows=slice(0,1) ) )
+
+    result = ""
+    for ind in range( min( 15, cand_inds.shape[1] ) ):
+        tok = int( cand_inds[0,ind] )
+        tmp = token_string( tokenizer, tok ).replace("\n","")
+        tmp = "[" + tmp + "] " + f"{cand_probs[0,ind]:0.3f} <- {tmp_normal_probs[0,tok]:0.3f}"
+        result +=  f"{tmp: <30}"
+    print( result )
+
+class RowFinisher():
+    # Tracks which rows of a batch are done, either because they sampled
+    # EOS or one of the stop strings or used up max_tokens, and keeps the
+    # text each row generated (cut before the EOS or stop string) by row
+    # id.  Text is detokenized incrementally as tokens arrive.  The caller
+    # drops the finished rows from its batch, so the rows seen by update()
+    # are always the ones still running, in order.
+
+    def __init__( self, tokenizer, prompt_tokens, stop_strings=[], max_tokens=None ):
+        # prompt_tokens is the [B,P] host tensor of the rows' prompts
+        self.eos = getattr( tokenizer, 'eos_token_id', None )
+        self.num_seen = prompt_tokens.shape[1]
+        self.detok = StreamDetokenizer( tokenizer, prompt_tokens.tolist() )
+        self.stop_strings = [ s for s in stop_strings if s ]
+        self.max_tokens = max_tokens
+        self.row_ids = list( range( prompt_tokens.shape[0] ) )
+        self.num_generated = [ 0 ] * prompt_tokens.shape[0]
+        self.budgets = [ max_tokens ] * prompt_tokens.shape[0]
+        self.results = {}
+        self.finished = []
+
+    def add_rows( self, prompt_tokens, row_ids, max_tokens=None ):
+        # new rows join the batch after the running ones, optionally with a
+        # token budget of their own
+        self.detok.add_rows( prompt_tokens )
+        self.row_ids += list( row_ids )
+        self.num_generated += [ 0 ] * len( row_ids )
+        self.budgets += [ max_tokens or self.max_tokens ] * len( row_ids )
+
+    def select_rows( self, rows ):
+        # keeps only the given running rows, e.g. to drop cancelled ones
+        self.row_ids = [ self.row_ids[ind] for ind in rows ]
+        self.num_generated = [ self.num_generated[ind] for ind in rows ]
+        self.budgets = [ self.budgets[ind] for ind in rows ]
+        self.detok.select_rows( rows )
+
+    def _cut( self, text, start ):
+        # position of the first stop string that ends after start
+        cuts = [ text.find( s, max( start - len(s) + 1, 0 ) ) for s in self.stop_strings ]
+        cuts = [ c for c in cuts if c >= 0 ]
+        return min( cuts ) if len( cuts ) > 0 else None
+
+    def update( self, tokens ):
+        # tokens are the running rows [B,T] on the host; returns the rows to
+        # keep, or None if they all keep going
+        new_tokens = tokens[:,self.num_seen:].tolist()
+        self.num_seen = tokens.shape[1]
+        return self.add_tokens( new_tokens )
+
+    def add_tokens( self, new_tokens ):
+        # like update, given the list of new tokens of each running row
+        done = [ False ] * len( new_tokens )
+        for ind, toks in enumerate( new_tokens ):
+            if self.eos is not None and self.eos in toks:
+                new_tokens[ind] = toks[:toks.index( self.eos )]
+                done[ind] = True
+            self.num_generated[ind] += len( toks )
+            if self.budgets[ind] is not None and self.num_generated[ind] >= self.budgets[ind]:
+                done[ind] = True
+
+        old_lens = [ len( text ) for text in self.detok.texts ]
+        self.detok.add_tokens( new_tokens, final=done )
+        if self.stop_strings:
+            for ind, text in enumerate( self.detok.texts ):
+                cut = self._cut( text, old_lens[ind] )
+                if cut is not None:
+                    self.detok.texts[ind] = text[:cut]
+                    done[ind] = True
+        if not any( done ):
+            return None
+
+        keep = []
+        for ind in range( len( done ) ):
+            if done[ind]:
+                self.results[self.row_ids[ind]] = self.detok.texts[ind]
+                self.finished.append( self.row_ids[ind] )
+            else:
+                keep.append( ind )
+        self.select_rows( keep )
+        return keep
+
+    def pop_finished( self ):
+        # ( row id, text ) of every row finished since the last call
+        finished = [ (row_id, self.results.pop( row_id )) for row_id in self.finished ]
+        self.finished = []
+        return finished
+
+    def finish_all( self, tokens ):
+        # the rest of the rows ran out of tokens
+        if len( self.row_ids ) > 0:
+            self.update( tokens )
+        old_lens = [ len( text ) for text in self.detok.texts ]
+        self.detok.flush()
+        for ind, text in enumerate( self.detok.texts ):
+            cut = self._cut( text, old_lens[ind] ) if self.stop_strings else None
+            self.results[self.row_ids[ind]] = text if cut is None else text[:cut]
+        return [ self.results[row_id] for row_id in sorted( self.results ) ]
 
 def gen_completion( normodel, posmodel, negmodel, tokenizer, tok_cnt=20 ):
+    return gen_completions( normodel, posmodel, negmodel, tokenizer, tok_cnt=tok_cnt )[0]
+
+class LazyExpertStats():
+    # Counts how often the lazy mode of gen_completions sampled from the
+    # normal model alone, and, for the skipped steps that were scored at
+    # catch-up, the total variation distance between the distribution that
+    # was sampled from and the contrastive one.
+    def __init__( self ):
+        self.num_steps = 0
+        self.num_skipped = 0
+        self.num_scored = 0
+        self.tv_sum = 0.0
+        self.tv_max = 0.0
+
+    def add_divergence( self, tv ):
+        # tv holds one distance per row
+        self.num_scored += tv.numel()
+        self.tv_sum += float( tv.sum() )
+        self.tv_max = max( self.tv_max, float( tv.max() ) )
+
+    def report( self ):
+        result = f"experts skipped on {self.num_skipped}/{self.num_steps} steps ({self.num_skipped/max(self.num_steps,1):0.1%})"
+        if self.num_scored > 0:
+            result += f", TV mean {self.tv_sum/self.num_scored:0.4f} max {self.tv_max:0.4f}"
+        return result
+
+# counts over every gen_completions call of the run, not per prompt
+lazy_stats = LazyExpertStats()
+
+def score_skipped( combiner, skipped, posmodel, negmodel, first_step ):
+    # catches the experts up on the skipped steps (first_step onwards),
+    # records them in the trace and, with --lazy_divergence, compares for
+    # each of them the contrastive distribution with the normal one we
+    # sampled from
     args = get_args()
+    num_skipped = len( skipped )
+    pos_logits, neg_logits = run_all( [ lambda: posmodel.get_new_logits( num_skipped+1 ),
+                                        lambda: negmodel.get_new_logits( num_skipped+1 ) ] )
+    vocab_size = pos_logits.shape[-1]
+
+    for ind, s in enumerate( skipped ):
+        trace_step( [ s[0], pos_logits[:,ind], neg_logits[:,ind] ], s[3], step=first_step+ind )
+    if args.lazy_divergence:
+        nor_logits = torch.stack( [ s[0] for s in skipped ], dim=1 ).view(-1,vocab_size)
+        rows = torch.arange( pos_logits.shape[0] ).repeat_interleave( num_skipped )
+        final_logits = combiner.combine( nor_logits,
+                                         [ pos_logits[:,:num_skipped].reshape(-1,vocab_size), neg_logits[:,:num_skipped].reshape(-1,vocab_size) ],
+                                         row_setting( 'omega', rows=rows ), row_setting( 'tau', rows=rows ) )
+        target_probs = filtered_probs( final_logits, temperature=row_setting( 'temperature', rows=rows ), top_k=args.top_k, top_p=row_setting( 'top_p', rows=rows ) )
+
+        used_probs = torch.zeros_like( target_probs )
+        used_probs.scatter_( 1, torch.stack( [ s[1] for s in skipped ], dim=1 ).view( target_probs.shape[0], -1 ),
+                             torch.stack( [ s[2] for s in skipped ], dim=1 ).view( target_probs.shape[0], -1 ) )
+        lazy_stats.add_divergence( 0.5 * ( target_probs - used_probs ).abs().sum( dim=-1 ) )
+    skipped.clear()
+
+def gen_completions( normodel, posmodel, negmodel, tokenizer, tok_cnt=20 ):
+    # generates one completion for every row of the models' current batch.
+    #
+    # With --lazy_entropy, steps on which every row's (filtered) normal
+    # distribution has less entropy than the threshold are sampled from the
+    # normal model alone.  The experts only buffer those tokens and catch up
+    # on all of them in one forward the next time they are needed.
+    args = get_args()
+    combiner = ContrastiveCombiner()
+    skipped = []
+    finisher = RowFinisher( tokenizer, normodel.get_tokens(), stop_strings=args.stop_string )
 
     for tok_ind in range( tok_cnt ):
-        nor_logits = normodel.get_next_logits()
-        pos_logits = posmodel.get_next_logits()
-        neg_logits = negmodel.get_next_logits()
+        if tok_ind > 0:
+            # finished rows leave the batch, and every model's cache
+            keep = finisher.update( normodel.get_tokens() )
+            if keep is not None:
+                if len( keep ) == 0:
+                    break
+                select_rows( [ normodel, posmodel, negmodel ], keep )
+                skipped[:] = [ tuple( t[torch.tensor( keep, device=t.device )] for t in s ) for s in skipped ]
+        num_steps = tok_ind + 1
+
+        if args.lazy_entropy > 0:
+            nor_logits = normodel.get_next_logits()
+            cand_inds, cand_probs = filter_candidates( nor_logits, temperature=row_setting('temperature'), top_k=args.top_k, top_p=row_setting('top_p') )
+            lazy_stats.num_steps += 1
 
-        bonus_1, bonus_2 = create_bonus( nor_logits, pos_logits, neg_logits )
+            if float( torch.special.entr( cand_probs ).sum( dim=-1 ).max() ) < args.lazy_entropy:
+                lazy_stats.num_skipped += 1
+                new_tok = _sample_candidates( cand_inds, cand_probs, sample_uniforms() )
+                if args.lazy_divergence or tracing():
+                    skipped.append( (nor_logits, cand_inds, cand_probs, new_tok) )
 
-        final_logits = nor_logits + args.omega*bonus_1
-        final_logits = normalize_logits( final_logits )
+                if mpu.get_tensor_model_parallel_rank() == 0 and args.verbose:
+                    print_top_tokens( tokenizer, nor_logits, cand_inds, cand_probs )
 
-        # if mpu.get_tensor_model_parallel_rank() == 0 and tok_ind == 0:
-        #     dump_logits( "normal"+normal_text, normalize_logits( nor_logits ) )
-        #     dump_logits( "pos"+normal_text, normalize_logits( pos_logits ) )
-        #     dump_logits( "neg"+normal_text, normalize_logits( neg_logits ) )
-        #     dump_logits( "final"+normal_text, normalize_logits( final_logits ) )
-        #     dump_logits( "bonus"+normal_text, bonus_1 )
+                normodel.append_new_tok( new_tok )
+                posmodel.append_new_tok( new_tok )
+                negmodel.append_new_tok( new_tok )
+                continue
 
-        # XXX note that this modifies final_logits
-        new_tok, itr, topkprobs = sample_tok( final_logits )
+            if len( skipped ) > 0:
+                score_skipped( combiner, skipped, posmodel, negmodel, tok_ind - len( skipped ) )
+
+        if args.restrict_vocab:
+            nor_logits, pos_hidden, neg_hidden = run_all( [normodel.get_next_logits, posmodel.get_next_hidden, negmodel.get_next_hidden] )
+            experts = [ (pos_hidden, posmodel.model.lm_head.weight), (neg_hidden, negmodel.model.lm_head.weight) ]
+            restricted = restricted_combine( combiner, nor_logits, experts, row_setting('omega'), row_setting('tau'),
+                                             margin=args.restrict_margin, num_samples=args.restrict_samples )
+        else:
+            nor_logits, pos_logits, neg_logits = get_all_next_logits( [normodel, posmodel, negmodel] )
+
+            final_logits = combiner.combine( nor_logits, [pos_logits, neg_logits], row_setting('omega'), row_setting('tau') )
+
+        if args.restrict_vocab:
+            new_tok, cand_inds, cand_probs = sample_restricted( *restricted )
+        else:
+            new_tok, cand_inds, cand_probs = sample_tok( final_logits )
+            trace_step( [nor_logits, pos_logits, neg_logits], new_tok, step=tok_ind )
 
         if mpu.get_tensor_model_parallel_rank() == 0 and args.verbose:
-            print( f"  Tokens left: {topkprobs.shape[1] - len(itr)}\t", end="" )
-
-            #tmp_normal_logits = normalize_logits( normal_logits )
-            _, _, tmp_normal_probs = sample_tok( nor_logits )
-
-            tmp = topkprobs.cpu().numpy().ravel()
-            inds = np.flip( np.argsort( tmp ) )
-            #print( "Inds: ", inds )
-            result = ""
-            for ind in range( 15 ):
-                tok = inds[ind]
-                try:
-#                    tmp = tokenizer.detokenize( [tok] ).replace("\n","")
-                    tmp = tokenizer.decode( [tok] ).replace("\n","")
-                except:
-                    tmp = "!"+str(tok)+"!"
-                tmp = "[" + tmp + "] " + f"{topkprobs[0,tok]:0.3f} <- {tmp_normal_probs[0,tok]:0.3f}"
-                result +=  f"{tmp: <30}"
-            print( result )
+            print_top_tokens( tokenizer, nor_logits, cand_inds, cand_probs )
 
         normodel.append_new_tok( new_tok )
         posmodel.append_new_tok( new_tok )
         negmodel.append_new_tok( new_tok )
 
-    cpu_toks = normodel.get_tokens().cpu().numpy().ravel()
-    rstr = clean_detok( tokenizer, cpu_toks )
-    return rstr
+    if len( skipped ) > 0:
+        score_skipped( combiner, skipped, posmodel, negmodel, num_steps - len( skipped ) )
+
+    return finisher.finish_all( normodel.get_tokens() )
+
+def precision_drift( reference, reduced, tokenizer, prompts, tok_cnt=20 ):
+    # Compares the final sampling distribution of reduced-precision models
+    # with that of full-precision ones.  reference and reduced are
+    # ( normal, positive, negative ) generators, both teacher-forced with
+    # tokens sampled from the reduced ones.  Returns the mean and max total
+    # variation between the filtered distributions, the mean KL( reference
+    # || reduced ) of the unfiltered ones and how often the top tokens agree.
+    args = get_args()
+    combiner = ContrastiveCombiner()
+    tvs, kls, same_top = [], [], []
+    for prompt_text in prompts:
+        for m in reference + reduced:
+            m.set_prompt( prompt_text )
+
+        for tok_ind in range( tok_cnt ):
+            logprobs = []
+            for models in ( reference, reduced ):
+                nor_logits, pos_logits, neg_logits = get_all_next_logits( models )
+                logprobs.append( combiner.combine( nor_logits, [pos_logits, neg_logits], row_setting('omega'), row_setting('tau') ).clone() )
+            ref_probs, red_probs = [ filtered_probs( lp, temperature=row_setting('temperature'), top_k=args.top_k, top_p=row_setting('top_p') ) for lp in logprobs ]
+
+            tvs.append( 0.5 * ( ref_probs - red_probs ).abs().sum( dim=-1 ) )
+            kls.append( ( logprobs[0].exp() * ( logprobs[0] - logprobs[1] ) ).sum( dim=-1 ) )
+            same_top.append( ( logprobs[0].argmax( dim=-1 ) == logprobs[1].argmax( dim=-1 ) ).float() )
+
+            new_tok = torch.multinomial( red_probs, 1 ).view(-1)
+            for m in reference + reduced:
+                m.append_new_tok( new_tok )
+
+    tvs = torch.cat( tvs )
+    return { 'tv_mean': float( tvs.mean() ), 'tv_max': float( tvs.max() ),
+             'kl_mean': float( torch.cat( kls ).mean() ), 'top1_agree': float( torch.cat( same_top ).mean() ) }
+
+def expert_step( experts, combiner, tokenizer ):
+    # samples the next token of every row of an ExpertBatch whose first
+    # stream is the normal model and whose remaining streams are attribute
+    # experts (the first of them being the one we steer towards)
+    args = get_args()
+
+    if args.restrict_vocab:
+        # only the normal stream goes through the full LM head
+        hidden = experts.get_next_hidden()
+        weight = experts.model.lm_head.weight
+        nor_logits = experts.model.lm_head( hidden[0] )
+        restricted = restricted_combine( combiner, nor_logits, [ (h, weight) for h in hidden[1:] ], row_setting('omega'), row_setting('tau'),
+                                         margin=args.restrict_margin, num_samples=args.restrict_samples )
+        new_tok, cand_inds, cand_probs = sample_restricted( *restricted )
+    else:
+        logits = experts.get_next_logits()
+        nor_logits = logits[0]
+
+        final_logits = combiner.combine( nor_logits, logits[1:], row_setting('omega'), row_setting('tau') )
+
+        new_tok, cand_inds, cand_probs = sample_tok( final_logits )
+        trace_step( logits, new_tok )
+
+    if mpu.get_tensor_model_parallel_rank() == 0 and args.verbose:
+        print_top_tokens( tokenizer, nor_logits, cand_inds, cand_probs )
+
+    return new_tok
+
+def gen_expert_completions( experts, tokenizer, tok_cnt=20 ):
+    # like gen_completions, but for an ExpertBatch
+    args = get_args()
+    combiner = ContrastiveCombiner()
+    finisher = RowFinisher( tokenizer, experts.get_tokens(), stop_strings=args.stop_string, max_tokens=tok_cnt )
+
+    while experts.num_rows > 0:
+        new_tok = expert_step( experts, combiner, tokenizer )
+        keep = finisher.add_tokens( [ [tok] for tok in new_tok.tolist() ] )
+
+        # finished rows leave before their last token is fed, so the
+        # batched forward only runs rows that are still going
+        if keep is not None:
+            select_rows( [ experts ], keep )
+            new_tok = new_tok[torch.tensor( keep, dtype=torch.int64, device=new_tok.device )]
+        if experts.num_rows > 0:
+            experts.append_new_tok( new_tok )
+
+    return finisher.finish_all( experts.get_tokens() )
+
+def gen_continuous_completions( experts, tokenizer, work, num_slots, tok_cnt=20 ):
+    # Continuous batching over an ExpertBatch.  work yields ( key, prompt )
+    # pairs, one per sample; up to num_slots samples decode together, and
+    # whenever rows finish their slots are refilled from work right away
+    # (consecutive samples of the same prompt share one prefill) as far as
+    # the ExpertBatch's KV blocks allow.  Yields ( key, completion ) in the
+    # order the samples finish.
+    args = get_args()
+    combiner = ContrastiveCombiner()
+    finisher = RowFinisher( tokenizer, torch.zeros( (0,0), dtype=torch.int64 ),
+                            stop_strings=args.stop_string, max_tokens=tok_cnt )
+    experts.num_rows = 0
+
+    work = iter( work )
+    next_item = next( work, None )
+    waiting = None
+    while True:
+        while experts.num_rows < num_slots:
+            if waiting is None:
+                if next_item is None:
+                    break
+                prompt_text = next_item[1]
+                keys = []
+                while next_item is not None and next_item[1] == prompt_text and experts.num_rows + len( keys ) < num_slots:
+                    keys.append( next_item[0] )
+                    next_item = next( work, None )
+                waiting = ( prompt_text, keys )
+
+            # with a paged cache, only as many samples join as have their
+            # KV blocks free; the rest wait for running rows to finish
+            prompt_text, keys = waiting
+            num_free = experts.free_blocks()
+            num_rows = len( keys )
+            while num_rows > 0 and experts.blocks_needed( prompt_text, num_rows=num_rows, max_new=tok_cnt ) > num_free:
+                num_rows -= 1
+            if num_rows == 0:
+                if experts.num_rows == 0:
+                    raise MemoryError( "not enough KV blocks for a single sample" )
+                break
+            waiting = ( prompt_text, keys[num_rows:] ) if num_rows < len( keys ) else None
+            keys = keys[:num_rows]
+
+            experts.add_prompt( prompt_text, num_rows=len( keys ), max_new=tok_cnt )
+            prompt_ids = tokenizer( prompt_text, return_tensors='pt' )['input_ids'][0].tolist()
+            finisher.add_rows( [ prompt_ids ] * len( keys ), keys )
+            if _sample_streams is not None:
+                _sample_streams.add_rows( keys )
+
+        if experts.num_rows == 0:
+            break
+
+        new_tok = expert_step( experts, combiner, tokenizer )
+        keep = finisher.add_tokens( [ [tok] for tok in new_tok.tolist() ] )
+        for key, completion in finisher.pop_finished():
+            yield key, completion
+
+        # finished rows leave before their last token is fed
+        if keep is not None:
+            select_rows( [ experts ], keep )
+            new_tok = new_tok[torch.tensor( keep, dtype=torch.int64, device=new_tok.device )]
+        if experts.num_rows > 0:
+            experts.append_new_tok( new_tok )
+
+def gen_speculative_completions( normodel, posmodel, negmodel, draft, tokenizer, tok_cnt=20, spec_len=4 ):
+    # like gen_completions, but a small draft model proposes up to spec_len
+    # tokens per row, which the three models then score in one forward
+    # each.  Drafts are accepted with probability min(1,P/Q) against the
+    # full contrastive distribution P; the first rejected position is
+    # resampled from the residual max(0,P-Q), so the samples still follow
+    # P exactly.
+    #
+    # Rows accept runs of different lengths.  The models only keep the
+    # tokens every row has decided; the tokens a row decided beyond that
+    # stay pending, are fed again in the next round, and the row drafts on
+    # from there.  Rows more than spec_len tokens ahead sit a round out.
+    # A row takes its draws from its own sample stream in the same order
+    # whatever else shares the batch, and uses its own settings.
+    args = get_args()
+    combiner = ContrastiveCombiner()
+    models = [ normodel, posmodel, negmodel ]
+
+    finisher = RowFinisher( tokenizer, normodel.get_tokens(), stop_strings=args.stop_string )
+
+    num_drafted = 0
+    num_accepted = 0
+    num_committed = 0
+    pending = [ [] for ind in range( normodel.get_tokens().shape[0] ) ]
+    while num_committed < tok_cnt:
+        if num_committed > 0:
+            keep = finisher.update( normodel.get_tokens() )
+            if keep is not None:
+                if len( keep ) == 0:
+                    break
+                select_rows( models + [ draft ], keep )
+                pending = [ pending[ind] for ind in keep ]
+
+        # a row's last position needs no drafts, it just samples from P
+        num_rows = len( pending )
+        ahead = [ len( p ) for p in pending ]
+        rows = [ ind for ind in range( num_rows ) if ahead[ind] <= spec_len and num_committed + ahead[ind] < tok_cnt ]
+        if len( rows ) == 0:
+            # every row is too far ahead (e.g. the slowest one just
+            # finished), so this round only commits pending tokens
+            num_new = min( ahead )
+            for ind in range( num_new ):
+                tok = torch.tensor( [ p[ind] for p in pending ] )
+                for m in models + [ draft ]:
+                    m.append_new_tok( tok )
+            pending = [ p[num_new:] for p in pending ]
+            num_committed += num_new
+            continue
+        num_drafts = [ min( spec_len, tok_cnt - num_committed - ahead[ind] - 1 ) for ind in rows ]
+        width = max( ahead[ind] + num for ind, num in zip( rows, num_drafts ) )
+
+        # spec_len draws for the drafts, spec_len for accepting them and
+        # one for the final sample
+        row_uniforms = sample_uniforms( num=2*spec_len+1, rows=rows )
+        uniforms = torch.zeros( num_rows, 2*spec_len+1 )
+        uniforms[rows] = torch.rand( len( rows ), 2*spec_len+1 ) if row_uniforms is None else row_uniforms
+
+        start = torch.tensor( ahead )
+        end = start.clone()
+        end[rows] += torch.tensor( num_drafts, dtype=end.dtype )
+        forced = torch.tensor( [ p[:width] + [0] * max( width - len( p ), 0 ) for p in pending ], dtype=torch.int64 ).view( num_rows, width )
+        positions = torch.arange( width ).view(1,-1)
+
+        # positions before a row's start feed its pending tokens, the ones
+        # after its drafts just the draft model's top token
+        draft_probs = []
+        fed = []
+        for ind in range( width ):
+            logits = draft.get_next_logits()
+            cand_inds, cand_probs = filter_candidates( logits, temperature=row_setting('temperature'), top_k=args.top_k, top_p=row_setting('top_p') )
+            draft_uniforms = torch.gather( uniforms, 1, ( ind - start ).clamp( 0, max( spec_len-1, 0 ) ).view(-1,1) ).view(-1)
+            x = _sample_candidates( cand_inds, cand_probs, draft_uniforms ).cpu()
+            x = torch.where( ind < start, forced[:,ind], torch.where( ind < end, x, logits.argmax( dim=-1 ).cpu() ) )
+            draft.append_new_tok( x )
+            draft_probs.append( torch.zeros_like( logits ).scatter_( 1, cand_inds, cand_probs ) )
+            fed.append( x )
+
+        for x in fed:
+            for m in models:
+                m.append_new_tok( x )
+        nor_logits, pos_logits, neg_logits = run_all( [ (lambda m=m: m.get_new_logits( width+1 )) for m in models ] )
+        vocab_size = nor_logits.shape[-1]
+
+        flat_rows = torch.arange( num_rows ).repeat_interleave( width+1 )
+        final_logits = combiner.combine( nor_logits.reshape(-1,vocab_size),
+                                         [ pos_logits.reshape(-1,vocab_size), neg_logits.reshape(-1,vocab_size) ],
+                                         row_setting( 'omega', rows=flat_rows ), row_setting( 'tau', rows=flat_rows ) )
+        target_probs = filtered_probs( final_logits, temperature=row_setting( 'temperature', rows=flat_rows ),
+                                       top_k=args.top_k, top_p=row_setting( 'top_p', rows=flat_rows ) )
+        target_probs = target_probs.view( num_rows, width+1, vocab_size )
+        device = target_probs.device
+
+        # decided[r] counts the fed tokens row r keeps: its pending ones,
+        # then its run of accepted drafts
+        row_inds = torch.arange( num_rows )
+        if width > 0:
+            fed = torch.stack( fed, dim=1 )
+            draft_probs = torch.stack( draft_probs, dim=1 ).to( device )
+            p = torch.gather( target_probs[:,:width], 2, fed.to( device ).unsqueeze(2) ).squeeze(2).cpu()
+            q = torch.gather( draft_probs, 2, fed.to( device ).unsqueeze(2) ).squeeze(2).cpu()
+            accept_uniforms = torch.gather( uniforms, 1, ( spec_len + positions - start.view(-1,1) ).clamp( spec_len, 2*spec_len-1 ) )
+            is_draft = ( positions >= start.view(-1,1) ) & ( positions < end.view(-1,1) )
+            accepted = torch.where( is_draft, accept_uniforms * q < p, positions < start.view(-1,1) )
+            decided = torch.cumprod( accepted.long(), dim=1 ).sum( dim=1 )
+
+            # a rejected draft is resampled from the residual
+            probs = target_probs[row_inds, decided]
+            residual = torch.clamp( probs - draft_probs[row_inds, decided.clamp( max=width-1 )], min=0 )
+            rejected = ( decided < end ).to( device ).view(-1,1)
+            probs = torch.where( rejected & ( residual.sum( dim=-1, keepdim=True ) > 0 ), residual, probs )
+        else:
+            fed = torch.zeros( num_rows, 0, dtype=torch.int64 )
+            decided = start.clone()
+            probs = target_probs[:,0]
+        new_tok = _sample_candidates( torch.arange( vocab_size, device=device ).expand( num_rows, -1 ), probs, uniforms[:,2*spec_len] ).cpu()
+
+        fed = fed.tolist()
+        for ind, num in zip( rows, num_drafts ):
+            pending[ind] = pending[ind] + fed[ind][ahead[ind]:int( decided[ind] )] + [ int( new_tok[ind] ) ]
+            num_drafted += num
+            num_accepted += int( decided[ind] ) - ahead[ind]
+
+        if mpu.get_tensor_model_parallel_rank() == 0 and args.verbose and rows[0] == 0:
+            print( f"  accepted {int( decided[0] ) - ahead[0]}/{num_drafts[0]} drafts" )
+
+        # every row's first num_new pending tokens are committed; the fed
+        # tokens up to num_kept already are, the rest are appended
+        num_new = min( len( p ) for p in pending )
+        num_kept = min( num_new, int( decided.min() ) )
+        for m in models + [ draft ]:
+            m.rewind( width - num_kept )
+        for ind in range( num_kept, num_new ):
+            tok = torch.tensor( [ p[ind] for p in pending ] )
+            for m in models + [ draft ]:
+                m.append_new_tok( tok )
+        pending = [ p[num_new:] for p in pending ]
+        num_committed += num_new
+
+    if mpu.get_tensor_model_parallel_rank() == 0 and args.verbose and num_drafted > 0:
+        print( f"  draft acceptance rate: {num_accepted/num_drafted:0.3f}" )
+
+    return finisher.finish_all( normodel.get_tokens() )
 
 def count_lines( fn ):
     try:
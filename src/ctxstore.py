@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+
+import torch
+import numpy as np
+
+#
+# ==========================================================================
+#
+
+# numpy has no bfloat16; those caches are stored as their raw 16 bit words
+RAW_DTYPES = { 'bfloat16': ( np.int16, torch.int16 ) }
+
+def content_hash( *parts ):
+    # sha256 over a key's parts (strings or bytes), length-prefixed so that
+    # moving bytes from one part to the next changes the hash
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance( part, str ):
+            part = part.encode()
+        h.update( len( part ).to_bytes( 8, 'little' ) )
+        h.update( part )
+    return h.hexdigest()
+
+def file_hash( fn ):
+    h = hashlib.sha256()
+    with open( fn, "rb" ) as f:
+        for chunk in iter( lambda: f.read( 1 << 20 ), b"" ):
+            h.update( chunk )
+    return h.hexdigest()
+
+class ContextEntry():
+    # One stored context: its token ids and/or the per-layer keys/values of
+    # a prefix, each memory-mapped from a .npy file on first use.  Pages are
+    # shared by every process that maps the same entry.
+
+    def __init__( self, path, meta ):
+        self.path = path
+        self.meta = meta
+        self._arrays = {}
+
+    def _array( self, name ):
+        if name not in self._arrays:
+            # copy-on-write, so torch gets a writable array without the
+            # file ever changing
+            self._arrays[name] = np.load( os.path.join( self.path, name + ".npy" ), mmap_mode='c' )
+        return self._arrays[name]
+
+    def tokens( self ):
+        if 'tokens' not in self.meta['files']:
+            return None
+        return self._array( 'tokens' ).tolist()
+
+    def past( self, device="cpu" ):
+        # the legacy cache, a ( key, value ) pair of [1,H,T,D] per layer
+        if 'past' not in self.meta['files']:
+            return None
+        past = torch.from_numpy( self._array( 'past' ) )
+        if self.meta['dtype'] in RAW_DTYPES:
+            past = past.view( getattr( torch, self.meta['dtype'] ) )
+        past = past.to( device )
+        return tuple( ( past[layer,0], past[layer,1] ) for layer in range( past.shape[0] ) )
+
+class ContextStore():
+    # Token ids and precomputed prefix caches on disk, keyed by a hash of
+    # the model and the context text or prefix checkpoint it came from:
+    #
+    #   root/<key>/meta.json   file sizes and sha256s, dtype, description
+    #   root/<key>/tokens.npy  int32 [T]
+    #   root/<key>/past.npy    [L,2,1,H,T,D], keys and values of every layer
+    #
+    # Entries are written to a temporary directory and renamed into place,
+    # so concurrent writers and readers only ever see complete ones.  An
+    # entry whose files don't match its meta.json is dropped and rebuilt.
+    # The store is kept under max_bytes by evicting the least recently used
+    # entries (meta.json's mtime is touched on every hit).  Temporary
+    # directories left behind by writers that died are removed too.
+
+    # a temporary directory this old is abandoned even if its writer lives
+    TMP_TIMEOUT = 3600
+
+    def __init__( self, root, max_bytes=2**32, verify=True ):
+        os.makedirs( root, exist_ok=True )
+        self.root = root
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.verified = set()
+
+    def _meta_fn( self, key ):
+        return os.path.join( self.root, key, "meta.json" )
+
+    def get( self, key ):
+        path = os.path.join( self.root, key )
+        try:
+            with open( self._meta_fn( key ) ) as f:
+                meta = json.load( f )
+        except ( OSError, ValueError ):
+            return None
+
+        if key not in self.verified:
+            for name, info in meta['files'].items():
+                fn = os.path.join( path, name + ".npy" )
+                if not os.path.exists( fn ) or os.path.getsize( fn ) != info['bytes'] or \
+                   ( self.verify and file_hash( fn ) != info['sha256'] ):
+                    print( f"WARNING: context store entry {key} is corrupt, dropping it" )
+                    shutil.rmtree( path, ignore_errors=True )
+                    return None
+            self.verified.add( key )
+
+        try:
+            os.utime( self._meta_fn( key ) )
+        except OSError:
+            pass
+        return ContextEntry( path, meta )
+
+    def put( self, key, tokens=None, past=None, description="" ):
+        tmp = os.path.join( self.root, f".tmp-{key}-{socket.gethostname()}-{os.getpid()}" )
+        os.makedirs( tmp, exist_ok=True )
+        arrays = {}
+        if tokens is not None:
+            arrays['tokens'] = np.asarray( tokens, dtype=np.int32 ).reshape( -1 )
+        dtype = None
+        if past is not None:
+            past = torch.stack( [ torch.stack( list( layer_past ), dim=0 ) for layer_past in past ], dim=0 ).detach().cpu()
+            dtype = str( past.dtype ).replace( "torch.", "" )
+            if dtype in RAW_DTYPES:
+                past = past.view( RAW_DTYPES[dtype][1] )
+            arrays['past'] = past.numpy()
+
+        files = {}
+        for name, array in arrays.items():
+            fn = os.path.join( tmp, name + ".npy" )
+            np.save( fn, array )
+            files[name] = { 'bytes': os.path.getsize( fn ), 'sha256': file_hash( fn ) }
+        meta = { 'files': files, 'dtype': dtype, 'description': description, 'created': time.time() }
+        with open( os.path.join( tmp, "meta.json" ), "w" ) as f:
+            json.dump( meta, f )
+
+        try:
+            os.rename( tmp, os.path.join( self.root, key ) )
+        except OSError:
+            # somebody else stored it first
+            shutil.rmtree( tmp, ignore_errors=True )
+
+        self.evict( keep=key )
+        return self.get( key )
+
+    def entries( self ):
+        # [ ( last use, bytes, key ) ] of all complete entries
+        entries = []
+        for key in os.listdir( self.root ):
+            if key.startswith( "." ):
+                continue
+            try:
+                with open( self._meta_fn( key ) ) as f:
+                    meta = json.load( f )
+                used = os.path.getmtime( self._meta_fn( key ) )
+            except ( OSError, ValueError ):
+                continue
+            entries.append( ( used, sum( info['bytes'] for info in meta['files'].values() ), key ) )
+        return entries
+
+    def _stale_tmp( self, name ):
+        # whether .tmp-<key>-<host>-<pid> belongs to a writer that is gone:
+        # a dead process on this host, or one that took too long
+        try:
+            if time.time() - os.path.getmtime( os.path.join( self.root, name ) ) > self.TMP_TIMEOUT:
+                return True
+            host, pid = name.split( "-", 2 )[2].rsplit( "-", 1 )
+            pid = int( pid )
+        except ( OSError, ValueError, IndexError ):
+            return False
+        if host != socket.gethostname() or pid == os.getpid():
+            return False
+        try:
+            os.kill( pid, 0 )
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def evict( self, keep=None ):
+        for name in os.listdir( self.root ):
+            if name.startswith( ".tmp-" ) and self._stale_tmp( name ):
+                print( f"    removing abandoned context store directory {name}" )
+                shutil.rmtree( os.path.join( self.root, name ), ignore_errors=True )
+
+        entries = sorted( self.entries() )
+        total = sum( size for used, size, key in entries )
+        for used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            print( f"    evicting context store entry {key}" )
+            shutil.rmtree( os.path.join( self.root, key ), ignore_errors=True )
+            total -= size
+
+#
+# ==========================================================================
+#
+
+def hard_context_state( store, model_name, precision, tokenizer, model, text ):
+    # ( token ids, cache ) of a GPT2LMHC hard context, from the store or
+    # computed by the model and stored
+    key = content_hash( "hard", model_name, precision, text )
+    entry = store.get( key )
+    if entry is not None:
+        return entry.tokens(), entry.past( model.transformer.wte.weight.device )
+
+    tokens = tokenizer.encode( text, add_special_tokens=False )
+    model.set_prompt_tokens( tokens )
+    store.put( key, tokens=tokens, past=model.transformer.prompt_past,
+               description=f"{model_name} {precision} hard context: {text[:60]}" )
+    return tokens, model.transformer.prompt_past
+
+def soft_prefix_state( store, model_name, precision, entry_point, checkpoint, device ):
+    # ( key, cache or None ) of a GPT2LMPlus soft prefix checkpoint; the
+    # caller stores the cache under key once the model has built it
+    with open( checkpoint, "rb" ) as f:
+        key = content_hash( "soft", model_name, precision, entry_point, f.read() )
+    entry = store.get( key )
+    return key, None if entry is None else entry.past( device )
+
+def context_tokens( store, model_name, tokenizer, text ):
+    key = content_hash( "tokens", model_name, text )
+    entry = store.get( key )
+    if entry is not None:
+        return entry.tokens()
+    tokens = tokenizer.encode( text, add_special_tokens=False )
+    store.put( key, tokens=tokens, description=f"{model_name} tokens: {text[:60]}" )
+    return tokens
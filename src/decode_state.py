@@ -0,0 +1,221 @@
+import math
+import torch
+import torch.nn.functional as F
+
+from paged_kv import PagedRows, paged_decode_step
+
+#
+# ==========================================================================
+#
+
+def decode_step( transformer, input_ids, positions, cursor, keys, values, mask ):
+    # One GPT-2 decoding step over preallocated buffers.  input_ids and
+    # positions are [B]; the new keys/values are written in place at
+    # cursor (a 0-d tensor, so a compiled step does not specialize on it)
+    # and attention runs over the whole buffer, masked.  Every shape stays
+    # the same from step to step.
+    config = transformer.config
+    num_rows = input_ids.shape[0]
+    num_heads = config.n_head
+    head_dim = config.n_embd // num_heads
+
+    mask.index_fill_( 1, cursor, True )
+    attn_mask = torch.zeros( mask.shape, dtype=keys[0].dtype, device=mask.device )
+    attn_mask = attn_mask.masked_fill( ~mask, -float('Inf') ).view( num_rows, 1, 1, -1 )
+
+    hidden = transformer.wte( input_ids ) + transformer.wpe( positions )
+    hidden = hidden.view( num_rows, 1, -1 )
+    for layer, block in enumerate( transformer.h ):
+        scale = 1.0 / math.sqrt( head_dim ) if config.scale_attn_weights else 1.0
+        if config.scale_attn_by_inverse_layer_idx:
+            scale /= float( layer + 1 )
+
+        query, key, value = block.attn.c_attn( block.ln_1( hidden ) ).split( config.n_embd, dim=2 )
+        query = query.view( num_rows, 1, num_heads, head_dim ).transpose( 1, 2 )
+        keys[layer].index_copy_( 2, cursor, key.view( num_rows, 1, num_heads, head_dim ).transpose( 1, 2 ) )
+        values[layer].index_copy_( 2, cursor, value.view( num_rows, 1, num_heads, head_dim ).transpose( 1, 2 ) )
+
+        attn = F.scaled_dot_product_attention( query, keys[layer], values[layer], attn_mask=attn_mask, scale=scale )
+        attn = attn.transpose( 1, 2 ).reshape( num_rows, 1, -1 )
+        hidden = hidden + block.attn.c_proj( attn )
+        hidden = hidden + block.mlp( block.ln_2( hidden ) )
+
+    return transformer.ln_f( hidden ).view( num_rows, -1 )
+
+def prefix_takes_no_positions( model ):
+    # whether the prefix in front of the cached tokens is an after_pe soft
+    # prefix; every other prefix (and a hard context) takes positions
+    transformer = model.transformer
+    return getattr( transformer, 'do_prompt_tune', False ) and \
+        transformer.prompt_tuning_entry_point == "after_pe"
+
+compiled_decode_step = None
+def get_decode_step( compile=False ):
+    global compiled_decode_step
+    if not compile:
+        return decode_step
+    if compiled_decode_step is None:
+        compiled_decode_step = torch.compile( decode_step )
+    return compiled_decode_step
+
+#
+# ==========================================================================
+#
+
+class DecodeState():
+    # Decoding state of a Generator with everything preallocated: the
+    # tokens (on the host), and every layer's keys/values plus the
+    # attention mask (on the model's device), each sized for the prefilled
+    # context plus max_new tokens.  Appending, rewinding and decoding only
+    # write in place and move cursors.
+    #
+    # num_toks counts the tokens, num_fed those whose keys/values are in
+    # the buffers; cursor is the next free slot of the buffers, which also
+    # hold any prefix or hard context in front of the tokens.
+
+    def __init__( self, model, tokens, past_key_values, max_new, step=decode_step ):
+        self.model = model
+        self.step = step
+        num_rows = tokens.shape[0]
+        num_toks = tokens.shape[1]
+        past_len = past_key_values[0][0].shape[2]
+        capacity = past_len + max_new
+        device = model.lm_head.weight.device
+
+        self.tokens = torch.zeros( (num_rows, num_toks + max_new), dtype=torch.int64 )
+        self.tokens[:,:num_toks] = tokens
+        self.num_toks = num_toks
+        self.num_fed = num_toks
+
+        # past_key_values may still have a single row; copying broadcasts it
+        key = past_key_values[0][0]
+        shape = ( num_rows, key.shape[1], capacity, key.shape[3] )
+        self.keys = [ torch.zeros( shape, dtype=key.dtype, device=device ) for layer_past in past_key_values ]
+        self.values = [ torch.zeros( shape, dtype=key.dtype, device=device ) for layer_past in past_key_values ]
+        for layer, (k, v) in enumerate( past_key_values ):
+            self.keys[layer][:,:,:past_len] = k
+            self.values[layer][:,:,:past_len] = v
+        self.mask = torch.zeros( (num_rows, capacity), dtype=torch.bool, device=device )
+        self.mask[:,:past_len] = True
+        self.cursor = past_len
+
+        # soft prefixes added after the position embeddings take no positions
+        if prefix_takes_no_positions( model ) and past_len > num_toks:
+            next_position = num_toks
+        else:
+            next_position = past_len
+        self.positions = torch.full( (num_rows,), next_position, dtype=torch.int64, device=device )
+
+    def append_tokens( self, new_toks ):
+        # new_toks is a [B] host tensor
+        self.tokens[:,self.num_toks] = new_toks
+        self.num_toks += 1
+
+    def run_pending( self ):
+        # feeds the tokens not in the buffers yet, one step at a time, and
+        # returns their final hidden states [B,T,E]
+        device = self.mask.device
+        hidden = []
+        for ind in range( self.num_fed, self.num_toks ):
+            hidden.append( self.step( self.model.transformer,
+                                      self.tokens[:,ind].to( device ),
+                                      self.positions,
+                                      torch.tensor( self.cursor, device=device ),
+                                      self.keys, self.values, self.mask ) )
+            self.positions += 1
+            self.cursor += 1
+        self.num_fed = self.num_toks
+        return torch.stack( hidden, dim=1 )
+
+    def uncache( self, num_toks ):
+        # forgets the keys/values of every token after the first num_toks
+        drop = self.num_fed - max( min( self.num_fed, num_toks ), 0 )
+        if drop > 0:
+            self.cursor -= drop
+            self.positions -= drop
+            self.mask[:,self.cursor:] = False
+            self.num_fed -= drop
+
+    def truncate( self, num_toks ):
+        # drops every token after the first num_toks
+        self.num_toks = num_toks
+        self.uncache( num_toks )
+
+    def select_rows( self, rows ):
+        dev_rows = rows.to( self.mask.device )
+        self.tokens = self.tokens[rows]
+        self.keys = [ k[dev_rows] for k in self.keys ]
+        self.values = [ v[dev_rows] for v in self.values ]
+        self.mask = self.mask[dev_rows]
+        self.positions = self.positions[dev_rows]
+
+    def get_tokens( self ):
+        return self.tokens[:,:self.num_toks]
+
+class PagedDecodeState():
+    # Decoding state of a Generator whose cache lives in a PagedKVStore;
+    # same interface as DecodeState.  The prompt's keys/values are written
+    # once and shared by all rows, and rows only own the blocks they write.
+
+    def __init__( self, model, store, tokens, past_key_values ):
+        self.model = model
+        self.store = store
+        num_rows = tokens.shape[0]
+        past_len = past_key_values[0][0].shape[2]
+        device = model.lm_head.weight.device
+
+        self.tokens = tokens.clone()
+        self.num_toks = tokens.shape[1]
+        self.num_fed = self.num_toks
+
+        # past_key_values may still have a single row, shared by all of them
+        self.rows = PagedRows( store )
+        if past_key_values[0][0].shape[0] == 1:
+            self.rows.add_prefill( past_key_values, [ 0 ], copies=num_rows )
+        else:
+            self.rows.add_prefill( past_key_values, [ 0 ] * num_rows )
+
+        # soft prefixes added after the position embeddings take no positions
+        if prefix_takes_no_positions( model ) and past_len > self.num_toks:
+            next_position = self.num_toks
+        else:
+            next_position = past_len
+        self.positions = torch.full( (num_rows,), next_position, dtype=torch.int64, device=device )
+
+    def append_tokens( self, new_toks ):
+        # new_toks is a [B] host tensor
+        self.tokens = torch.cat( ( self.tokens[:,:self.num_toks], new_toks.view(-1,1) ), dim=1 )
+        self.num_toks += 1
+
+    def run_pending( self ):
+        device = self.positions.device
+        hidden = []
+        for ind in range( self.num_fed, self.num_toks ):
+            slots, tables, mask = self.rows.prepare_step( device )
+            hidden.append( paged_decode_step( self.model.transformer, self.tokens[:,ind].to( device ), self.positions,
+                                              self.store, slots, tables, mask ) )
+            self.positions += 1
+        self.num_fed = self.num_toks
+        return torch.stack( hidden, dim=1 )
+
+    def uncache( self, num_toks ):
+        drop = self.num_fed - max( min( self.num_fed, num_toks ), 0 )
+        if drop > 0:
+            self.rows.truncate( [ length - drop for length in self.rows.lengths ] )
+            self.positions -= drop
+            self.num_fed -= drop
+
+    def truncate( self, num_toks ):
+        self.num_toks = num_toks
+        self.uncache( num_toks )
+
+    def select_rows( self, rows ):
+        self.tokens = self.tokens[rows]
+        self.rows.select_rows( rows.tolist() )
+        self.positions = self.positions[rows.to( self.positions.device )]
+
+    def release( self ):
+        self.rows.release()
+
+    def get_tokens( self ):
+        return self.tokens[:,:self.num_toks]
@@ -0,0 +1,359 @@
+import math
+import torch
+import torch.nn.functional as F
+
+from transformers.models.gpt2.modeling_gpt2 import GPT2Model
+
+from paged_kv import PagedRows, paged_decode_step
+
+#
+# ==========================================================================
+#
+
+def get_stream_prefix( model ):
+    # Describes what a model puts in front of its input: nothing (plain
+    # model), a soft prefix (GPT2LMPlus) or a hard context (GPT2LMHC)
+    transformer = model.transformer
+    if getattr( transformer, 'do_prompt_tune', False ):
+        if transformer.prompt_tuning_entry_point == "kv_prefix":
+            raise ValueError( "kv_prefix prefixes only share a backbone through a prefix bank" )
+        return { 'embeds': transformer.pt_prefix[0],
+                 'after_pe': transformer.prompt_tuning_entry_point == "after_pe" }
+    prompt_tokens = getattr( transformer, 'prompt_tokens', [] )
+    if len( prompt_tokens ) > 0:
+        return { 'tokens': prompt_tokens[0] }
+    return {}
+
+class ExpertBatch():
+    # Runs the normal model and any number of attribute experts that share
+    # one backbone as rows of a single batched forward.  Each stream only
+    # differs in its prefix; rows are left-padded to a common length and
+    # carry their own attention mask and position ids.
+    #
+    # Rows are laid out stream-major: row s*B+b is sample b of stream s.
+    #
+    # A stream's prefix is a hard context ('tokens'), soft prefix
+    # embeddings ('embeds') or an entry of the model's prefix bank
+    # ('bank', see GPT2ModelPlus.set_up_prefix_bank).  Bank streams are
+    # prefilled together in one forward that starts from the bank's cache,
+    # so they work for every entry point, kv_prefix included.
+    #
+    # With a kv_store (a PagedKVStore), the cache lives in its blocks
+    # instead: rows have no padding, and samples of one prompt share the
+    # prompt's blocks.  Every sample row has a budget of new tokens, and
+    # add_prompt only admits rows if the blocks they and the running rows
+    # may still need are free, so decoding never runs out of blocks.
+
+    def __init__( self, model, tokenizer, prefixes, kv_store=None ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefixes = prefixes
+        self.num_streams = len( prefixes )
+        self.device = model.lm_head.weight.device
+        self.max_len = model.config.n_positions
+        self.kv_store = kv_store
+        self.kv = None
+
+    def _prefix_embeds( self, prefix, num_toks ):
+        # returns ( embeddings, positions ) for a stream's prefix
+        wte = self.model.transformer.wte
+        wpe = self.model.transformer.wpe
+        if 'tokens' in prefix:
+            # like GPT2ModelHC, only keep as much context as fits
+            tokens = prefix['tokens']
+            tokens = tokens[max( len(tokens) - (self.max_len - num_toks), 0 ):].to( self.device )
+            positions = torch.arange( len(tokens), device=self.device )
+            return wte( tokens ), positions
+
+        if 'embeds' in prefix:
+            embeds = prefix['embeds'].to( device=self.device, dtype=wte.weight.dtype )
+            if embeds.shape[0] + num_toks > self.max_len:
+                # as in GPT2ModelPlus: only an after_pe prefix can be left out
+                if not prefix.get( 'after_pe', False ):
+                    raise ValueError( f"{num_toks} tokens and the {embeds.shape[0]} token soft prefix "
+                                      f"don't fit in {self.max_len} positions" )
+                print( "WARNING: prompt too long, skipping adding soft prefix" )
+            else:
+                positions = torch.arange( embeds.shape[0], device=self.device )
+                if prefix.get( 'after_pe', False ):
+                    # the prefix is added after the position embeddings, so
+                    # cancel out the ones the backbone will add
+                    embeds = embeds - wpe( positions )
+                return embeds, positions
+
+        return wte.weight[0:0], torch.arange( 0, device=self.device )
+
+    def _prefill( self, prompt_ids ):
+        # runs a prompt through every stream; returns the cache, mask, next
+        # positions and final hidden states of the num_streams new rows
+        prompt_ids = prompt_ids.to( self.device )
+        bank = [ ind for ind, prefix in enumerate( self.prefixes ) if 'bank' in prefix ]
+        other = [ ind for ind in range( self.num_streams ) if ind not in bank ]
+        parts = []
+        if len( other ) > 0:
+            parts.append( self._embeds_prefill( prompt_ids, [ self.prefixes[ind] for ind in other ] ) )
+        if len( bank ) > 0:
+            parts.append( self._bank_prefill( prompt_ids, [ self.prefixes[ind]['bank'] for ind in bank ] ) )
+        if len( parts ) == 1:
+            return parts[0]
+
+        # left-pad both to a common cache length, then back to stream order
+        length = max( mask.shape[1] for past, mask, positions, hidden in parts )
+        order = torch.argsort( torch.tensor( other + bank ) ).to( self.device )
+        past_key_values = tuple(
+            tuple( torch.cat( [ F.pad( past[layer][ind], [ 0, 0, length - mask.shape[1], 0 ] )
+                                for past, mask, positions, hidden in parts ] )[order] for ind in range( 2 ) )
+            for layer in range( len( parts[0][0] ) ) )
+        attention_mask = torch.cat( [ F.pad( mask, [ length - mask.shape[1], 0 ] ) for past, mask, positions, hidden in parts ] )[order]
+        next_positions = torch.cat( [ positions for past, mask, positions, hidden in parts ] )[order]
+        next_hidden = torch.cat( [ hidden for past, mask, positions, hidden in parts ] )[order]
+        return past_key_values, attention_mask, next_positions, next_hidden
+
+    def _bank_prefill( self, prompt_ids, prefix_ids ):
+        # _prefill for rows with prefixes from the model's prefix bank, in
+        # one forward; each row's mask covers its own prefix in the bank
+        transformer = self.model.transformer
+        num_toks = prompt_ids.shape[0]
+        prefix_ids = torch.tensor( prefix_ids, device=self.device )
+        bank_past, bank_mask, bank_starts = transformer.build_bank_cache( self.device )
+        output = transformer( input_ids=prompt_ids.view(1,-1).expand( len( prefix_ids ), -1 ),
+                              prefix_ids=prefix_ids,
+                              use_cache=True )
+        attention_mask = torch.cat( ( bank_mask[prefix_ids],
+                                      torch.ones( ( len( prefix_ids ), num_toks ), dtype=bank_mask.dtype, device=self.device ) ), dim=1 )
+        return output['past_key_values'], attention_mask, bank_starts[prefix_ids] + num_toks, output['last_hidden_state'][:,-1,:]
+
+    def _embeds_prefill( self, prompt_ids, prefixes ):
+        # _prefill for rows whose prefixes are tokens or embeddings (or
+        # nothing), fed with the prompt as one left-padded batch
+        wte = self.model.transformer.wte
+        num_toks = prompt_ids.shape[0]
+        prompt_embeds = wte( prompt_ids )
+
+        rows = []
+        for prefix in prefixes:
+            embeds, positions = self._prefix_embeds( prefix, num_toks )
+            if prefix.get( 'after_pe', False ):
+                tok_positions = torch.arange( num_toks, device=self.device )
+            else:
+                tok_positions = torch.arange( len(positions), len(positions)+num_toks, device=self.device )
+            rows.append(( torch.cat( (embeds, prompt_embeds), dim=0 ),
+                          torch.cat( (positions, tok_positions), dim=0 ) ))
+
+        # left-pad every stream to the longest one
+        seq_len = max( e.shape[0] for e, p in rows )
+        inputs_embeds = torch.zeros( (len(rows), seq_len, prompt_embeds.shape[-1]),
+                                     dtype=prompt_embeds.dtype, device=self.device )
+        position_ids = torch.zeros( (len(rows), seq_len), dtype=torch.long, device=self.device )
+        attention_mask = torch.zeros( (len(rows), seq_len), dtype=torch.long, device=self.device )
+        for ind, (embeds, positions) in enumerate( rows ):
+            inputs_embeds[ind, seq_len-embeds.shape[0]:] = embeds
+            position_ids[ind, seq_len-embeds.shape[0]:] = positions
+            attention_mask[ind, seq_len-embeds.shape[0]:] = 1
+
+        output = GPT2Model.forward( self.model.transformer,
+                                    inputs_embeds=inputs_embeds,
+                                    attention_mask=attention_mask,
+                                    position_ids=position_ids,
+                                    use_cache=True )
+        return output['past_key_values'], attention_mask, position_ids[:,-1] + 1, output['last_hidden_state'][:,-1,:]
+
+    def _prefix_len( self, prefix, num_toks ):
+        # how many positions _prefix_embeds puts in front of num_toks tokens
+        if 'tokens' in prefix:
+            return min( len( prefix['tokens'] ), max( self.max_len - num_toks, 0 ) )
+        if 'bank' in prefix:
+            return int( self.model.transformer.build_bank_cache( self.device )[1][prefix['bank']].sum() )
+        if 'embeds' in prefix and prefix['embeds'].shape[0] + num_toks <= self.max_len:
+            return prefix['embeds'].shape[0]
+        return 0
+
+    def blocks_needed( self, raw_text, num_rows=1, max_new=None ):
+        # KV blocks that num_rows samples of a prompt need over their whole
+        # decode: the prompt's shared blocks, the ones each sample grows
+        # into, and each sample's copy of a shared last block (counted the
+        # same way as PagedRows.blocks_to_grow)
+        if self.kv_store is None:
+            return 0
+        num_toks = self.tokenizer( raw_text, return_tensors='pt' )['input_ids'].shape[1]
+        max_new = self.max_len - num_toks if max_new is None else max_new
+        bs = self.kv_store.block_size
+        total = 0
+        for prefix in self.prefixes:
+            length = self._prefix_len( prefix, num_toks ) + num_toks
+            shared = math.ceil( length / bs )
+            total += shared + num_rows * ( math.ceil( ( length + max_new ) / bs ) - shared )
+            if length % bs and max_new > 0:
+                total += num_rows
+        return total
+
+    def free_blocks( self ):
+        # KV blocks that stay free once every running row has used up its
+        # budget (unlimited without a kv_store)
+        if self.kv_store is None:
+            return math.inf
+        if self.kv is None:
+            return self.kv_store.num_free()
+        if getattr( self, 'num_rows', 0 ) == 0:
+            # set_prompt releases whatever an abandoned batch still holds
+            return self.kv_store.num_free() + self.kv.blocks_held()
+        return self.kv_store.num_free() - self.kv.blocks_to_grow( self.budgets * self.num_streams )
+
+    def set_prompt( self, raw_text, num_rows=1, max_new=None ):
+        # max_new is the samples' token budget, by default as many as fit
+        prompt_ids = self.tokenizer( raw_text, return_tensors='pt' )['input_ids'][0]
+        self.budgets = [ self.max_len - prompt_ids.shape[0] if max_new is None else max_new ]
+        self.all_tokens = prompt_ids.unsqueeze(0)
+        self.past_key_values, self.attention_mask, self.next_positions, self.next_hidden = self._prefill( prompt_ids )
+        self.next_logits = None
+        self.num_rows = 1
+
+        if self.kv_store is not None:
+            if self.kv is not None:
+                self.kv.release()
+            self.kv = PagedRows( self.kv_store )
+            self.kv.add_prefill( self.past_key_values, ( self.attention_mask == 0 ).sum( dim=1 ).tolist() )
+            self.past_key_values = None
+            self.attention_mask = None
+
+        if num_rows > 1:
+            self.expand( num_rows )
+
+    def add_prompt( self, raw_text, num_rows=1, max_new=None ):
+        # adds num_rows samples of another prompt to the running batch (for
+        # continuous batching).  Rows of different lengths are left-padded
+        # to a common cache length, so get_tokens() is left-padded too.
+        # Raises MemoryError if their KV blocks (see blocks_needed) aren't
+        # free.
+        if self.blocks_needed( raw_text, num_rows=num_rows, max_new=max_new ) > self.free_blocks():
+            raise MemoryError( f"not enough free KV blocks for {num_rows} more rows" )
+        if getattr( self, 'num_rows', 0 ) == 0:
+            self.set_prompt( raw_text, num_rows=num_rows, max_new=max_new )
+            return
+
+        prompt_ids = self.tokenizer( raw_text, return_tensors='pt' )['input_ids'][0]
+        self.budgets += [ self.max_len - prompt_ids.shape[0] if max_new is None else max_new ] * num_rows
+        past_key_values, attention_mask, next_positions, next_hidden = self._prefill( prompt_ids )
+
+        if self.kv is not None:
+            # the new rows go after the old ones of each stream
+            num_old = self.num_streams * self.num_rows
+            self.kv.add_prefill( past_key_values, ( attention_mask == 0 ).sum( dim=1 ).tolist(), copies=num_rows )
+            self.kv.select_rows( [ ind for stream in range( self.num_streams )
+                                   for ind in list( range( stream * self.num_rows, ( stream+1 ) * self.num_rows ) )
+                                            + list( range( num_old + stream * num_rows, num_old + ( stream+1 ) * num_rows ) ) ] )
+
+        def join( old, new, dim=None ):
+            # pads dim on the left to a common length and puts the new rows
+            # after the old ones of each stream
+            if dim is not None:
+                pad = [ 0, 0 ] * ( old.dim() - dim - 1 )
+                length = max( old.shape[dim], new.shape[dim] )
+                old = F.pad( old, pad + [ length - old.shape[dim], 0 ] )
+                new = F.pad( new, pad + [ length - new.shape[dim], 0 ] )
+            new = new.repeat_interleave( num_rows, dim=0 )
+            old = old.view( self.num_streams, self.num_rows, *old.shape[1:] )
+            new = new.view( self.num_streams, num_rows, *new.shape[1:] )
+            return torch.cat( (old, new), dim=1 ).view( -1, *old.shape[2:] )
+
+        if self.kv is None:
+            self.past_key_values = tuple(
+                tuple( join( t, n, dim=2 ) for t, n in zip( layer_past, new_layer_past ) )
+                for layer_past, new_layer_past in zip( self.past_key_values, past_key_values ) )
+            self.attention_mask = join( self.attention_mask, attention_mask, dim=1 )
+        self.next_positions = join( self.next_positions, next_positions )
+        self.next_hidden = join( self.next_hidden, next_hidden )
+        self.next_logits = None
+
+        length = max( self.all_tokens.shape[1], prompt_ids.shape[0] )
+        self.all_tokens = torch.cat( ( F.pad( self.all_tokens, [ length - self.all_tokens.shape[1], 0 ] ),
+                                       F.pad( prompt_ids, [ length - prompt_ids.shape[0], 0 ] ).repeat( num_rows, 1 ) ), dim=0 )
+        self.num_rows += num_rows
+
+    def expand( self, num_rows ):
+        # every stream row becomes num_rows sample rows
+        if self.kv is not None:
+            self.kv.select_rows( torch.arange( self.num_streams * self.num_rows ).repeat_interleave( num_rows ).tolist() )
+        else:
+            self.past_key_values = tuple(
+                tuple( t.repeat_interleave( num_rows, dim=0 ) for t in layer_past )
+                for layer_past in self.past_key_values )
+            self.attention_mask = self.attention_mask.repeat_interleave( num_rows, dim=0 )
+        self.next_positions = self.next_positions.repeat_interleave( num_rows, dim=0 )
+        self.next_hidden = self.next_hidden.repeat_interleave( num_rows, dim=0 )
+        if self.next_logits is not None:
+            self.next_logits = self.next_logits.repeat_interleave( num_rows, dim=0 )
+        self.all_tokens = self.all_tokens.repeat( num_rows, 1 )
+        self.budgets = [ budget for budget in self.budgets for ind in range( num_rows ) ]
+        self.num_rows *= num_rows
+
+    def get_next_hidden( self ):
+        # returns a tensor of shape [num_streams, num_rows, E]
+        return self.next_hidden.view( self.num_streams, self.num_rows, -1 )
+
+    def get_next_logits( self ):
+        # returns a tensor of shape [num_streams, num_rows, V]
+        if self.next_logits is None:
+            self.next_logits = self.model.lm_head( self.next_hidden )
+        return self.next_logits.view( self.num_streams, self.num_rows, -1 )
+
+    def append_new_tok( self, new_token ):
+        # new_token is either a single token for all samples or a tensor
+        # with one token per sample; all streams get the same tokens
+        new_toks = torch.as_tensor( new_token, dtype=torch.int64 ).view(-1).expand( self.num_rows )
+        self.all_tokens = torch.hstack(( self.all_tokens, new_toks.view(-1,1).cpu() ))
+        self.budgets = [ budget - 1 for budget in self.budgets ]
+
+        input_ids = new_toks.to( self.device ).repeat( self.num_streams ).view(-1,1)
+        if self.kv is not None:
+            slots, tables, mask = self.kv.prepare_step( self.device )
+            self.next_hidden = paged_decode_step( self.model.transformer, input_ids.view(-1), self.next_positions.view(-1),
+                                                  self.kv_store, slots, tables, mask )
+            self.next_positions = self.next_positions + 1
+            self.next_logits = None
+            return
+
+        self.attention_mask = torch.hstack(( self.attention_mask, torch.ones_like( input_ids ) ))
+        output = GPT2Model.forward( self.model.transformer,
+                                    inputs_embeds=self.model.transformer.wte( input_ids ),
+                                    attention_mask=self.attention_mask,
+                                    position_ids=self.next_positions.view(-1,1),
+                                    past_key_values=self.past_key_values,
+                                    use_cache=True )
+        self.past_key_values = output['past_key_values']
+        self.next_positions = self.next_positions + 1
+        self.next_hidden = output['last_hidden_state'][:,-1,:]
+        self.next_logits = None
+
+    def select_rows( self, rows ):
+        # keeps only the given sample rows, in every stream
+        rows = torch.as_tensor( rows, dtype=torch.int64 )
+        batch_rows = ( torch.arange( self.num_streams ).view(-1,1) * self.num_rows + rows.view(1,-1) ).view(-1).to( self.device )
+        self.next_positions = self.next_positions[batch_rows]
+        self.next_hidden = self.next_hidden[batch_rows]
+        if self.next_logits is not None:
+            self.next_logits = self.next_logits[batch_rows]
+        self.all_tokens = self.all_tokens[rows]
+        self.budgets = [ self.budgets[ind] for ind in rows.tolist() ]
+        self.num_rows = len( rows )
+
+        if self.kv is not None:
+            self.kv.select_rows( batch_rows.tolist() )
+            return
+
+        self.past_key_values = tuple(
+            tuple( t[batch_rows] for t in layer_past )
+            for layer_past in self.past_key_values )
+        self.attention_mask = self.attention_mask[batch_rows]
+
+        # drop the left padding no remaining row needs
+        used = self.attention_mask.any( dim=0 ).nonzero()
+        start = int( used[0] ) if len( used ) > 0 else self.attention_mask.shape[1]
+        if start > 0:
+            self.attention_mask = self.attention_mask[:,start:]
+            self.past_key_values = tuple(
+                tuple( t[:,:,start:] for t in layer_past )
+                for layer_past in self.past_key_values )
+
+    def get_tokens( self ):
+        return self.all_tokens
@@ -0,0 +1,200 @@
+import torch
+
+from decode_state import DecodeState, PagedDecodeState, get_decode_step
+
+#
+# ==========================================================================
+#
+
+class Generator():
+    # Decoding state of one model.  With static_len > 0, everything after
+    # the prompt's prefill lives in a preallocated DecodeState with room for
+    # static_len more tokens, and tokens are decoded one at a time by
+    # decode_step (compiled if compile_step is set).  With a kv_store, it
+    # lives in a PagedDecodeState over the store's shared blocks instead.
+    def __init__( self, model, tokenizer, use_cache=True, static_len=0, compile_step=False, kv_store=None ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.use_cache = use_cache
+        self.static_len = static_len
+        self.step = get_decode_step( compile_step )
+        self.kv_store = kv_store
+        self.state = None
+
+    def set_hard_context( self, hard_context ):
+        self.model.set_prompt_tokens( self.tokenizer.encode( hard_context, add_special_tokens=False) )
+        
+    def set_prompt( self, raw_text, num_rows=1 ):
+        if self.kv_store is not None and self.state is not None:
+            self.state.release()
+        self.device = self.model.lm_head.weight.device
+        self.token_struct = self.tokenizer( raw_text, return_tensors='pt' )        
+        self.all_tokens = torch.clone( self.token_struct['input_ids'] )
+        self.token_struct['input_ids'] = self.token_struct['input_ids'].to( self.device )
+        self.token_struct['attention_mask'] = self.token_struct['attention_mask'].to( self.device )
+        self.past_key_values = None
+        self.num_cached = 0
+        self.next_hidden = None
+        self.next_logits = None
+        self.state = None
+
+        if self.static_len > 0 or self.kv_store is not None:
+            # prefill with the model itself (so prefixes and hard contexts
+            # are handled as usual), then decode in place
+            self.get_next_hidden()
+            if self.kv_store is not None:
+                self.state = PagedDecodeState( self.model, self.kv_store, self.all_tokens.repeat( num_rows, 1 ), self.past_key_values )
+            else:
+                self.state = DecodeState( self.model, self.all_tokens.repeat( num_rows, 1 ), self.past_key_values,
+                                          self.static_len, step=self.step )
+            self.token_struct = None
+            self.all_tokens = None
+            self.past_key_values = None
+            self.next_hidden = self.next_hidden.repeat( num_rows, 1 )
+            return
+
+        if num_rows > 1:
+            if self.use_cache:
+                # prefill the prompt once and share it across all rows
+                self.get_next_hidden()
+            self.expand( num_rows )
+
+    def expand( self, num_rows ):
+        # turns a single-row state into num_rows identical rows that are
+        # then sampled independently
+        self.token_struct['input_ids'] = self.token_struct['input_ids'].repeat( num_rows, 1 )
+        self.token_struct['attention_mask'] = self.token_struct['attention_mask'].repeat( num_rows, 1 )
+        self.all_tokens = self.all_tokens.repeat( num_rows, 1 )
+        if self.past_key_values is not None:
+            # the cache only gets read before being concatenated with the
+            # new keys/values, so a broadcast view is enough here
+            self.past_key_values = tuple(
+                tuple( t.expand( num_rows, -1, -1, -1 ) for t in layer_past )
+                for layer_past in self.past_key_values )
+        if self.next_hidden is not None:
+            self.next_hidden = self.next_hidden.repeat( num_rows, 1 )
+        if self.next_logits is not None:
+            self.next_logits = self.next_logits.repeat( num_rows, 1 )
+
+    def _num_toks( self ):
+        if self.state is not None:
+            return self.state.num_toks
+        return self.token_struct['input_ids'].shape[1]
+
+    def _run_pending( self ):
+        # runs the tokens that are not in the cache yet (all of them on the
+        # first call, or when not caching) and returns their hidden states
+        if self.state is not None:
+            return self.state.run_pending()
+
+        if self.use_cache:
+            input_ids = self.token_struct['input_ids'][:,self.num_cached:]
+        else:
+            input_ids = self.token_struct['input_ids']
+            self.past_key_values = None
+
+        output = self.model.transformer( input_ids=input_ids,
+                                         attention_mask=self.token_struct['attention_mask'],
+                                         past_key_values=self.past_key_values,
+                                         use_cache=self.use_cache )
+        if self.use_cache:
+            self.past_key_values = output['past_key_values']
+        self.num_cached = self.token_struct['input_ids'].shape[1]
+        return output['last_hidden_state']
+
+    def get_next_hidden( self ):
+        # final hidden state at the last position, [B,E]
+        num_cached = self.num_cached if self.state is None else self.state.num_fed
+        if self.next_hidden is not None and num_cached == self._num_toks():
+            return self.next_hidden
+
+        self.next_hidden = self._run_pending()[:,-1,:]
+        self.next_logits = None
+        return self.next_hidden
+
+    def _uncache( self, num_toks ):
+        # shrinks the cache so that it holds at most the first num_toks tokens
+        if self.state is not None:
+            self.state.uncache( num_toks )
+            return
+
+        keep = max( min( self.num_cached, num_toks ), 0 )
+        drop = self.num_cached - keep
+        if self.past_key_values is not None and drop > 0:
+            self.past_key_values = tuple(
+                tuple( t[:,:,:t.shape[2]-drop] for t in layer_past )
+                for layer_past in self.past_key_values )
+        self.num_cached = keep
+
+    def get_new_logits( self, num_positions ):
+        # feeds every token not yet in the cache in one forward and returns
+        # the logits after each of the last num_positions tokens, [B,n,V]
+        self._uncache( self._num_toks() - num_positions )
+        hidden = self._run_pending()[:,-num_positions:,:]
+        logits = self.model.lm_head( hidden )
+        self.next_hidden = hidden[:,-1,:]
+        self.next_logits = logits[:,-1,:]
+        return logits
+
+    def rewind( self, num_toks ):
+        # drops the last num_toks tokens, e.g. rejected speculative ones
+        num_left = self._num_toks() - num_toks
+        if self.state is not None:
+            self.state.truncate( num_left )
+        else:
+            self.token_struct['input_ids'] = self.token_struct['input_ids'][:,:num_left]
+            self.token_struct['attention_mask'] = self.token_struct['attention_mask'][:,:num_left]
+            self.all_tokens = self.all_tokens[:,:num_left]
+
+        # also uncache the last remaining token, so that the next forward
+        # always has something to feed
+        self._uncache( num_left - 1 )
+        self.next_hidden = None
+        self.next_logits = None
+
+    def get_next_logits( self ):
+        hidden = self.get_next_hidden()
+        if self.next_logits is None:
+            # only the last position goes through the LM head
+            self.next_logits = self.model.lm_head( hidden )
+        return self.next_logits
+
+    def append_new_tok( self, new_token ):
+        # new_token is either a single token for all rows or a tensor with
+        # one token per row
+        num_rows = self.get_tokens().shape[0]
+        new_toks = torch.as_tensor( new_token, dtype=torch.int64 ).view(-1,1).expand( num_rows, 1 )
+        if self.state is not None:
+            self.state.append_tokens( new_toks.view(-1).cpu() )
+            return
+
+        self.token_struct['input_ids'] = torch.hstack(( self.token_struct['input_ids'], new_toks.to( self.device ) ))
+        self.token_struct['attention_mask']= torch.hstack(( self.token_struct['attention_mask'], torch.ones([num_rows,1],dtype=torch.int64,device=self.device) ))
+
+        self.all_tokens = torch.hstack(( self.all_tokens, new_toks.cpu() ))
+
+    def select_rows( self, rows ):
+        # keeps only the given rows (e.g. drops finished ones) everywhere,
+        # including the cache
+        rows = torch.as_tensor( rows, dtype=torch.int64 )
+        dev_rows = rows.to( self.device )
+        if self.next_hidden is not None:
+            self.next_hidden = self.next_hidden[dev_rows]
+        if self.next_logits is not None:
+            self.next_logits = self.next_logits[dev_rows]
+        if self.state is not None:
+            self.state.select_rows( rows )
+            return
+
+        self.token_struct['input_ids'] = self.token_struct['input_ids'][dev_rows]
+        self.token_struct['attention_mask'] = self.token_struct['attention_mask'][dev_rows]
+        self.all_tokens = self.all_tokens[rows]
+        if self.past_key_values is not None:
+            self.past_key_values = tuple(
+                tuple( t[dev_rows] for t in layer_past )
+                for layer_past in self.past_key_values )
+
+    def get_tokens( self ):
+        if self.state is not None:
+            return self.state.get_tokens()
+        return self.all_tokens
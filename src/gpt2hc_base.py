@@ -13,16 +13,28 @@ from transformers.modeling_outputs import (
     BaseModelOutputWithPastAndCrossAttentions
 )
 
+from common import module_view
+
 class GPT2ModelHC(GPT2Model):
 
     def __init__(self, config):
         super().__init__(config)
         self.prompt_tokens = []
+        self.prompt_past = None
 
-    def set_prompt_tokens( self, prompt_tokens ):
-        self.prompt_tokens = torch.Tensor( prompt_tokens ).unsqueeze(0).long().to("cuda:0")
+    def set_prompt_tokens( self, prompt_tokens, prompt_past=None ):
+        self.prompt_tokens = torch.Tensor( prompt_tokens ).unsqueeze(0).long().to( self.wte.weight.device )
         print( f"    setting {len(self.prompt_tokens)} prompt tokens" )
 
+        # the context's keys/values, computed once (unless they are given,
+        # e.g. from a ContextStore); forwards without a cache start from
+        # them instead of re-encoding the context.  A context that leaves
+        # no room for any input isn't cached, so forward truncates it to fit.
+        self.prompt_past = prompt_past
+        if self.prompt_past is None and 0 < self.prompt_tokens.shape[1] < self.config.n_positions:
+            with torch.no_grad():
+                self.prompt_past = GPT2Model.forward( self, input_ids=self.prompt_tokens, use_cache=True )['past_key_values']
+
     def forward(
         self,
         input_ids=None,
@@ -57,22 +69,31 @@ class GPT2ModelHC(GPT2Model):
                    "inputs_embeds at the same time")
             raise ValueError(msg)
         elif input_ids is not None:
+            max_len = self.config.n_positions
 
             if past_key_values is not None:
                 NUM_ADDED_TOKENS = 0
+            elif self.prompt_past is not None and self.prompt_tokens.shape[1] + input_ids.shape[1] <= max_len:
+                # the context is only attended to, through its cache
+                NUM_ADDED_TOKENS = 0
+                past_key_values = tuple(
+                    tuple( t.expand( input_ids.shape[0], -1, -1, -1 ) for t in layer_past )
+                    for layer_past in self.prompt_past )
+                if attention_mask is None:
+                    attention_mask = torch.ones_like( input_ids )
             else:
                 # input_ids is a tensor of [1,seq]
                 NUM_ADDED_TOKENS = self.prompt_tokens.shape[1]
-                if input_ids.shape[1] == 1024:
+                if input_ids.shape[1] == max_len:
                     NUM_ADDED_TOKENS = 0
-                elif NUM_ADDED_TOKENS + input_ids.shape[1] > 1024:
-                    NUM_ADDED_TOKENS = 1024 - input_ids.shape[1]
+                elif NUM_ADDED_TOKENS + input_ids.shape[1] > max_len:
+                    NUM_ADDED_TOKENS = max_len - input_ids.shape[1]
                     print( f"Only adding {NUM_ADDED_TOKENS}" )
-                    input_ids = torch.cat( (self.prompt_tokens[0:1,-NUM_ADDED_TOKENS:],input_ids), dim=1 )
+                    input_ids = torch.cat( (self.prompt_tokens[0:1,-NUM_ADDED_TOKENS:].expand(input_ids.shape[0],-1),input_ids), dim=1 )
                 else:
-                    input_ids = torch.cat( (self.prompt_tokens,input_ids), dim=1 )
+                    input_ids = torch.cat( (self.prompt_tokens.expand(input_ids.shape[0],-1),input_ids), dim=1 )
 
-                if input_ids.shape[1] > 1024:
+                if input_ids.shape[1] > max_len:
                     error('nope')
 
                 attention_mask = torch.ones_like( input_ids ) # XXX only works with batch_size of 1!!!
@@ -131,6 +152,20 @@ class GPT2ModelHC(GPT2Model):
 #            ), dim=1)
         ##############################################################
 
+        # When decoding against a cache, the hard context is already in
+        # the cache and the caller's mask only covers its own tokens.
+        if attention_mask is not None and past_length > 0:
+            num_cached_prefix = past_length + input_shape[-1] - attention_mask.shape[-1]
+            if num_cached_prefix > 0:
+                attention_mask = torch.cat((
+                    torch.ones(
+                        (batch_size, num_cached_prefix),
+                        dtype=attention_mask.dtype,
+                        device=device
+                    ),
+                    attention_mask
+                ), dim=1)
+
         # GPT2Attention mask.
         if attention_mask is not None:
             if batch_size <= 0:
@@ -329,5 +364,15 @@ class GPT2LMHC(GPT2LMHeadModel):
         # Initialize weights and apply final processing
         self.post_init()
 
-    def set_prompt_tokens( self, prompt_tokens ):
-        return self.transformer.set_prompt_tokens( prompt_tokens )
+    @classmethod
+    def from_backbone(cls, model):
+        # Wraps an already loaded GPT2LMHeadModel without copying its
+        # weights; only the hard context set afterwards is our own
+        view = module_view(model, cls)
+        view.transformer = module_view(model.transformer, GPT2ModelHC)
+        view.transformer.prompt_tokens = []
+        view.transformer.prompt_past = None
+        return view
+
+    def set_prompt_tokens( self, prompt_tokens, prompt_past=None ):
+        return self.transformer.set_prompt_tokens( prompt_tokens, prompt_past=prompt_past )
@@ -64,11 +64,12 @@ class GPT2SPLM(BaseLM):
 
     @property
     def max_length(self):
+        # the soft prefix takes up positions of its own
         try:
-            return self.gpt2.config.n_ctx
+            return self.gpt2.config.n_ctx - self.gpt2.transformer.prompt_tuning_k
         except AttributeError:
             # gptneoconfig doesn't have n_ctx apparently
-            return self.gpt2.config.max_position_embeddings
+            return self.gpt2.config.max_position_embeddings - self.gpt2.transformer.prompt_tuning_k
 
     @property
     def max_gen_toks(self):
@@ -10,17 +10,28 @@ from transformers.models.gpt2.modeling_gpt2 import (
     GPT2Model
 )
 from transformers.modeling_outputs import (
-    BaseModelOutputWithPastAndCrossAttentions
+    BaseModelOutputWithPastAndCrossAttentions,
+    CausalLMOutputWithCrossAttentions
 )
 
+from common import module_view
+
+# where the soft prefix goes in: as input embeddings before or after the
+# position embeddings, or as per-layer keys/values (deep prefix tuning)
+ENTRY_POINTS = [ "before_pe", "after_pe", "kv_prefix" ]
+
 class GPT2ModelPlus(GPT2Model):
 
     def __init__(self, config):
         super().__init__(config)
         self.do_prompt_tune = False
         self.vocab_len = config.vocab_size
+        self.prefix_past = None
+        self.prefix_past_key = None
+        self.prefix_bank = None
+        self.bank_cache = None
 
-    def set_up_prompt_tuning(self, k, entry_point):
+    def set_up_prompt_tuning(self, k, entry_point, prefix_past=None):
         self.do_prompt_tune = True
         self.prompt_tuning_entry_point = entry_point
 
@@ -32,11 +43,125 @@ class GPT2ModelPlus(GPT2Model):
             self.pt_prefix = nn.Parameter(
                 self.wte.weight[k_idxs].clone().detach().unsqueeze(0)
             )
+            if entry_point == "kv_prefix":
+                # start from the keys/values those tokens have at the
+                # front of a sequence
+                past = self.encode_prefix( self.pt_prefix, self.wte.weight.device )
+                self.pt_prefix = nn.Parameter( torch.stack(
+                    [ torch.cat( layer_past, dim=0 ) for layer_past in past ] ).float() )
         elif type(k) == str:
             print( f"    loading checkpoint {k}" )
             self.pt_prefix = nn.Parameter( torch.Tensor( np.load( k ) ) )
-            self.prompt_tuning_k = self.pt_prefix.shape[1]
-            
+            if ( self.pt_prefix.dim() == 5 ) != ( entry_point == "kv_prefix" ):
+                raise ValueError( f"{k} is not a {entry_point} checkpoint" )
+            self.prompt_tuning_k = self.pt_prefix.shape[-2 if entry_point == "kv_prefix" else 1]
+            if prefix_past is not None:
+                self.set_prefix_cache( prefix_past )
+            elif not self.training:
+                self.build_prefix_cache( self.wte.weight.device )
+
+    def set_up_prefix_bank( self, prefixes, entry_point ):
+        # Any number of trained prefixes (checkpoint files or arrays, of
+        # any lengths) for the same entry point.  A forward given
+        # prefix_ids [B] puts prefix prefix_ids[b] in front of row b, so
+        # rows with different prefixes share one pass over the backbone.
+        self.prefix_bank = []
+        for prefix in prefixes:
+            if type(prefix) == str:
+                print( f"    loading bank checkpoint {prefix}" )
+                prefix = np.load( prefix )
+            prefix = torch.as_tensor( prefix ).float()
+            if ( prefix.dim() == 5 ) != ( entry_point == "kv_prefix" ):
+                raise ValueError( f"prefix {len( self.prefix_bank )} of the bank is not a {entry_point} prefix" )
+            self.prefix_bank.append( prefix )
+        self.prefix_bank_entry_point = entry_point
+        self.bank_cache = None
+        if not self.training:
+            self.build_bank_cache( self.wte.weight.device )
+
+    def train(self, mode=True):
+        # outside of training the prefix is a constant, so eval() encodes
+        # it once for all later forwards
+        super().train(mode)
+        if not mode and self.do_prompt_tune:
+            self.build_prefix_cache( self.wte.weight.device )
+        if not mode and self.prefix_bank is not None:
+            self.build_bank_cache( self.wte.weight.device )
+        return self
+
+    def set_prefix_cache( self, prefix_past ):
+        # a cache built earlier for this same prefix (e.g. by a ContextStore)
+        self.prefix_past = prefix_past
+        self.prefix_past_key = ( self.pt_prefix._version, prefix_past[0][0].device )
+
+    def encode_prefix( self, embeds, device, add_positions=True ):
+        # per-layer keys/values of [1,k,E] prefix embeddings at the front of
+        # a sequence
+        with torch.no_grad():
+            hidden_states = embeds.to( device=device, dtype=self.wte.weight.dtype )
+            if add_positions:
+                hidden_states = hidden_states + self.wpe( torch.arange( embeds.shape[1], device=device ) )
+            presents = ()
+            for block in self.h:
+                hidden_states, present = block( hidden_states, use_cache=True )[:2]
+                presents = presents + (present,)
+        return presents
+
+    def build_prefix_cache( self, device ):
+        # Per-layer keys/values of the soft prefix.  Attention is causal, so
+        # they don't depend on the tokens that follow it.  Rebuilt when the
+        # prefix changes or the model moves to another device.
+        if self.prompt_tuning_entry_point == "kv_prefix":
+            # the prefix is the cache, [L,2,H,k,D]; views of it keep the
+            # gradients flowing
+            prefix = self.pt_prefix.to( device=device, dtype=self.wte.weight.dtype )
+            return tuple( ( layer[0:1], layer[1:2] ) for layer in prefix )
+
+        key = ( self.pt_prefix._version, torch.device( device ) )
+        if self.prefix_past_key == key:
+            return self.prefix_past
+
+        self.prefix_past = self.encode_prefix( self.pt_prefix, device,
+                                               add_positions=self.prompt_tuning_entry_point == "before_pe" )
+        self.prefix_past_key = key
+        return self.prefix_past
+
+    def build_bank_cache( self, device ):
+        # The caches of all bank prefixes, left-padded to the longest one:
+        # ( ( keys, values ) [N,H,K,D] per layer, mask [N,K], position of
+        # each prefix's first input token [N] )
+        device = torch.device( device )
+        if self.bank_cache is not None and self.bank_cache[1].device == device:
+            return self.bank_cache
+
+        entry_point = self.prefix_bank_entry_point
+        pasts = []
+        for prefix in self.prefix_bank:
+            if entry_point == "kv_prefix":
+                prefix = prefix.to( device=device, dtype=self.wte.weight.dtype )
+                pasts.append( tuple( ( layer[0:1], layer[1:2] ) for layer in prefix ) )
+            else:
+                pasts.append( self.encode_prefix( prefix, device, add_positions=entry_point == "before_pe" ) )
+        lengths = [ past[0][0].shape[2] for past in pasts ]
+        width = max( lengths )
+
+        bank_past = ()
+        for layer in range( len( self.h ) ):
+            keys, values = [ torch.zeros( ( len( pasts ), ) + pasts[0][layer][0].shape[1:2] + ( width, ) + pasts[0][layer][0].shape[3:],
+                                          dtype=pasts[0][layer][0].dtype, device=device ) for ind in range( 2 ) ]
+            for ind, past in enumerate( pasts ):
+                keys[ind,:,width-lengths[ind]:] = past[layer][0][0]
+                values[ind,:,width-lengths[ind]:] = past[layer][1][0]
+            bank_past = bank_past + ((keys, values),)
+
+        mask = torch.zeros( ( len( pasts ), width ), dtype=torch.int64, device=device )
+        for ind, length in enumerate( lengths ):
+            mask[ind,width-length:] = 1
+        starts = torch.tensor( [ 0 if entry_point == "after_pe" else length for length in lengths ], device=device )
+
+        self.bank_cache = ( bank_past, mask, starts )
+        return self.bank_cache
+
 
     def forward(
         self,
@@ -52,7 +177,8 @@ class GPT2ModelPlus(GPT2Model):
         use_cache=None,
         output_attentions=None,
         output_hidden_states=None,
-        return_dict=None
+        return_dict=None,
+        prefix_ids=None
     ):
 
         if output_attentions is None:
@@ -73,9 +199,35 @@ class GPT2ModelPlus(GPT2Model):
             raise ValueError(msg)
         elif input_ids is not None:
 
-            if input_ids.shape[1] + self.prompt_tuning_k > 1024:
+            if prefix_ids is not None:
+                # per-row prefixes from the bank, always through its cache
+                DO_SP = False
+                bank_past, bank_mask, bank_starts = self.build_bank_cache( input_ids.device )
+                if bank_mask.shape[1] + input_ids.shape[1] > self.config.n_positions:
+                    raise ValueError( f"{input_ids.shape[1]} tokens and the {bank_mask.shape[1]} token prefix bank "
+                                      f"don't fit in {self.config.n_positions} positions" )
+                if past_key_values is None:
+                    past_key_values = tuple( ( k[prefix_ids], v[prefix_ids] ) for k, v in bank_past )
+            elif past_key_values is not None:
+                # the prefix (if any) is already in the cache
+                DO_SP = False
+            elif not self.do_prompt_tune:
+                DO_SP = False
+            elif input_ids.shape[1] + self.prompt_tuning_k > self.config.n_positions:
+                if self.prompt_tuning_entry_point != "after_pe":
+                    raise ValueError( f"{input_ids.shape[1]} tokens and the {self.prompt_tuning_k} token soft prefix "
+                                      f"don't fit in {self.config.n_positions} positions" )
+                # an after_pe prefix takes no positions, but attention still
+                # can't reach past n_positions keys, so it is left out
                 print( "WARNING: prompt too long, skipping adding soft prefix" )
                 DO_SP = False
+            elif self.prompt_tuning_entry_point == "kv_prefix" or \
+                 ( not self.training and not ( torch.is_grad_enabled() and self.pt_prefix.requires_grad ) ):
+                # the prefix is a cache (or a constant); start from it
+                DO_SP = False
+                past_key_values = tuple(
+                    tuple( t.expand( input_ids.shape[0], -1, -1, -1 ) for t in layer_past )
+                    for layer_past in self.build_prefix_cache( input_ids.device ) )
             else:
                 DO_SP = True
 
@@ -104,29 +256,55 @@ class GPT2ModelPlus(GPT2Model):
             past_key_values = tuple([None] * len(self.h))
         else:
             past_length = past_key_values[0][0].size(-2)
-        if position_ids is None:
+
+        # When decoding against a cache, the soft prefix positions are
+        # already in the cache and the caller's mask only covers its own
+        # tokens.
+        num_cached_prefix = 0
+        if past_length > 0 and ( self.do_prompt_tune or prefix_ids is not None ):
+            if attention_mask is None:
+                num_cached_prefix = bank_mask.shape[1] if prefix_ids is not None else self.prompt_tuning_k
+            else:
+                num_cached_prefix = past_length + input_shape[-1] - attention_mask.shape[-1]
+
+        if position_ids is None and prefix_ids is not None:
+            # the bank's slots come first in the cache, then each row's
+            # tokens follow its own prefix
+            position_ids = torch.arange( input_shape[-1], dtype=torch.long, device=device ).unsqueeze(0) + \
+                ( past_length - bank_mask.shape[1] + bank_starts[prefix_ids] ).unsqueeze(1)
+        elif position_ids is None:
+            position_offset = past_length
+            if self.do_prompt_tune and self.prompt_tuning_entry_point == "after_pe":
+                # the prefix has no position of its own
+                position_offset -= num_cached_prefix
             position_ids = torch.arange(
-                past_length,
-                input_shape[-1]+past_length,
+                position_offset,
+                input_shape[-1]+position_offset,
                 dtype=torch.long,
                 device=device
             )
             position_ids = position_ids.unsqueeze(0).view(-1, input_shape[-1])
 
         if attention_mask is None:
-            if batch_size != 1:
+            if batch_size != 1 and prefix_ids is None:
                 error("I don't know how to handle this")
-            attention_mask = torch.ones( (batch_size, input_ids.shape[1]),
+            attention_mask = torch.ones( (batch_size, past_length - num_cached_prefix + input_shape[-1]),
                                          dtype=torch.int64,
                                          device=device )
 
         #######################################################################
-        if DO_SP and self.do_prompt_tune:
+        if num_cached_prefix > 0 and prefix_ids is not None:
+            # attend to each row's own prefix, not the bank's padding
+            attention_mask = torch.cat((
+                bank_mask[prefix_ids][:, bank_mask.shape[1]-num_cached_prefix:].to(attention_mask.dtype),
+                attention_mask
+            ), dim=1)
+        elif ( DO_SP or num_cached_prefix > 0 ) and self.do_prompt_tune:
             # Make it so we attend to the prompt tuning prefix
             attention_mask = torch.cat((
                 torch.ones(
-                    (batch_size, self.prompt_tuning_k),
-                    dtype=torch.int64,
+                    (batch_size, self.prompt_tuning_k if DO_SP else num_cached_prefix),
+                    dtype=attention_mask.dtype,
                     device=device
                 ),
                 attention_mask
@@ -192,7 +370,7 @@ class GPT2ModelPlus(GPT2Model):
             if self.prompt_tuning_entry_point == "before_pe":
                 # Add prompt tuning prefix on
                 inputs_embeds = torch.cat((
-                    self.pt_prefix.expand(batch_size, -1, -1),
+                    self.pt_prefix.to(inputs_embeds.dtype).expand(batch_size, -1, -1),
                     inputs_embeds
                 ), dim=1)
 
@@ -218,7 +396,7 @@ class GPT2ModelPlus(GPT2Model):
            self.prompt_tuning_entry_point == "after_pe":
             # Add prompt tuning prefix on
             hidden_states = torch.cat((
-                self.pt_prefix.expand(batch_size, -1, -1),
+                self.pt_prefix.to(hidden_states.dtype).expand(batch_size, -1, -1),
                 hidden_states
             ), dim=1)
             # Change input shape to account for prefix
@@ -366,13 +544,55 @@ class GPT2LMPlus(GPT2LMHeadModel):
         # Initialize weights and apply final processing
         self.post_init()
 
+    @classmethod
+    def from_backbone(cls, model):
+        # Wraps an already loaded GPT2LMHeadModel without copying its
+        # weights; only the soft prefix set up afterwards is our own
+        view = module_view(model, cls)
+        view.transformer = module_view(model.transformer, GPT2ModelPlus)
+        view.transformer.do_prompt_tune = False
+        view.transformer.vocab_len = model.config.vocab_size
+        view.transformer.prefix_past = None
+        view.transformer.prefix_past_key = None
+        view.transformer.prefix_bank = None
+        view.transformer.bank_cache = None
+        return view
+
+    def forward(self, *args, prefix_ids=None, labels=None, **kwargs):
+        if prefix_ids is None:
+            return super().forward(*args, labels=labels, **kwargs)
+
+        # rows with prefixes from the bank; only the plain decoding
+        # arguments are passed on
+        outputs = self.transformer(*args, prefix_ids=prefix_ids, **kwargs)
+        lm_logits = self.lm_head(outputs[0])
+
+        loss = None
+        if labels is not None:
+            # as in GPT2LMHeadModel, each position predicts the next label
+            shift_logits = lm_logits[..., :-1, :].contiguous()
+            shift_labels = labels.to(lm_logits.device)[..., 1:].contiguous()
+            loss = nn.CrossEntropyLoss()(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+
+        return CausalLMOutputWithCrossAttentions(
+            loss=loss,
+            logits=lm_logits,
+            past_key_values=outputs.past_key_values,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+            cross_attentions=outputs.cross_attentions,
+        )
+
+    def set_up_prefix_bank(self, prefixes, entry_point):
+        self.transformer.set_up_prefix_bank(prefixes, entry_point)
+
     def freeze_weights(self):
         for param in self.transformer.parameters():
             param.requires_grad = False
 
-    def set_up_prompt_tuning(self, k, entry_point):
+    def set_up_prompt_tuning(self, k, entry_point, prefix_past=None):
         self.freeze_weights()
-        self.transformer.set_up_prompt_tuning(k, entry_point)
+        self.transformer.set_up_prompt_tuning(k, entry_point, prefix_past=prefix_past)
 
     def save_prompt_checkpoint( self, fn ):
         np.save( fn, self.transformer.pt_prefix.clone().detach().cpu().numpy() )
@@ -0,0 +1,85 @@
+#
+# Runs prompt_gen.py as several shard processes and merges their outputs
+# into the usual hf_*_generations.jsonl file:
+#
+#   python launch.py --num_shards 8 --gpus 0,1,2,3 -- --hard --omega 2.0 --tau 1.0
+#
+# Everything after "--" is passed on to prompt_gen.py.  To spread a run
+# over several hosts, start each one with its own --local_shards range
+# (e.g. "0-3" and "4-7"), copy the shard files into one directory and run
+# with --merge_only there.
+#
+
+import os
+import sys
+import argparse
+import subprocess
+
+#
+# ==========================================================================
+#
+
+def parse_args( argv ):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--local_shards', type=str, default="") # e.g. "0-3"; default is all of them
+    parser.add_argument('--gpus', type=str, default="") # comma-separated devices, handed out round-robin
+    parser.add_argument('--threads', type=int, default=0) # intra-op threads per shard; default splits the cores
+    parser.add_argument('--merge_only', action='store_true')
+
+    return parser.parse_args( argv )
+
+def parse_range( text, num_shards ):
+    if text == "":
+        return list( range( num_shards ) )
+    first, last = text.split("-") if "-" in text else ( text, text )
+    return list( range( int(first), int(last)+1 ) )
+
+#
+# ==========================================================================
+#
+
+if "--" in sys.argv:
+    split = sys.argv.index("--")
+    args = parse_args( sys.argv[1:split] )
+    gen_args = sys.argv[split+1:]
+else:
+    args = parse_args( sys.argv[1:] )
+    gen_args = []
+
+prompt_gen = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "prompt_gen.py" )
+shard_args = [ "--num_shards", str( args.num_shards ) ]
+
+shards = parse_range( args.local_shards, args.num_shards )
+gpus = [ g for g in args.gpus.split(",") if g ]
+threads = args.threads if args.threads > 0 else max( ( os.cpu_count() or 1 ) // len( shards ), 1 )
+
+if not args.merge_only:
+    workers = []
+    for ind, shard in enumerate( shards ):
+        env = dict( os.environ )
+        env['OMP_NUM_THREADS'] = str( threads )
+        if gpus:
+            env['CUDA_VISIBLE_DEVICES'] = gpus[ind % len( gpus )]
+
+        log = open( f"shard_{shard}_of_{args.num_shards}.log", "a" )
+        print( f"starting shard {shard} of {args.num_shards}..." )
+        workers.append(( shard, log, subprocess.Popen( [ sys.executable, prompt_gen ] + gen_args + shard_args + [ "--shard", str( shard ) ],
+                                                       env=env, stdout=log, stderr=subprocess.STDOUT ) ))
+
+    failed = []
+    for shard, log, proc in workers:
+        if proc.wait() != 0:
+            failed.append( shard )
+        log.close()
+
+    if failed:
+        print( f"shards {failed} failed, see their logs; not merging" )
+        sys.exit( 1 )
+
+    if len( shards ) < args.num_shards:
+        print( "only some of the shards ran here; merge with --merge_only once all are done" )
+        sys.exit( 0 )
+
+sys.exit( subprocess.call( [ sys.executable, prompt_gen ] + gen_args + shard_args + [ "--merge_shards" ] ) )
@@ -0,0 +1,233 @@
+#
+# Records the normal and expert next-token distributions of a generation
+# run, and replays any bonus formula, omega and tau against them offline:
+#
+#   python prompt_gen.py --soft ... --trace ./traces/run1
+#   python logit_trace.py ./traces/run1 --formulas contrastive,min --omegas 0.5,1,2,4 --taus 0.5,1,2
+#
+# Every recorded step keeps the top_k tokens of the normal distribution
+# (plus the sampled token, if it is not among them) and every stream's
+# log-probabilities on that support, in float16, along with each stream's
+# remaining tail mass.  Replay treats the tail as one more pseudo-token and
+# keeps the sampled tokens fixed (teacher forcing), so a whole grid of
+# settings only costs a few vectorized passes over the memory-mapped files.
+#
+
+import os
+import sys
+import json
+import argparse
+
+import torch
+import torch.nn.functional as F
+import numpy as np
+
+#
+# ==========================================================================
+#
+
+TRACE_FILES = [ 'meta', 'inds', 'logprobs', 'tails' ]
+
+class TraceRecorder():
+    # Appends one record per running row and decoding step.  meta holds
+    # ( prompt index, sample index, step, sampled token ) of each record.
+    # Rows are keyed by start() and follow the batch's compaction.
+
+    def __init__( self, path, vocab_size, stream_names, top_k=64 ):
+        os.makedirs( path, exist_ok=True )
+        self.top_k = min( top_k, vocab_size )
+        self.index_dtype = np.uint16 if vocab_size <= 2**16 else np.int32
+        header = { 'vocab_size': vocab_size, 'streams': stream_names, 'top_k': self.top_k,
+                   'index_dtype': np.dtype( self.index_dtype ).name }
+
+        header_fn = os.path.join( path, "header.json" )
+        if os.path.exists( header_fn ) and json.load( open( header_fn ) ) != header:
+            raise ValueError( f"trace {path} was recorded with different settings" )
+        json.dump( header, open( header_fn, "w" ) )
+
+        self.files = { name: open( os.path.join( path, name + ".bin" ), "ab" ) for name in TRACE_FILES }
+        self.keys = []
+        self.step = 0
+
+    def start( self, keys ):
+        # a new batch of rows, one ( prompt index, sample index ) key each
+        for f in self.files.values():
+            f.flush()
+        self.keys = list( keys )
+        self.step = 0
+
+    def select_rows( self, rows ):
+        self.keys = [ self.keys[ind] for ind in rows ]
+
+    def record( self, stream_logits, tokens, step=None ):
+        # stream_logits holds [B,V] logits for every stream, normal first;
+        # tokens [B] are the tokens sampled from them at step (by default
+        # the one after the last recorded step)
+        step = self.step if step is None else step
+        logprobs = F.log_softmax( torch.stack( list( stream_logits ), dim=0 ).float(), dim=-1 )
+        num_streams, num_rows = logprobs.shape[:2]
+
+        inds = torch.topk( logprobs[0], self.top_k, dim=-1 )[1]
+        tokens = torch.as_tensor( tokens ).to( inds.device ).view(-1)
+        present = ( inds == tokens.view(-1,1) ).any( dim=-1 )
+        inds[:,-1] = torch.where( present, inds[:,-1], tokens )
+
+        support = torch.gather( logprobs, 2, inds.unsqueeze(0).expand( num_streams, -1, -1 ) )
+        tails = torch.log( ( 1.0 - support.exp().sum( dim=-1 ) ).clamp( min=1e-30 ) )
+
+        meta = np.array( [ [ *key, step, tok ] for key, tok in zip( self.keys, tokens.tolist() ) ], dtype=np.int32 )
+        self.files['meta'].write( meta.tobytes() )
+        self.files['inds'].write( inds.cpu().numpy().astype( self.index_dtype ).tobytes() )
+        self.files['logprobs'].write( support.transpose( 0, 1 ).cpu().numpy().astype( np.float16 ).tobytes() )
+        self.files['tails'].write( tails.t().cpu().numpy().astype( np.float32 ).tobytes() )
+        self.step = step + 1
+
+    def close( self ):
+        for f in self.files.values():
+            f.close()
+
+class Trace():
+    # Read side of a TraceRecorder's files, memory-mapped
+
+    def __init__( self, path ):
+        self.header = json.load( open( os.path.join( path, "header.json" ) ) )
+        self.streams = self.header['streams']
+        num_streams = len( self.streams )
+        top_k = self.header['top_k']
+
+        def load( name, dtype, shape ):
+            fn = os.path.join( path, name + ".bin" )
+            if os.path.getsize( fn ) == 0:
+                return np.zeros( (0,) + shape, dtype=dtype )
+            return np.memmap( fn, dtype=dtype, mode='r' ).reshape( (-1,) + shape )
+
+        self.meta = load( 'meta', np.int32, (4,) )
+        self.inds = load( 'inds', np.dtype( self.header['index_dtype'] ), (top_k,) )
+        self.logprobs = load( 'logprobs', np.float16, (num_streams, top_k) )
+        self.tails = load( 'tails', np.float32, (num_streams,) )
+        # a run that was killed mid-write leaves partial records behind
+        self.num_records = min( len( self.meta ), len( self.inds ), len( self.logprobs ), len( self.tails ) )
+
+    def __len__( self ):
+        return self.num_records
+
+    def batches( self, batch_size=65536 ):
+        # yields ( support log-probs [S,N,K+1] with the tail last, position
+        # of the sampled token in the support [N] )
+        for start in range( 0, self.num_records, batch_size ):
+            end = min( start + batch_size, self.num_records )
+            logprobs = torch.from_numpy( np.asarray( self.logprobs[start:end], dtype=np.float32 ) )
+            tails = torch.from_numpy( np.array( self.tails[start:end] ) )
+            support = torch.cat( (logprobs, tails.unsqueeze(-1)), dim=-1 ).transpose( 0, 1 )
+
+            inds = torch.from_numpy( np.asarray( self.inds[start:end], dtype=np.int64 ) )
+            tokens = torch.from_numpy( np.asarray( self.meta[start:end,3], dtype=np.int64 ) )
+            yield support, ( inds == tokens.view(-1,1) ).int().argmax( dim=-1 )
+
+#
+# ==========================================================================
+#
+
+# Bonus formulas: fn( nor, experts, tau ) -> bonus, all [N,K] log-probs over
+# the recorded support ( experts[0] is the one steered towards ).  The final
+# distribution is log_softmax( nor + omega*bonus ).
+BONUS_FORMULAS = {}
+
+def bonus_formula( name ):
+    def register( fn ):
+        BONUS_FORMULAS[name] = fn
+        return fn
+    return register
+
+@bonus_formula( "contrastive" )
+def contrastive_bonus( nor, experts, tau ):
+    # log posterior of the first expert, as in ContrastiveCombiner.bonus
+    return F.log_softmax( tau * torch.stack( experts, dim=0 ), dim=0 )[0]
+
+@bonus_formula( "min" )
+def min_bonus( nor, experts, tau ):
+    return -nor + tau * torch.minimum( nor, nor + ( experts[0] - experts[1] ) )
+
+@bonus_formula( "pos" )
+def pos_bonus( nor, experts, tau ):
+    return -nor + tau * experts[0]
+
+@bonus_formula( "ratio" )
+def ratio_bonus( nor, experts, tau ):
+    return tau * ( experts[0] - experts[1] )
+
+# Metrics: fn( final, nor, token_pos ) -> [N] values, averaged over records
+METRICS = {}
+
+def metric( name ):
+    def register( fn ):
+        METRICS[name] = fn
+        return fn
+    return register
+
+@metric( "token_logprob" )
+def token_logprob( final, nor, token_pos ):
+    # log-probability of the recorded token
+    return torch.gather( final, 1, token_pos.view(-1,1) ).view(-1)
+
+@metric( "entropy" )
+def entropy( final, nor, token_pos ):
+    return -( final.exp() * final ).sum( dim=-1 )
+
+@metric( "kl_normal" )
+def kl_normal( final, nor, token_pos ):
+    return ( final.exp() * ( final - nor ) ).sum( dim=-1 )
+
+@metric( "top1_changed" )
+def top1_changed( final, nor, token_pos ):
+    return ( final.argmax( dim=-1 ) != nor.argmax( dim=-1 ) ).float()
+
+def replay( trace, formula, omegas, taus, metrics=None, batch_size=65536 ):
+    # evaluates a bonus formula for every ( omega, tau ) on all recorded
+    # steps; returns { (omega, tau): { metric: mean } }
+    fn = BONUS_FORMULAS[formula]
+    metrics = list( METRICS ) if metrics is None else metrics
+    omegas = torch.tensor( omegas, dtype=torch.float32 ).view(-1,1,1)
+
+    totals = {}
+    for support, token_pos in trace.batches( batch_size ):
+        nor = support[0]
+        experts = list( support[1:] )
+        for tau in taus:
+            bonus = fn( nor, experts, tau )
+            finals = F.log_softmax( nor.unsqueeze(0) + omegas * bonus.unsqueeze(0), dim=-1 )
+            for ind, omega in enumerate( omegas.view(-1).tolist() ):
+                sums = totals.setdefault( (omega, tau), { name: 0.0 for name in metrics } )
+                for name in metrics:
+                    sums[name] += float( METRICS[name]( finals[ind], nor, token_pos ).sum() )
+
+    return { key: { name: total / max( len( trace ), 1 ) for name, total in sums.items() } for key, sums in totals.items() }
+
+#
+# ==========================================================================
+#
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace', type=str)
+    parser.add_argument('--formulas', type=str, default="contrastive")
+    parser.add_argument('--omegas', type=str, default="1.0")
+    parser.add_argument('--taus', type=str, default="1.0")
+    parser.add_argument('--metrics', type=str, default="") # default is all of them
+    parser.add_argument('--batch_size', type=int, default=65536)
+    args = parser.parse_args()
+
+    trace = Trace( args.trace )
+    if len( trace ) == 0:
+        print( f"no records in {args.trace}" )
+        sys.exit( 1 )
+
+    omegas = [ float( v ) for v in args.omegas.split(",") ]
+    taus = [ float( v ) for v in args.taus.split(",") ]
+    metrics = list( filter( None, args.metrics.split(",") ) ) or list( METRICS )
+    print( f"{len( trace )} records, streams {trace.streams}" )
+    print( f"{'formula':<12} {'omega':>6} {'tau':>6} " + " ".join( f"{name:>14}" for name in metrics ) )
+    for formula in args.formulas.split(","):
+        results = replay( trace, formula, omegas, taus, metrics=metrics, batch_size=args.batch_size )
+        for (omega, tau), values in sorted( results.items() ):
+            print( f"{formula:<12} {omega:>6.2f} {tau:>6.2f} " + " ".join( f"{values[name]:>14.4f}" for name in metrics ) )
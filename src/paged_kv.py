@@ -0,0 +1,220 @@
+import math
+import torch
+
+#
+# ==========================================================================
+#
+
+class PagedKVStore():
+    # A fixed pool of key/value blocks, each holding block_size positions of
+    # every layer, shared by all models with the same shape (the normal
+    # model and the experts) and all of their sequences.  Blocks are
+    # reference counted: samples forked from one prompt share its blocks
+    # and only copy one when they write into it (copy-on-write), and a
+    # block goes back to the free list once nothing points at it.
+
+    def __init__( self, num_layers, num_heads, head_dim, num_blocks, block_size=16, dtype=torch.float32, device="cpu" ):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        shape = ( num_blocks, block_size, num_heads, head_dim )
+        self.keys = [ torch.zeros( shape, dtype=dtype, device=device ) for layer in range( num_layers ) ]
+        self.values = [ torch.zeros( shape, dtype=dtype, device=device ) for layer in range( num_layers ) ]
+        self.refcounts = [ 0 ] * num_blocks
+        self.free = list( range( num_blocks-1, -1, -1 ) )
+
+    @classmethod
+    def for_model( cls, model, num_blocks, block_size=16 ):
+        config = model.config
+        weight = model.transformer.wte.weight
+        return cls( config.n_layer, config.n_head, config.n_embd // config.n_head, num_blocks,
+                    block_size=block_size, dtype=weight.dtype, device=weight.device )
+
+    def num_free( self ):
+        return len( self.free )
+
+    def alloc( self ):
+        if len( self.free ) == 0:
+            raise MemoryError( f"all {self.num_blocks} KV blocks are in use" )
+        block = self.free.pop()
+        self.refcounts[block] = 1
+        return block
+
+    def incref( self, blocks ):
+        for block in blocks:
+            self.refcounts[block] += 1
+
+    def decref( self, blocks ):
+        for block in blocks:
+            self.refcounts[block] -= 1
+            if self.refcounts[block] == 0:
+                self.free.append( block )
+
+    def writable( self, block ):
+        # the block itself if nobody else uses it, otherwise a private copy
+        if self.refcounts[block] == 1:
+            return block
+        copy = self.alloc()
+        for pool in self.keys + self.values:
+            pool[copy] = pool[block]
+        self.decref( [ block ] )
+        return copy
+
+class PagedRows():
+    # Block tables and cache lengths of a batch of rows in a PagedKVStore.
+    # Row r's position t lives at offset t % block_size of block
+    # tables[r][t // block_size].
+
+    def __init__( self, store ):
+        self.store = store
+        self.tables = []
+        self.lengths = []
+
+    def add_prefill( self, past_key_values, starts, copies=1 ):
+        # appends the rows of a prefill's legacy cache ( [R,H,T,D] per
+        # layer ), row r holding positions starts[r]: of it (the rest is
+        # left padding); each becomes copies rows sharing the same blocks
+        bs = self.store.block_size
+        for row, start in enumerate( starts ):
+            length = past_key_values[0][0].shape[2] - start
+            table = [ self.store.alloc() for ind in range( math.ceil( length / bs ) ) ]
+            for layer, (k, v) in enumerate( past_key_values ):
+                for ind, block in enumerate( table ):
+                    end = min( ( ind+1 ) * bs, length )
+                    self.store.keys[layer][block,:end-ind*bs] = k[row,:,start+ind*bs:start+end].transpose( 0, 1 )
+                    self.store.values[layer][block,:end-ind*bs] = v[row,:,start+ind*bs:start+end].transpose( 0, 1 )
+            self.store.incref( table * ( copies-1 ) )
+            self.tables += [ list( table ) for ind in range( copies ) ]
+            self.lengths += [ length ] * copies
+
+    def select_rows( self, rows ):
+        # keeps (or repeats) the given rows; repeated rows share blocks
+        tables = [ list( self.tables[ind] ) for ind in rows ]
+        lengths = [ self.lengths[ind] for ind in rows ]
+        for table in tables:
+            self.store.incref( table )
+        self.release()
+        self.tables = tables
+        self.lengths = lengths
+
+    def truncate( self, lengths ):
+        # forgets every position past each row's new length
+        bs = self.store.block_size
+        for row, length in enumerate( lengths ):
+            keep = math.ceil( length / bs )
+            self.store.decref( self.tables[row][keep:] )
+            self.tables[row] = self.tables[row][:keep]
+            self.lengths[row] = length
+
+    def blocks_to_grow( self, extra ):
+        # how many more blocks the rows need to grow by extra[r] positions
+        # each, counting a private copy of every shared last block
+        bs = self.store.block_size
+        total = 0
+        for table, length, num in zip( self.tables, self.lengths, extra ):
+            if num > 0:
+                total += math.ceil( ( length + num ) / bs ) - len( table )
+                if length % bs and self.store.refcounts[table[-1]] > 1:
+                    total += 1
+        return total
+
+    def blocks_held( self ):
+        # how many blocks only these rows use, i.e. release() would free
+        uses = {}
+        for table in self.tables:
+            for block in table:
+                uses[block] = uses.get( block, 0 ) + 1
+        return sum( 1 for block, num in uses.items() if self.store.refcounts[block] == num )
+
+    def release( self ):
+        for table in self.tables:
+            self.store.decref( table )
+        self.tables = []
+        self.lengths = []
+
+    def prepare_step( self, device ):
+        # makes room for one more position in every row; returns the flat
+        # slots it goes to [R], the block tables [R,N] and the attention
+        # mask over the gathered blocks [R,N*block_size]
+        bs = self.store.block_size
+        slots = []
+        for row, length in enumerate( self.lengths ):
+            table = self.tables[row]
+            if length // bs == len( table ):
+                table.append( self.store.alloc() )
+            else:
+                table[-1] = self.store.writable( table[-1] )
+            slots.append( table[-1] * bs + length % bs )
+            self.lengths[row] = length + 1
+
+        num_blocks = max( len( table ) for table in self.tables )
+        tables = torch.tensor( [ table + [0] * ( num_blocks - len( table ) ) for table in self.tables ], device=device )
+        lengths = torch.tensor( self.lengths, device=device )
+        mask = torch.arange( num_blocks * bs, device=device ).view(1,-1) < lengths.view(-1,1)
+        return torch.tensor( slots, device=device ), tables, mask
+
+#
+# ==========================================================================
+#
+
+def paged_attention( query, key_pool, value_pool, tables, mask, scale, chunk_blocks=8 ):
+    # Attention of query [R,H,1,D] over the blocks of a store's key/value
+    # pools listed in tables [R,N], masked by mask [R,N*block_size].  The
+    # blocks are visited chunk_blocks at a time with a running softmax, so
+    # only that many blocks per row are ever gathered, instead of a dense
+    # copy of every row's whole cache per layer and step.  Returns [R,H,1,D]
+    num_rows, num_heads, _, head_dim = query.shape
+    bs = key_pool.shape[1]
+    query = query.float() * scale
+
+    running_max = torch.full( ( num_rows, num_heads, 1, 1 ), -float('Inf'), device=query.device )
+    denom = torch.zeros( ( num_rows, num_heads, 1, 1 ), device=query.device )
+    out = torch.zeros( ( num_rows, num_heads, 1, head_dim ), device=query.device )
+    for start in range( 0, tables.shape[1], chunk_blocks ):
+        blocks = tables[:,start:start+chunk_blocks]
+        keys = key_pool[blocks].view( num_rows, -1, num_heads, head_dim ).permute( 0, 2, 3, 1 )
+        values = value_pool[blocks].view( num_rows, -1, num_heads, head_dim ).transpose( 1, 2 )
+        scores = torch.matmul( query, keys.float() )
+        scores = scores.masked_fill( ~mask[:,start*bs:(start+blocks.shape[1])*bs].view( num_rows, 1, 1, -1 ), -float('Inf') )
+
+        # rescale what we have to the new maximum; rows with nothing
+        # unmasked so far shift by 0 instead of -Inf
+        new_max = torch.maximum( running_max, scores.amax( dim=-1, keepdim=True ) )
+        shift = torch.where( torch.isinf( new_max ), torch.zeros_like( new_max ), new_max )
+        probs = torch.exp( scores - shift )
+        rescale = torch.exp( running_max - shift )
+        denom = denom * rescale + probs.sum( dim=-1, keepdim=True )
+        out = out * rescale + torch.matmul( probs, values.float() )
+        running_max = new_max
+
+    return ( out / denom ).to( key_pool.dtype )
+
+def paged_decode_step( transformer, input_ids, positions, store, slots, tables, mask ):
+    # Like decode_step, but the new keys/values go to the given slots of a
+    # PagedKVStore and attention runs block by block over each row's
+    # blocks.  input_ids and positions are [R]; returns the final hidden
+    # states [R,E]
+    config = transformer.config
+    num_rows = input_ids.shape[0]
+    num_heads = config.n_head
+    head_dim = config.n_embd // num_heads
+
+    hidden = transformer.wte( input_ids ) + transformer.wpe( positions )
+    hidden = hidden.view( num_rows, 1, -1 )
+    for layer, block in enumerate( transformer.h ):
+        scale = 1.0 / math.sqrt( head_dim ) if config.scale_attn_weights else 1.0
+        if config.scale_attn_by_inverse_layer_idx:
+            scale /= float( layer + 1 )
+
+        query, key, value = block.attn.c_attn( block.ln_1( hidden ) ).split( config.n_embd, dim=2 )
+        query = query.view( num_rows, 1, num_heads, head_dim ).transpose( 1, 2 )
+        store.keys[layer].view( -1, num_heads, head_dim ).index_copy_( 0, slots, key.view( num_rows, num_heads, head_dim ) )
+        store.values[layer].view( -1, num_heads, head_dim ).index_copy_( 0, slots, value.view( num_rows, num_heads, head_dim ) )
+
+        attn = paged_attention( query, store.keys[layer], store.values[layer], tables, mask, scale )
+        attn = attn.transpose( 1, 2 ).reshape( num_rows, 1, -1 )
+        hidden = hidden + block.attn.c_proj( attn )
+        hidden = hidden + block.mlp( block.ln_2( hidden ) )
+
+    return transformer.ln_f( hidden ).view( num_rows, -1 )
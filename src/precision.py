@@ -0,0 +1,62 @@
+import torch
+import torch.nn as nn
+
+from transformers.pytorch_utils import Conv1D
+
+#
+# ==========================================================================
+#
+
+PRECISIONS = [ "fp32", "bf16", "int8" ]
+
+def conv1d_to_linear( module ):
+    # Replaces every GPT-2 Conv1D (y = x @ W + b, W stored [in,out]) below
+    # module with the equivalent nn.Linear, which the quantizer knows about
+    for name, child in module.named_children():
+        if isinstance( child, Conv1D ):
+            linear = nn.Linear( child.weight.shape[0], child.weight.shape[1] )
+            linear.weight = nn.Parameter( child.weight.detach().t().contiguous(), requires_grad=False )
+            linear.bias = nn.Parameter( child.bias.detach().clone(), requires_grad=False )
+            setattr( module, name, linear )
+        else:
+            conv1d_to_linear( child )
+
+def _float_input( module, inputs ):
+    return tuple( x.to( module.weight.dtype ) for x in inputs )
+
+def reduce_precision( model, precision ):
+    # Runs a GPT2LMHeadModel's backbone in bfloat16, or with its linear
+    # layers dynamically quantized to int8 (CPU only).  The LM head keeps
+    # a full-precision copy of the embeddings, so the logits and all the
+    # contrastive math after them stay in fp32; soft prefixes are trained
+    # parameters of the views and stay fp32 as well.
+    if precision == "fp32":
+        return model
+
+    if precision == "bf16":
+        lm_weight = model.lm_head.weight.detach().float().clone()
+        model.transformer.to( torch.bfloat16 )
+        model.lm_head.weight = nn.Parameter( lm_weight, requires_grad=False )
+        model.lm_head.register_forward_pre_hook( _float_input )
+
+    elif precision == "int8":
+        conv1d_to_linear( model.transformer.h )
+        torch.ao.quantization.quantize_dynamic( model.transformer.h, { nn.Linear }, dtype=torch.qint8, inplace=True )
+
+    else:
+        raise ValueError( f"unknown precision {precision}, use one of {PRECISIONS}" )
+
+    return model
+
+def model_bytes( model ):
+    # size of a model's weights, counting shared and packed ones once
+    seen = set()
+    total = 0
+    for t in list( model.parameters() ) + list( model.buffers() ):
+        if id( t ) not in seen:
+            seen.add( id( t ) )
+            total += t.numel() * t.element_size()
+    for m in model.modules():
+        if isinstance( m, torch.ao.nn.quantized.dynamic.Linear ):
+            total += m.weight().numel() * m.weight().element_size() + m.bias().numel() * m.bias().element_size()
+    return total
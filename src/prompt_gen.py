@@ -21,8 +21,14 @@ from transformers import (AutoModelForCausalLM,AutoTokenizer)
 
 from common import *
 
-from gpt2sp_base import GPT2LMPlus
+from gpt2sp_base import GPT2LMPlus, ENTRY_POINTS
 from gpt2hc_base import GPT2LMHC
+from expert_batch import ExpertBatch, get_stream_prefix
+from generator import Generator
+from paged_kv import PagedKVStore
+from logit_trace import TraceRecorder
+from precision import PRECISIONS, reduce_precision, model_bytes
+from ctxstore import ContextStore, hard_context_state, soft_prefix_state, context_tokens
 
 import json
 
@@ -71,6 +77,7 @@ def parse_args():
     parser.add_argument('--negmodel', type=str, default="gpt2") # gpt2-xl, gpt2-medium
     
     parser.add_argument('--dim', type=int, default=10)
+    parser.add_argument('--entry_point', type=str, default="before_pe", choices=ENTRY_POINTS) # how the soft checkpoints were trained
 
     parser.add_argument('--num_prompts', type=int, default=2000)    
 
@@ -102,52 +109,173 @@ def parse_args():
 
     parser.add_argument('--verbose', action='store_true')    
 
-    return parser.parse_args()
+    parser.add_argument('--no_cache', action='store_true') # re-run the whole sequence every step
+    parser.add_argument('--batch_gens', action='store_true') # decode all num_gens samples of a prompt as one batch
+    parser.add_argument('--shared_forward', action='store_true') # run all streams as one batched forward over the normal model's backbone
+
+    parser.add_argument('--parallel_experts', action='store_true') # run the three models' forwards concurrently
+    parser.add_argument('--expert_threads', type=str, default="") # e.g. "16,4,4"; default splits the cores evenly
+
+    # only score the experts on the normal model's nucleus plus a margin
+    parser.add_argument('--restrict_vocab', action='store_true')
+    parser.add_argument('--restrict_margin', type=int, default=50)
+    parser.add_argument('--restrict_samples', type=int, default=64) # tail samples for the experts' normalizers
+
+    # additional contrast experts, only used with --shared_forward
+    parser.add_argument('--extracontexts', type=str, default="") # comma-separated KNOWN_TEXTS keys (--hard)
+    parser.add_argument('--extracheckpoints', type=str, default="") # comma-separated prefix checkpoints (--soft)
+
+    # speculative decoding: a small model drafts tokens the experts then verify
+    parser.add_argument('--draft_model', type=str, default="") # e.g. distilgpt2
+    parser.add_argument('--spec_len', type=int, default=4)
+
+    # skip the experts on steps where the normal model is confident
+    parser.add_argument('--lazy_entropy', type=float, default=0.0) # entropy threshold in nats; 0 disables
+    parser.add_argument('--lazy_divergence', action='store_true') # score skipped steps at catch-up (costs the experts' LM head)
+
+    # per-row stopping; rows also stop when they sample EOS
+    parser.add_argument('--max_tokens', type=int, default=20)
+    parser.add_argument('--stop_string', type=str, action='append', default=[]) # may be repeated; escapes like \n are decoded
+
+    # decode from preallocated buffers instead of growing tensors
+    parser.add_argument('--static_decode', action='store_true')
+    parser.add_argument('--compile_decode', action='store_true') # torch.compile the single-token step (needs --static_decode)
+
+    # continuous batching across prompts (needs --shared_forward)
+    parser.add_argument('--slots', type=int, default=0) # rows decoding at once; 0 goes prompt by prompt
+
+    # sharding: this process only does every num_shards-th prompt, starting
+    # at shard; every sample draws from its own seeded RNG stream
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--shard', type=int, default=0)
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--merge_shards', action='store_true') # merge the shards' outputs and exit
+
+    # decode several configurations as rows of one batch, one output file
+    # each: comma-separated omega:tau[:temperature[:top_p]], missing values
+    # default to the flags above, e.g. "1:1,2:1,4:1,4:0.5:0.8"
+    parser.add_argument('--sweep', type=str, default="")
+
+    # record every step's normal and expert distributions for offline
+    # replay with logit_trace.py
+    parser.add_argument('--trace', type=str, default="") # output directory
+    parser.add_argument('--trace_top_k', type=int, default=64)
+
+    # where and in what precision the backbones run; soft prefixes, logits
+    # and the contrastive math always stay fp32
+    parser.add_argument('--device', type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--precision', type=str, default="fp32", choices=PRECISIONS) # int8 is dynamic quantization, cpu only
+    parser.add_argument('--drift_prompts', type=int, default=0) # compare that many prompts against fp32 before the run
+
+    # keep the caches in a fixed pool of paged KV blocks shared by all
+    # models and rows; samples share their prompt's blocks
+    parser.add_argument('--kv_blocks', type=int, default=0) # pool size in blocks; 0 keeps per-row tensors
+    parser.add_argument('--kv_block_size', type=int, default=16)
+
+    # keep tokenized contexts and prefix caches on disk, shared by every
+    # process using the same directory
+    parser.add_argument('--ctx_store', type=str, default="") # directory; empty recomputes everything
+    parser.add_argument('--ctx_store_mb', type=int, default=4096) # least recently used entries go beyond this
+
+    # HTTP service instead of a batch run (needs --shared_forward); --slots
+    # is the batch width, and requests beyond --queue_size get a 503
+    parser.add_argument('--serve_port', type=int, default=0) # 0 does a batch run
+    parser.add_argument('--serve_host', type=str, default="127.0.0.1")
+    parser.add_argument('--queue_size', type=int, default=64)
+
+    args = parser.parse_args()
+    args.stop_string = [ s.encode().decode('unicode_escape') for s in args.stop_string ]
+
+    configs = []
+    for text in filter( None, args.sweep.split(",") ):
+        values = [ float( v ) for v in text.split(":") ]
+        configs.append( { name: values[ind] if ind < len( values ) else getattr( args, name ) for ind, name in enumerate( RowSettings.NAMES ) } )
+    args.sweep = configs
+
+    return args
+
+def sweep_args( args, config ):
+    # the args of one sweep configuration
+    return argparse.Namespace( **{ **vars( args ), **config } )
 
 #
 # ==========================================================================
 #
 
-class Generator():
-    def __init__( self, model, tokenizer ):
-        self.model = model
-        self.tokenizer = tokenizer
-
-    def set_hard_context( self, hard_context ):
-        self.model.set_prompt_tokens( self.tokenizer.encode( hard_context, add_special_tokens=False) )
-        
-    def set_prompt( self, raw_text ):
-        self.token_struct = self.tokenizer( raw_text, return_tensors='pt' )        
-        self.all_tokens = torch.clone( self.token_struct['input_ids'] )
-        self.token_struct['input_ids'] = self.token_struct['input_ids'].to("cuda:0")
-        self.token_struct['attention_mask'] = self.token_struct['attention_mask'].to("cuda:0")
-        self.past_key_values = None
-
-    def get_next_logits( self ):
-        output = self.model( **self.token_struct, past_key_values = self.past_key_values )
-        
-#        self.past_key_values = output['past_key_values']
-        
-        return output['logits'][0:1,-1,:]
-
-    def append_new_tok( self, new_token ):
-        self.token_struct['input_ids'] = torch.hstack(( self.token_struct['input_ids'], torch.tensor([[new_token]],dtype=torch.int64,device="cuda:0") ))
-        self.token_struct['attention_mask']= torch.hstack(( self.token_struct['attention_mask'], torch.ones([1,1],dtype=torch.int64,device="cuda:0") ))
-
-#        self.token_struct['input_ids'] = torch.tensor( [[new_token]], dtype=torch.int64, device="cuda:0" )
-#        self.token_struct['attention_mask'] = torch.ones( [1,1], dtype=torch.int64, device="cuda:0" )
-
-        self.all_tokens = torch.hstack(( self.all_tokens, torch.tensor([[new_token]],dtype=torch.int64) ))
-
-    def get_tokens( self ):
-        return self.all_tokens
-
-#
-# ==========================================================================
-#
-
-def generate_interactive_completions( args, normodel, posmodel, negmodel, tokenizer ):
-    np.random.seed( 42 )
+def sample_completions( args, normodel, posmodel, negmodel, tokenizer, prompt_text, experts=None, draft=None, prompt_ind=0 ):
+    if experts is not None:
+        num_rows = args.num_gens if args.batch_gens else 1
+        completions = []
+        while len( completions ) < args.num_gens:
+            keys = [ (prompt_ind, gen_ind) for gen_ind in range( len( completions ), len( completions ) + num_rows ) ]
+            set_sample_streams( SampleStreams( args.seed, keys ) )
+            trace_rows( keys )
+            experts.set_prompt( prompt_text, num_rows=num_rows )
+            completions += gen_expert_completions( experts, tokenizer, tok_cnt=args.max_tokens )
+        return completions
+
+    if args.batch_gens:
+        # one prefill per model, then all num_gens samples decode together
+        keys = [ (prompt_ind, gen_ind) for gen_ind in range( args.num_gens ) ]
+        set_sample_streams( SampleStreams( args.seed, keys ) )
+        trace_rows( keys )
+        normodel.set_prompt( prompt_text, num_rows=args.num_gens )
+        posmodel.set_prompt( prompt_text, num_rows=args.num_gens )
+        negmodel.set_prompt( prompt_text, num_rows=args.num_gens )
+        if draft is not None:
+            draft.set_prompt( prompt_text, num_rows=args.num_gens )
+            return gen_speculative_completions( normodel, posmodel, negmodel, draft, tokenizer, tok_cnt=args.max_tokens, spec_len=args.spec_len )
+        return gen_completions( normodel, posmodel, negmodel, tokenizer, tok_cnt=args.max_tokens )
+
+    completions = []
+    for gen_ind in range( args.num_gens ):
+        set_sample_streams( SampleStreams( args.seed, [ (prompt_ind, gen_ind) ] ) )
+        trace_rows( [ (prompt_ind, gen_ind) ] )
+        normodel.set_prompt( prompt_text )
+        posmodel.set_prompt( prompt_text )
+        negmodel.set_prompt( prompt_text )                
+
+        if draft is not None:
+            draft.set_prompt( prompt_text )
+            completions += gen_speculative_completions( normodel, posmodel, negmodel, draft, tokenizer, tok_cnt=args.max_tokens, spec_len=args.spec_len )
+        else:
+            completions.append( gen_completion( normodel, posmodel, negmodel, tokenizer, tok_cnt=args.max_tokens ) )
+    return completions
+
+def sweep_completions( args, normodel, posmodel, negmodel, tokenizer, prompt_text, experts=None, draft=None, prompt_ind=0 ):
+    # Every sweep configuration's samples decode as rows of one batch, so
+    # the prompt is prefilled once per model for all of them.  A sample
+    # draws the same random numbers under every configuration, just like
+    # in a separate run.  Returns each configuration's completions.
+    gens_per_batch = args.num_gens if args.batch_gens else 1
+    results = [ [] for config in args.sweep ]
+    for first in range( 0, args.num_gens, gens_per_batch ):
+        gen_inds = range( first, min( first + gens_per_batch, args.num_gens ) )
+        rows = [ (config, gen_ind) for config in args.sweep for gen_ind in gen_inds ]
+        set_sample_streams( SampleStreams( args.seed, [ (prompt_ind, gen_ind) for config, gen_ind in rows ] ) )
+        set_row_settings( RowSettings( [ config for config, gen_ind in rows ] ) )
+
+        if experts is not None:
+            experts.set_prompt( prompt_text, num_rows=len( rows ) )
+            completions = gen_expert_completions( experts, tokenizer, tok_cnt=args.max_tokens )
+        else:
+            normodel.set_prompt( prompt_text, num_rows=len( rows ) )
+            posmodel.set_prompt( prompt_text, num_rows=len( rows ) )
+            negmodel.set_prompt( prompt_text, num_rows=len( rows ) )
+            if draft is not None:
+                draft.set_prompt( prompt_text, num_rows=len( rows ) )
+                completions = gen_speculative_completions( normodel, posmodel, negmodel, draft, tokenizer, tok_cnt=args.max_tokens, spec_len=args.spec_len )
+            else:
+                completions = gen_completions( normodel, posmodel, negmodel, tokenizer, tok_cnt=args.max_tokens )
+
+        for ind, completion in enumerate( completions ):
+            results[ind // len( gen_inds )].append( completion )
+
+    set_row_settings( None )
+    return results
+
+def generate_interactive_completions( args, normodel, posmodel, negmodel, tokenizer, experts=None, draft=None ):
+    np.random.seed( args.seed )
 
     with torch.no_grad():
 
@@ -168,7 +296,8 @@ def generate_interactive_completions( args, normodel, posmodel, negmodel, tokeni
                 args.num_gens = int( prompt_text.split()[1] )
                 continue
             if prompt_text.startswith("seed"):
-                np.random.seed( int( prompt_text.split()[1] ) )
+                args.seed = int( prompt_text.split()[1] )
+                np.random.seed( args.seed )
                 continue
             if prompt_text == "":
                 continue
@@ -179,14 +308,9 @@ def generate_interactive_completions( args, normodel, posmodel, negmodel, tokeni
             average = 0.0
             cnt = 0
 
-            for ind in range( args.num_gens ):
+            completions = sample_completions( args, normodel, posmodel, negmodel, tokenizer, prompt_text, experts=experts, draft=draft )
 
-                normodel.set_prompt( prompt_text )
-                posmodel.set_prompt( prompt_text )
-                negmodel.set_prompt( prompt_text )                
-                
-                completion = gen_completion( normodel, posmodel, negmodel, tokenizer )
-                completion = completion.replace( prompt_text, "" )
+            for completion in completions:
 
                 if mpu.get_tensor_model_parallel_rank() == 0:
                     tmp = completion.replace("\n","\\n")
@@ -209,59 +333,133 @@ def generate_interactive_completions( args, normodel, posmodel, negmodel, tokeni
                 print( f"PROMPT_TEXT: [{prompt_text}], OMEGA {args.omega} TAU {args.tau} NGENS {args.num_gens}" )                
                 average /= (cnt+1e-3)
                 print( f"Average toxicity: {average:0.2f}" )
+                if args.lazy_entropy > 0:
+                    print( f"Lazy experts (all prompts so far): {lazy_stats.report()}" )
 
 #
 # ==========================================================================
 #
 
-def generate_prompt_completions( args, normodel, posmodel, negmodel, tokenizer ):
-    np.random.seed( 42 )
-    
-    prompts_fn = "./shuf_prompts.jsonl"
-
+def generations_fn( args ):
     if args.hard:
         gens_fn = f"./hf_{args.normodel}_{args.posmodel}_{args.negmodel}_hard_{args.hard}_dim_{args.dim}_omega_{args.omega}_tau_{args.tau}_generations.jsonl"
     else:
         gens_fn = f"./hf_{args.normodel}_{args.posmodel}_{args.negmodel}_hard_{args.hard}_dim_{args.dim}_omega_{args.omega}_tau_{args.tau}_{args.poscontext}_{args.negcontext}_generations.jsonl"        
+    if args.sweep:
+        # sweep outputs also name the sampling settings
+        gens_fn = gens_fn.replace( "_generations.jsonl", f"_temperature_{args.temperature}_top_p_{args.top_p}_generations.jsonl" )
+    return gens_fn
+
+def shard_fn( args, shard ):
+    return generations_fn( args ).replace( "_generations.jsonl", f"_shard_{shard}_of_{args.num_shards}_generations.jsonl" )
+
+def merge_shards( args ):
+    # shard k holds prompts k, k+num_shards, ... in order, so the merged
+    # file interleaves them; stops at the first prompt not done yet
+    shards = [ open( shard_fn( args, shard ) ).readlines() if count_lines( shard_fn( args, shard ) ) > 0 else []
+               for shard in range( args.num_shards ) ]
+    gens_fn = generations_fn( args )
+    done_cnt = count_lines( gens_fn )
+
+    gens = open( gens_fn, "a" )
+    ind = done_cnt
+    while ind < args.num_prompts:
+        shard, line = ind % args.num_shards, ind // args.num_shards
+        if line >= len( shards[shard] ):
+            break
+        gens.write( shards[shard][line] )
+        ind += 1
+    gens.close()
+    print( f"MERGED LINES {done_cnt} TO {ind} OF {args.num_prompts} INTO {gens_fn}" )
+
+def generate_prompt_completions( args, normodel, posmodel, negmodel, tokenizer, experts=None, draft=None ):
+    np.random.seed( args.seed )
+    
+    prompts_fn = "./shuf_prompts.jsonl"
+
+    # a sweep writes one file per configuration
+    outputs = [ sweep_args( args, config ) for config in args.sweep ] or [ args ]
+    if args.num_shards > 1:
+        gens_fns = [ shard_fn( out_args, args.shard ) for out_args in outputs ]
+    else:
+        gens_fns = [ generations_fn( out_args ) for out_args in outputs ]
 
     prompts = open( prompts_fn ).readlines()
 
-    # count existing gens
-    done_cnt = count_lines( gens_fn )
+    # this shard's prompts, skipping the ones already generated
+    shard_inds = list( range( args.shard, args.num_prompts, args.num_shards ) )
+    done_cnts = [ count_lines( gens_fn ) for gens_fn in gens_fns ]
+    prompt_inds = shard_inds[min( done_cnts ):]
 
     if mpu.get_tensor_model_parallel_rank() == 0:
-        gens = open( gens_fn, "a")
-        print( f"STARTING AT LINE {done_cnt}" )
+        gens = [ open( gens_fn, "a") for gens_fn in gens_fns ]
+        print( f"STARTING AT LINE {min( done_cnts )}" )
     
-    with torch.no_grad():
+    def write_generations( ind, completions, out=0 ):
+        if ( ind - args.shard ) // args.num_shards < done_cnts[out]:
+            return
+        prompt_ds = json.loads( prompts[ind] )
+        prompt_ds['generations'] = []
+        for completion in completions:
+            prompt_ds['generations'].append( { 'text': completion } )
+            if mpu.get_tensor_model_parallel_rank() == 0:
+                print( "  ", completion.replace("\n","\\n") )
 
-        for ind in range( done_cnt, args.num_prompts ):
+        if mpu.get_tensor_model_parallel_rank() == 0:
+            print( json.dumps( prompt_ds ), file=gens[out], flush=True )
+            if args.lazy_entropy > 0:
+                print( f"  lazy experts (all prompts so far): {lazy_stats.report()}" )
 
-            raw_prompt = prompts[ind]
-            prompt_ds = json.loads( raw_prompt )
-            prompt_text = prompt_ds['prompt']['text']
-            prompt_ds['generations'] = []
-            tox = prompt_ds['prompt']['toxicity']
+    with torch.no_grad():
+
+        if args.slots > 0:
+            # continuous batching: every (prompt, sample) pair is one row,
+            # and prompts are written out in order once all their samples
+            # are done
+            def work():
+                for ind in prompt_inds:
+                    prompt_text = json.loads( prompts[ind] )['prompt']['text']
+                    for gen_ind in range( args.num_gens ):
+                        yield (ind, gen_ind), prompt_text
+
+            set_sample_streams( SampleStreams( args.seed ) )
+            results = {}
+            next_pos = 0
+            for (ind, gen_ind), completion in gen_continuous_completions( experts, tokenizer, work(), args.slots, tok_cnt=args.max_tokens ):
+                results.setdefault( ind, {} )[gen_ind] = completion
+                while next_pos < len( prompt_inds ) and len( results.get( prompt_inds[next_pos], {} ) ) == args.num_gens:
+                    next_ind = prompt_inds[next_pos]
+                    if mpu.get_tensor_model_parallel_rank() == 0:
+                        print( json.loads( prompts[next_ind] )['prompt']['text'] )
+                    write_generations( next_ind, [ results[next_ind][gen_ind] for gen_ind in range( args.num_gens ) ] )
+                    del results[next_ind]
+                    next_pos += 1
+
+        else:
+            for ind in prompt_inds:
+
+                raw_prompt = prompts[ind]
+                prompt_ds = json.loads( raw_prompt )
+                prompt_text = prompt_ds['prompt']['text']
+                tox = prompt_ds['prompt']['toxicity']
 
-            if mpu.get_tensor_model_parallel_rank() == 0:
-                print( prompt_text )
-
-            for gen_ind in range( args.num_gens ):
-                normodel.set_prompt( prompt_text )
-                posmodel.set_prompt( prompt_text )
-                negmodel.set_prompt( prompt_text )                
-                
-                completion = gen_completion( normodel, posmodel, negmodel, tokenizer )
-                completion = completion.replace( prompt_text, "" )
-                prompt_ds['generations'].append( { 'text': completion } )
                 if mpu.get_tensor_model_parallel_rank() == 0:
-                    print( "  ", completion.replace("\n","\\n") )
-                    
-            if mpu.get_tensor_model_parallel_rank() == 0:
-                print( json.dumps( prompt_ds ), file=gens, flush=True )
+                    print( prompt_text )
+
+                if args.sweep:
+                    sweep = sweep_completions( args, normodel, posmodel, negmodel, tokenizer, prompt_text, experts=experts, draft=draft, prompt_ind=ind )
+                    for out, completions in enumerate( sweep ):
+                        if mpu.get_tensor_model_parallel_rank() == 0:
+                            print( f"  OMEGA {outputs[out].omega} TAU {outputs[out].tau} TEMPERATURE {outputs[out].temperature} TOP_P {outputs[out].top_p}" )
+                        write_generations( ind, completions, out=out )
+                    continue
+
+                completions = sample_completions( args, normodel, posmodel, negmodel, tokenizer, prompt_text, experts=experts, draft=draft, prompt_ind=ind )
+                write_generations( ind, completions )
 
     if mpu.get_tensor_model_parallel_rank() == 0:
-        gens.close()
+        for f in gens:
+            f.close()
         
 #
 # ==========================================================================
@@ -270,6 +468,11 @@ def generate_prompt_completions( args, normodel, posmodel, negmodel, tokenizer )
 args = parse_args()
 set_args( args )
 
+if args.merge_shards:
+    for out_args in [ sweep_args( args, config ) for config in args.sweep ] or [ args ]:
+        merge_shards( out_args )
+    sys.exit( 0 )
+
 if ( not args.soft and not args.hard) or (args.soft and args.hard):
     error('must specify either hard or soft, but not both')
 
@@ -278,44 +481,203 @@ print( "Loading models..." )
 print( "  loading tokenizer..." )
 ztokenizer = AutoTokenizer.from_pretrained( args.normodel, cache_dir=args.cache_dir )
 
-print( f"  loading normal model {args.normodel}..." )
-zmodel = AutoModelForCausalLM.from_pretrained( args.normodel, cache_dir=args.cache_dir )
-zmodel.eval()
-zmodel.to("cuda:0")
-normodel = Generator( zmodel, ztokenizer )
-
-print( f"  loading positive model {args.posmodel}..." )
-
-if args.soft:
-    print( "    using soft model" )
-    zmodel = GPT2LMPlus.from_pretrained( args.posmodel )
-    zmodel.set_up_prompt_tuning( args.poscheckpoint, 'before_pe' )
-#    zmodel.set_up_prompt_tuning( args.dim, 'before_pe' )    
-else:
-    print( "    using hard model" )
-    zmodel = GPT2LMHC.from_pretrained( args.posmodel )
-zmodel.eval()
-zmodel.to("cuda:0")
-posmodel = Generator( zmodel, ztokenizer )
-
-print( f"  loading negative model {args.negmodel}..." )
-if args.soft:
-    print( "    using soft model" )
-    zmodel = GPT2LMPlus.from_pretrained( args.negmodel )
-    zmodel.set_up_prompt_tuning( args.negcheckpoint, 'before_pe' )
-#    zmodel.set_up_prompt_tuning( args.dim, 'before_pe' )    
-else:
-    print( "    using hard model" )    
-    zmodel = GPT2LMHC.from_pretrained( args.negmodel )
-zmodel.eval()
-zmodel.to("cuda:0")
-negmodel = Generator( zmodel, ztokenizer )
-
-if args.hard:
-    print( "    setting hard contexts..." )
-    posmodel.set_hard_context( KNOWN_TEXTS[args.poscontext].replace('YYY','') )
-    negmodel.set_hard_context( KNOWN_TEXTS[args.negcontext].replace('YYY','') )
+# Each set of weights is only loaded once per precision; the generators are
+# views over it that only differ in their soft prefix or hard context.
+backbones = {}
+def load_backbone( model_name, precision=None ):
+    precision = precision or args.precision
+    if (model_name, precision) not in backbones:
+        print( f"    loading weights for {model_name} ({precision})..." )
+        zmodel = AutoModelForCausalLM.from_pretrained( model_name, cache_dir=args.cache_dir )
+        zmodel.eval()
+        reduce_precision( zmodel, precision )
+        zmodel.to( args.device )
+        print( f"    {model_bytes( zmodel ) / 2**20:0.0f} MB of weights" )
+        backbones[(model_name, precision)] = zmodel
+    return backbones[(model_name, precision)]
+
+if args.static_decode and args.no_cache:
+    error('--static_decode needs the cache')
+
+if args.kv_blocks > 0 and ( args.no_cache or args.static_decode ):
+    error('--kv_blocks does not work with --no_cache or --static_decode')
+
+if args.precision == "int8" and not args.device.startswith("cpu"):
+    error('--precision int8 only runs on the cpu')
+
+ctx_store = ContextStore( args.ctx_store, max_bytes=args.ctx_store_mb * 2**20 ) if args.ctx_store else None
+
+def set_up_soft_prefix( zmodel, model_name, checkpoint, precision=None ):
+    # loads a prefix checkpoint; with a context store its cache is mapped
+    # from disk if some process already built it (kv_prefix checkpoints
+    # already are a cache)
+    if ctx_store is None or args.entry_point == "kv_prefix":
+        zmodel.set_up_prompt_tuning( checkpoint, args.entry_point )
+        return
+    precision = precision or args.precision
+    device = zmodel.transformer.wte.weight.device
+    key, past = soft_prefix_state( ctx_store, model_name, precision, args.entry_point, checkpoint, device )
+    zmodel.set_up_prompt_tuning( checkpoint, args.entry_point, prefix_past=past )
+    if past is None:
+        ctx_store.put( key, past=zmodel.transformer.build_prefix_cache( device ),
+                       description=f"{model_name} {precision} soft prefix: {checkpoint}" )
+
+def set_hard_context( generator, model_name, text, precision=None ):
+    if ctx_store is None:
+        generator.set_hard_context( text )
+        return
+    tokens, past = hard_context_state( ctx_store, model_name, precision or args.precision, ztokenizer, generator.model, text )
+    generator.model.set_prompt_tokens( tokens, prompt_past=past )
+
+kv_stores = {}
+def get_kv_store( model ):
+    # one paged KV store per model shape, shared by all of its generators
+    if args.kv_blocks == 0:
+        return None
+    config = model.config
+    key = ( config.n_layer, config.n_head, config.n_embd, model.transformer.wte.weight.dtype )
+    if key not in kv_stores:
+        kv_stores[key] = PagedKVStore.for_model( model, args.kv_blocks, block_size=args.kv_block_size )
+    return kv_stores[key]
+
+def make_generator( model, paged=True ):
+    static_len = args.max_tokens if args.static_decode else 0
+    return Generator( model, ztokenizer, use_cache=not args.no_cache,
+                      static_len=static_len, compile_step=args.compile_decode,
+                      kv_store=get_kv_store( model ) if paged else None )
+
+def load_generators( precision=None ):
+    # precision overrides --precision, for reference models that stay out
+    # of the paged KV store
+    paged = precision is None
+    print( f"  loading normal model {args.normodel}..." )
+    zmodel = load_backbone( args.normodel, precision )
+    normodel = make_generator( zmodel, paged=paged )
+
+    print( f"  loading positive model {args.posmodel}..." )
+
+    if args.soft:
+        print( "    using soft model" )
+        zmodel = GPT2LMPlus.from_backbone( load_backbone( args.posmodel, precision ) )
+        set_up_soft_prefix( zmodel, args.posmodel, args.poscheckpoint, precision )
+#        zmodel.set_up_prompt_tuning( args.dim, 'before_pe' )    
+    else:
+        print( "    using hard model" )
+        zmodel = GPT2LMHC.from_backbone( load_backbone( args.posmodel, precision ) )
+    zmodel.eval()
+    zmodel.to( args.device )
+    posmodel = make_generator( zmodel, paged=paged )
+
+    print( f"  loading negative model {args.negmodel}..." )
+    if args.soft:
+        print( "    using soft model" )
+        zmodel = GPT2LMPlus.from_backbone( load_backbone( args.negmodel, precision ) )
+        set_up_soft_prefix( zmodel, args.negmodel, args.negcheckpoint, precision )
+#        zmodel.set_up_prompt_tuning( args.dim, 'before_pe' )    
+    else:
+        print( "    using hard model" )    
+        zmodel = GPT2LMHC.from_backbone( load_backbone( args.negmodel, precision ) )
+    zmodel.eval()
+    zmodel.to( args.device )
+    negmodel = make_generator( zmodel, paged=paged )
+
+    if args.hard:
+        print( "    setting hard contexts..." )
+        set_hard_context( posmodel, args.posmodel, KNOWN_TEXTS[args.poscontext].replace('YYY',''), precision )
+        set_hard_context( negmodel, args.negmodel, KNOWN_TEXTS[args.negcontext].replace('YYY',''), precision )
+
+    return normodel, posmodel, negmodel
+
+normodel, posmodel, negmodel = load_generators()
+
+if args.drift_prompts > 0 and args.precision != "fp32":
+    # how far the reduced precision moves the final sampling distribution,
+    # against full-precision copies that are dropped again afterwards
+    print( "  measuring precision drift..." )
+    reference = load_generators( "fp32" )
+    prompts = [ json.loads( line )['prompt']['text'] for line in open( "./shuf_prompts.jsonl" ).readlines()[:args.drift_prompts] ]
+    with torch.no_grad():
+        drift = precision_drift( list( reference ), [ normodel, posmodel, negmodel ], ztokenizer, prompts, tok_cnt=args.max_tokens )
+    print( f"  {args.precision} drift over {len( prompts )} prompts: " + ", ".join( f"{k} {v:0.4f}" for k, v in drift.items() ) )
+    del reference
+    for name in [ name for name in backbones if name[1] == "fp32" ]:
+        del backbones[name]
+
+if args.parallel_experts:
+    if args.expert_threads:
+        thread_budgets = [ int(x) for x in args.expert_threads.split(",") ]
+    else:
+        thread_budgets = [ max( torch.get_num_threads() // 3, 1 ) ] * 3
+    print( f"    running models concurrently with {thread_budgets} threads" )
+    set_expert_pool( ExpertPool( thread_budgets ) )
+
+experts = None
+if args.shared_forward:
+    if args.posmodel != args.normodel or args.negmodel != args.normodel:
+        error('--shared_forward needs the same normal, positive and negative model')
+
+    print( "    stacking all streams onto one backbone..." )
+    # every soft prefix (the positive and negative ones with --soft, and
+    # the extra checkpoints) goes into one prefix bank on the backbone
+    extra_checkpoints = list( filter( None, args.extracheckpoints.split(",") ) )
+    checkpoints = ( [ args.poscheckpoint, args.negcheckpoint ] if args.soft else [] ) + extra_checkpoints
+    if args.soft:
+        prefixes = [ {}, { 'bank': 0 }, { 'bank': 1 } ]
+    else:
+        prefixes = [ get_stream_prefix( m.model ) for m in [normodel, posmodel, negmodel] ]
+    for context in filter( None, args.extracontexts.split(",") ):
+        text = KNOWN_TEXTS[context].replace('YYY','')
+        if ctx_store is not None:
+            tokens = context_tokens( ctx_store, args.normodel, ztokenizer, text )
+        else:
+            tokens = ztokenizer.encode( text, add_special_tokens=False )
+        prefixes.append( { 'tokens': torch.tensor( tokens ) } )
+    prefixes += [ { 'bank': ind } for ind in range( len( checkpoints ) - len( extra_checkpoints ), len( checkpoints ) ) ]
+    experts_model = normodel.model
+    if len( checkpoints ) > 0:
+        experts_model = GPT2LMPlus.from_backbone( normodel.model )
+        experts_model.set_up_prefix_bank( checkpoints, args.entry_point )
+        experts_model.eval()
+    experts = ExpertBatch( experts_model, ztokenizer, prefixes, kv_store=get_kv_store( normodel.model ) )
+    stream_names = [ "normal", "pos", "neg" ] + list( filter( None, args.extracontexts.split(",") ) ) + list( filter( None, args.extracheckpoints.split(",") ) )
+
+if args.slots > 0 and experts is None:
+    error('--slots needs --shared_forward')
+
+if args.lazy_entropy > 0 and ( experts is not None or args.draft_model ):
+    # the shared forward (also behind --slots and --serve_port) and the
+    # speculative path always run every stream
+    error('--lazy_entropy does not work with --shared_forward or --draft_model')
+
+if args.sweep and ( args.slots > 0 or args.serve_port > 0 ):
+    error('--sweep does not work with --slots or --serve_port')
+
+if args.trace:
+    if args.sweep or args.slots > 0 or args.serve_port > 0 or args.draft_model or args.restrict_vocab:
+        error('--trace does not work with --sweep, --slots, --serve_port, --draft_model or --restrict_vocab')
+    stream_names = stream_names if experts is not None else [ "normal", "pos", "neg" ]
+    recorder = TraceRecorder( args.trace, normodel.model.config.vocab_size, stream_names, top_k=args.trace_top_k )
+    set_trace_recorder( recorder )
+
+if args.serve_port > 0:
+    if experts is None:
+        error('--serve_port needs --shared_forward')
+
+    from serve import run_server
+    run_server( experts, ztokenizer, stream_names, args.serve_host, args.serve_port, args.slots or 16, args.queue_size )
+    sys.exit( 0 )
+
+draft = None
+if args.draft_model:
+    if args.shared_forward or args.restrict_vocab:
+        error('--draft_model does not work with --shared_forward or --restrict_vocab')
+
+    print( f"  loading draft model {args.draft_model}..." )
+    draft = make_generator( load_backbone( args.draft_model ) )
 
 with torch.no_grad():
-#    generate_interactive_completions( args, normodel, posmodel, negmodel, ztokenizer )
-    generate_prompt_completions( args, normodel, posmodel, negmodel, ztokenizer )
+#    generate_interactive_completions( args, normodel, posmodel, negmodel, ztokenizer, experts=experts, draft=draft )
+    generate_prompt_completions( args, normodel, posmodel, negmodel, ztokenizer, experts=experts, draft=draft )
+
+if args.trace:
+    recorder.close()
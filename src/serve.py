@@ -0,0 +1,338 @@
+import json
+import time
+import asyncio
+import itertools
+import traceback
+
+import torch
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from common import *
+
+#
+# ==========================================================================
+#
+
+class Request():
+    # One /generate call: its settings, and the queue its events go out on.
+    # The body is JSON with a prompt and optionally num_gens, omega, tau,
+    # temperature, top_k, top_p, max_tokens, seed, and the names of the
+    # positive stream and the negative streams to contrast it with.  The
+    # event queue holds at most EVENTS_PER_SAMPLE events per sample (plus
+    # one for an error); a client that falls further behind is dropped.
+    EVENTS_PER_SAMPLE = 256
+
+    def __init__( self, req_id, body, stream_names, num_slots ):
+        args = get_args()
+        self.id = req_id
+        self.prompt = str( body['prompt'] )
+        self.num_gens = int( body.get( 'num_gens', 1 ) )
+        self.omega = float( body.get( 'omega', args.omega ) )
+        self.tau = float( body.get( 'tau', args.tau ) )
+        self.temperature = float( body.get( 'temperature', args.temperature ) )
+        self.top_k = int( body.get( 'top_k', args.top_k ) )
+        self.top_p = float( body.get( 'top_p', args.top_p ) )
+        self.max_tokens = int( body.get( 'max_tokens', args.max_tokens ) )
+        self.seed = int( body.get( 'seed', np.random.randint( 2**31 ) ) )
+
+        positive = body.get( 'positive', stream_names[1] )
+        negative = body.get( 'negative', [ name for name in stream_names[1:] if name != positive ] )
+        # stream indices, steered-towards expert first
+        self.experts = tuple( stream_names.index( name ) for name in [ positive ] + list( negative ) )
+        if 0 in self.experts or len( self.experts ) < 2:
+            raise ValueError( "need a positive and at least one negative expert" )
+        if self.num_gens < 1 or self.num_gens > num_slots or self.max_tokens < 1:
+            raise ValueError( f"num_gens must be within 1..{num_slots} and max_tokens positive" )
+        if self.temperature <= 0.0:
+            raise ValueError( "temperature must be positive" )
+        if self.top_k < 0:
+            raise ValueError( "top_k can't be negative" )
+
+        self.events = asyncio.Queue( maxsize=self.EVENTS_PER_SAMPLE * self.num_gens + 1 )
+        self.cancelled = False
+        self.arrived = time.time()
+        self.first_text = None
+
+class ServeEngine():
+    # Decodes all admitted requests as rows of one ExpertBatch, continuous
+    # batching style: requests join as soon as there are free slots, and
+    # rows leave as soon as they finish.  Every row samples with its own
+    # request's settings.  Only ever called from the one engine thread.
+
+    def __init__( self, experts, tokenizer, num_slots, seed, stop_strings=[] ):
+        self.experts = experts
+        self.tokenizer = tokenizer
+        self.num_slots = num_slots
+        self.seed = seed
+        self.stop_strings = stop_strings
+        # running text is held back by this much, as it might still turn
+        # out to be the start of a stop string
+        self.holdback = max( [ len(s) for s in stop_strings ], default=1 ) - 1
+        self.combiner = ContrastiveCombiner()
+        self.reset()
+
+    def reset( self ):
+        self.experts.num_rows = 0
+        self.finisher = RowFinisher( self.tokenizer, torch.zeros( (0,0), dtype=torch.int64 ), stop_strings=self.stop_strings )
+        self.streams = SampleStreams( self.seed )
+        self.rows = []   # ( request, sample index ) of every running row
+        self.sent = []   # how much of every running row's text went out
+
+    def free_slots( self ):
+        return self.num_slots - len( self.rows )
+
+    def blocks_needed( self, request ):
+        return self.experts.blocks_needed( request.prompt, num_rows=request.num_gens, max_new=request.max_tokens )
+
+    def admit( self, request ):
+        self.experts.add_prompt( request.prompt, num_rows=request.num_gens, max_new=request.max_tokens )
+        prompt_ids = self.tokenizer( request.prompt, return_tensors='pt' )['input_ids'][0].tolist()
+        self.finisher.add_rows( [ prompt_ids ] * request.num_gens,
+                                [ (request.id, gen_ind) for gen_ind in range( request.num_gens ) ],
+                                max_tokens=request.max_tokens )
+        self.streams.add_rows( [ (request.seed, gen_ind) for gen_ind in range( request.num_gens ) ] )
+        self.rows += [ (request, gen_ind) for gen_ind in range( request.num_gens ) ]
+        self.sent += [ 0 ] * request.num_gens
+
+    def _select_rows( self, rows ):
+        self.experts.select_rows( rows )
+        self.streams.select_rows( rows )
+        self.rows = [ self.rows[ind] for ind in rows ]
+        self.sent = [ self.sent[ind] for ind in rows ]
+
+    def _per_row( self, name, device ):
+        return torch.tensor( [ getattr( request, name ) for request, gen_ind in self.rows ], device=device )
+
+    def _final_logits( self, logits ):
+        # rows are combined in groups that contrast the same experts
+        nor_logits = logits[0]
+        omega = self._per_row( 'omega', nor_logits.device )
+        tau = self._per_row( 'tau', nor_logits.device )
+
+        groups = {}
+        for ind, (request, gen_ind) in enumerate( self.rows ):
+            groups.setdefault( request.experts, [] ).append( ind )
+        if len( groups ) == 1:
+            experts = next( iter( groups ) )
+            return self.combiner.combine( nor_logits, [ logits[e] for e in experts ], omega, tau )
+
+        final_logits = torch.empty_like( nor_logits )
+        for experts, inds in groups.items():
+            inds = torch.tensor( inds, device=nor_logits.device )
+            final_logits[inds] = self.combiner.combine( nor_logits[inds], [ logits[e][inds] for e in experts ], omega[inds], tau[inds] )
+        return final_logits
+
+    def step( self, admits ):
+        # admits the new requests, drops cancelled ones and samples one token
+        # for every row; returns the ( request, event ) pairs to stream out
+        with torch.no_grad():
+            for request in admits:
+                self.admit( request )
+
+            keep = [ ind for ind, (request, gen_ind) in enumerate( self.rows ) if not request.cancelled ]
+            if len( keep ) < len( self.rows ):
+                self.finisher.select_rows( keep )
+                self._select_rows( keep )
+            if len( self.rows ) == 0:
+                return []
+
+            final_logits = self._final_logits( self.experts.get_next_logits() )
+            new_tok, cand_inds, cand_probs = sample_logits( final_logits,
+                                                            temperature=self._per_row( 'temperature', 'cpu' ),
+                                                            top_k=self._per_row( 'top_k', 'cpu' ),
+                                                            top_p=self._per_row( 'top_p', 'cpu' ),
+                                                            uniforms=self.streams.uniforms() )
+            keep = self.finisher.add_tokens( [ [tok] for tok in new_tok.tolist() ] )
+            if keep is None:
+                keep = list( range( len( self.rows ) ) )
+
+            events = []
+            finished = dict( self.finisher.pop_finished() )
+            kept = set( keep )
+            for ind, (request, gen_ind) in enumerate( self.rows ):
+                if ind not in kept:
+                    text = finished[(request.id, gen_ind)]
+                    events.append(( request, { 'sample': gen_ind, 'text': text[self.sent[ind]:], 'done': True } ))
+            for pos, ind in enumerate( keep ):
+                request, gen_ind = self.rows[ind]
+                text = self.finisher.detok.texts[pos]
+                end = max( len( text ) - self.holdback, self.sent[ind] )
+                if end > self.sent[ind]:
+                    events.append(( request, { 'sample': gen_ind, 'text': text[self.sent[ind]:end] } ))
+                    self.sent[ind] = end
+
+            # finished rows leave before their last token is fed
+            if len( keep ) < len( self.rows ):
+                self._select_rows( keep )
+                new_tok = new_tok[torch.tensor( keep, dtype=torch.int64, device=new_tok.device )]
+            if len( self.rows ) > 0:
+                self.experts.append_new_tok( new_tok )
+            return events
+
+#
+# ==========================================================================
+#
+
+class GenerationServer():
+    # A small HTTP/1.1 front end: POST /generate streams NDJSON events as
+    # tokens are sampled, GET /stats reports load and latency.  Requests
+    # wait in a bounded queue; when it is full new ones get a 503 right
+    # away instead of piling up.  Each request's event queue is bounded
+    # too.  All model work runs on one engine thread, so the event loop
+    # stays free to accept and stream.
+
+    def __init__( self, engine, stream_names, queue_size ):
+        self.engine = engine
+        self.stream_names = stream_names
+        self.queue = asyncio.Queue( maxsize=queue_size )
+        self.executor = ThreadPoolExecutor( max_workers=1 )
+        self.req_ids = itertools.count()
+        self.num_served = 0
+        self.first_text_times = []
+        self.total_times = []
+
+    async def decode_loop( self ):
+        loop = asyncio.get_running_loop()
+        pending = None
+        while True:
+            if len( self.engine.rows ) == 0 and pending is None:
+                pending = await self.queue.get()
+
+            # admit whatever fits, in arrival order, in both slots and KV
+            # blocks (the engine thread is idle, so its state holds still)
+            admits = []
+            free = self.engine.free_slots()
+            free_blocks = self.engine.experts.free_blocks()
+            while True:
+                if pending is None:
+                    try:
+                        pending = self.queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                if pending.cancelled:
+                    pending = None
+                    continue
+                blocks = self.engine.blocks_needed( pending )
+                if blocks > free_blocks and len( self.engine.rows ) == 0 and len( admits ) == 0:
+                    # it wouldn't even fit into an empty batch
+                    pending.events.put_nowait( { 'error': 'request needs more KV blocks than the server has' } )
+                    pending = None
+                    continue
+                if pending.num_gens > free or blocks > free_blocks:
+                    break
+                admits.append( pending )
+                free -= pending.num_gens
+                free_blocks -= blocks
+                pending = None
+
+            try:
+                events = await loop.run_in_executor( self.executor, self.engine.step, admits )
+            except Exception as err:
+                traceback.print_exc()
+                failed = set( request for request, gen_ind in self.engine.rows ) | set( admits )
+                events = [ (request, { 'error': str(err) }) for request in failed ]
+                await loop.run_in_executor( self.executor, self.engine.reset )
+            for request, event in events:
+                if request.cancelled:
+                    continue
+                if request.events.qsize() >= request.events.maxsize - 1:
+                    # the client stopped reading; drop the request rather
+                    # than buffer its events without bound (the last slot
+                    # is kept for this error)
+                    request.cancelled = True
+                    event = { 'error': 'client too slow, request dropped' }
+                request.events.put_nowait( event )
+
+    def stats( self ):
+        result = { 'queued': self.queue.qsize(),
+                   'running_rows': len( self.engine.rows ),
+                   'slots': self.engine.num_slots,
+                   'served': self.num_served }
+        for name, times in [ ('first_text', self.first_text_times), ('total', self.total_times) ]:
+            if len( times ) > 0:
+                result[name+'_p50'] = float( np.percentile( times, 50 ) )
+                result[name+'_p99'] = float( np.percentile( times, 99 ) )
+        return result
+
+    async def respond( self, writer, status, body, headers={} ):
+        data = ( json.dumps( body ) + "\n" ).encode()
+        head = f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n"
+        for key, value in headers.items():
+            head += f"{key}: {value}\r\n"
+        writer.write( ( head + "\r\n" ).encode() + data )
+        await writer.drain()
+
+    async def write_chunk( self, writer, data ):
+        writer.write( f"{len(data):x}\r\n".encode() + data + b"\r\n" )
+        await writer.drain()
+
+    async def generate( self, writer, body ):
+        request = Request( next( self.req_ids ), json.loads( body ), self.stream_names, self.engine.num_slots )
+        try:
+            self.queue.put_nowait( request )
+        except asyncio.QueueFull:
+            await self.respond( writer, "503 Service Unavailable", { 'error': 'queue full' }, { 'Retry-After': '1' } )
+            return
+
+        writer.write( b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n" )
+        try:
+            num_left = request.num_gens
+            while num_left > 0:
+                event = await request.events.get()
+                if request.first_text is None and event.get( 'text' ):
+                    request.first_text = time.time()
+                await self.write_chunk( writer, ( json.dumps( event ) + "\n" ).encode() )
+                if 'error' in event:
+                    break
+                if event.get( 'done' ):
+                    num_left -= 1
+            await self.write_chunk( writer, b"" )
+        except ConnectionError:
+            # the client went away; its rows are dropped on the next step
+            request.cancelled = True
+            return
+
+        self.num_served += 1
+        if request.first_text is not None:
+            self.first_text_times = ( self.first_text_times + [ request.first_text - request.arrived ] )[-1000:]
+        self.total_times = ( self.total_times + [ time.time() - request.arrived ] )[-1000:]
+
+    async def handle( self, reader, writer ):
+        try:
+            method, path, version = ( await reader.readline() ).decode().split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in ( b"\r\n", b"\n", b"" ):
+                    break
+                key, value = line.decode().split( ":", 1 )
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly( int( headers.get( 'content-length', 0 ) ) )
+
+            if method == "GET" and path == "/stats":
+                await self.respond( writer, "200 OK", self.stats() )
+            elif method == "POST" and path == "/generate":
+                await self.generate( writer, body )
+            else:
+                await self.respond( writer, "404 Not Found", { 'error': 'not found' } )
+        except ( ValueError, KeyError, TypeError ) as err:
+            await self.respond( writer, "400 Bad Request", { 'error': str(err) } )
+        except ( ConnectionError, asyncio.IncompleteReadError ):
+            pass
+        finally:
+            writer.close()
+
+def run_server( experts, tokenizer, stream_names, host, port, num_slots, queue_size ):
+    args = get_args()
+    engine = ServeEngine( experts, tokenizer, num_slots, args.seed, stop_strings=args.stop_string )
+
+    async def main():
+        server = GenerationServer( engine, stream_names, queue_size )
+        tcp_server = await asyncio.start_server( server.handle, host, port )
+        print( f"SERVING ON {host}:{port} WITH {num_slots} SLOTS, STREAMS {stream_names}" )
+        async with tcp_server:
+            await asyncio.gather( tcp_server.serve_forever(), server.decode_loop() )
+
+    asyncio.run( main() )
@@ -0,0 +1,193 @@
+import random
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from gpt2sp_base import GPT2LMPlus, ENTRY_POINTS
+from gpt2hc_base import GPT2LMHC
+from expert_batch import ExpertBatch
+from decode_state import DecodeState, PagedDecodeState
+from paged_kv import PagedKVStore
+
+#
+# ==========================================================================
+#
+
+# Every soft prefix entry point, decoded through the plain cache, a
+# DecodeState (--static_decode) and a PagedDecodeState (--kv_blocks), must
+# give the logits of running each row's whole sequence from scratch.
+
+NUM_ROWS = 3
+NUM_NEW = 6
+
+def tiny_backbone():
+    torch.manual_seed( 0 )
+    config = GPT2Config( vocab_size=97, n_positions=64, n_embd=32, n_layer=2, n_head=4 )
+    return GPT2LMHeadModel( config ).eval()
+
+def soft_model( backbone, entry_point, k=5, seed=1 ):
+    random.seed( seed )
+    torch.manual_seed( seed )
+    model = GPT2LMPlus.from_backbone( backbone )
+    model.set_up_prompt_tuning( k, entry_point )
+    with torch.no_grad():
+        # move the prefix away from plain token embeddings
+        model.transformer.pt_prefix.add_( 0.1 * torch.randn_like( model.transformer.pt_prefix ) )
+    model.eval()
+    return model
+
+def reference_logits( model, tokens ):
+    # logits after the last token of each row, every row run from scratch
+    return torch.cat( [ model( input_ids=row.view(1,-1) ).logits[:,-1] for row in tokens ] )
+
+def prefill( model, prompt ):
+    output = model.transformer( input_ids=prompt, attention_mask=torch.ones_like( prompt ), use_cache=True )
+    return output['past_key_values']
+
+def decode_plain( model, prompt, new_toks ):
+    tokens = prompt.repeat( NUM_ROWS, 1 )
+    past = tuple( tuple( t.expand( NUM_ROWS, -1, -1, -1 ) for t in layer_past ) for layer_past in prefill( model, prompt ) )
+    logits = []
+    for ind in range( new_toks.shape[1] ):
+        tokens = torch.cat( ( tokens, new_toks[:,ind:ind+1] ), dim=1 )
+        output = model.transformer( input_ids=new_toks[:,ind:ind+1], attention_mask=torch.ones_like( tokens ),
+                                    past_key_values=past, use_cache=True )
+        past = output['past_key_values']
+        logits.append( model.lm_head( output['last_hidden_state'][:,-1] ) )
+    return logits
+
+def decode_state( model, state, new_toks ):
+    logits = []
+    for ind in range( new_toks.shape[1] ):
+        state.append_tokens( new_toks[:,ind] )
+        logits.append( model.lm_head( state.run_pending()[:,-1] ) )
+    return logits
+
+def decode_static( model, prompt, new_toks ):
+    state = DecodeState( model, prompt.repeat( NUM_ROWS, 1 ), prefill( model, prompt ), new_toks.shape[1] )
+    return decode_state( model, state, new_toks )
+
+def decode_paged( model, prompt, new_toks ):
+    store = PagedKVStore.for_model( model, 32, block_size=4 )
+    state = PagedDecodeState( model, store, prompt.repeat( NUM_ROWS, 1 ), prefill( model, prompt ) )
+    logits = decode_state( model, state, new_toks )
+    state.release()
+    assert store.num_free() == 32
+    return logits
+
+@pytest.mark.parametrize( "entry_point", ENTRY_POINTS )
+@pytest.mark.parametrize( "decode", [ decode_plain, decode_static, decode_paged ] )
+def test_prefix_decoding( entry_point, decode ):
+    model = soft_model( tiny_backbone(), entry_point )
+    torch.manual_seed( 2 )
+    prompt = torch.randint( 97, ( 1, 7 ) )
+    new_toks = torch.randint( 97, ( NUM_ROWS, NUM_NEW ) )
+
+    with torch.no_grad():
+        logits = decode( model, prompt, new_toks )
+        tokens = prompt.repeat( NUM_ROWS, 1 )
+        for ind in range( NUM_NEW ):
+            tokens = torch.cat( ( tokens, new_toks[:,ind:ind+1] ), dim=1 )
+            torch.testing.assert_close( logits[ind], reference_logits( model, tokens ), atol=1e-4, rtol=1e-4 )
+
+#
+# ==========================================================================
+#
+
+# A prefix bank on one backbone, with prefix ids per row, must give every
+# row the logits of a separate model with just that row's prefix.
+
+class CharTokenizer():
+    def __call__( self, text, return_tensors=None ):
+        return { 'input_ids': torch.tensor( [ [ ord( c ) % 97 for c in text ] ] ) }
+
+def bank_checkpoints( backbone, entry_point, tmp_path ):
+    fns = []
+    for ind, k in enumerate( [ 3, 6, 4 ] ):
+        fn = str( tmp_path / f"prefix{ind}.npy" )
+        soft_model( backbone, entry_point, k=k, seed=10+ind ).save_prompt_checkpoint( fn )
+        fns.append( fn )
+    return fns
+
+def bank_model( backbone, entry_point, fns ):
+    model = GPT2LMPlus.from_backbone( backbone )
+    model.set_up_prefix_bank( fns, entry_point )
+    return model.eval()
+
+def separate_model( backbone, entry_point, fn ):
+    model = GPT2LMPlus.from_backbone( backbone )
+    model.set_up_prompt_tuning( fn, entry_point )
+    return model.eval()
+
+@pytest.mark.parametrize( "entry_point", ENTRY_POINTS )
+def test_bank_forward( entry_point, tmp_path ):
+    backbone = tiny_backbone()
+    fns = bank_checkpoints( backbone, entry_point, tmp_path )
+    model = bank_model( backbone, entry_point, fns )
+    torch.manual_seed( 3 )
+    tokens = torch.randint( 97, ( 4, 8 ) )
+    prefix_ids = torch.tensor( [ 2, 0, 1, 0 ] )
+
+    with torch.no_grad():
+        output = model( input_ids=tokens, prefix_ids=prefix_ids, labels=tokens )
+        losses = []
+        for row, prefix_id in zip( tokens, prefix_ids.tolist() ):
+            separate = separate_model( backbone, entry_point, fns[prefix_id] )
+            expected = separate( input_ids=row.view(1,-1), labels=row.view(1,-1) )
+            torch.testing.assert_close( output.logits[len( losses )], expected.logits[0], atol=1e-4, rtol=1e-4 )
+            losses.append( expected.loss )
+    torch.testing.assert_close( output.loss, torch.stack( losses ).mean(), atol=1e-4, rtol=1e-4 )
+
+@pytest.mark.parametrize( "entry_point", ENTRY_POINTS )
+@pytest.mark.parametrize( "paged", [ False, True ] )
+def test_bank_expert_batch( entry_point, paged, tmp_path ):
+    backbone = tiny_backbone()
+    fns = bank_checkpoints( backbone, entry_point, tmp_path )
+    context = torch.tensor( [ 5, 17, 33, 2 ] )
+    prefixes = [ {}, { 'bank': 0 }, { 'tokens': context }, { 'bank': 2 }, { 'bank': 1 } ]
+    kv_store = PagedKVStore.for_model( backbone, 128, block_size=4 ) if paged else None
+    experts = ExpertBatch( bank_model( backbone, entry_point, fns ), CharTokenizer(), prefixes, kv_store=kv_store )
+
+    # a stream's reference model and what goes in front of its tokens
+    references = [ ( backbone, [] ), ( separate_model( backbone, entry_point, fns[0] ), [] ),
+                   ( backbone, context.tolist() ), ( separate_model( backbone, entry_point, fns[2] ), [] ),
+                   ( separate_model( backbone, entry_point, fns[1] ), [] ) ]
+
+    torch.manual_seed( 4 )
+    with torch.no_grad():
+        experts.set_prompt( "hello", num_rows=2, max_new=8 )
+        rows = [ CharTokenizer()( "hello" )['input_ids'][0].tolist() ] * 2
+        for step in range( 5 ):
+            if step == 2:
+                experts.add_prompt( "a longer prompt", num_rows=1, max_new=8 )
+                rows.append( CharTokenizer()( "a longer prompt" )['input_ids'][0].tolist() )
+            logits = experts.get_next_logits()
+            for stream, ( model, front ) in enumerate( references ):
+                expected = torch.cat( [ model( input_ids=torch.tensor( [ front + row ] ) ).logits[:,-1] for row in rows ] )
+                torch.testing.assert_close( logits[stream], expected, atol=1e-4, rtol=1e-4 )
+            new_toks = torch.randint( 97, ( len( rows ), ) )
+            experts.append_new_tok( new_toks )
+            rows = [ row + [ tok ] for row, tok in zip( rows, new_toks.tolist() ) ]
+
+#
+# ==========================================================================
+#
+
+# A hard context is attended to through its cache when it fits, and cut
+# down to its last tokens when the context and the input don't.
+
+@pytest.mark.parametrize( "context_len", [ 10, 63, 64, 90 ] )
+def test_hard_context( context_len ):
+    backbone = tiny_backbone()
+    torch.manual_seed( 5 )
+    context = torch.randint( 97, ( context_len, ) )
+    input_ids = torch.randint( 97, ( 1, 8 ) )
+    model = GPT2LMHC.from_backbone( backbone )
+    model.set_prompt_tokens( context.tolist() )
+
+    with torch.no_grad():
+        logits = model( input_ids=input_ids ).logits[:,-input_ids.shape[1]:]
+        kept = context[max( context_len + input_ids.shape[1] - backbone.config.n_positions, 0 ):]
+        expected = backbone( input_ids=torch.cat( ( kept.view(1,-1), input_ids ), dim=1 ) ).logits[:,-input_ids.shape[1]:]
+    torch.testing.assert_close( logits, expected, atol=1e-4, rtol=1e-4 )
@@ -0,0 +1,94 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from common import sample_logits, filtered_probs, filter_candidates
+
+#
+# ==========================================================================
+#
+
+# The partial top-k sampler must give the distribution of a plain full
+# sort: keep the k best tokens, renormalize, keep every token whose
+# preceding mass is within top_p, renormalize again.
+
+VOCAB = 500
+
+def reference_probs( logits, temperature=1.0, top_k=0, top_p=0.0 ):
+    # the filtered distribution of each row, sorted by decreasing probability
+    result = []
+    for row in logits / temperature:
+        values = torch.sort( row, descending=True ).values
+        if 0 < top_k < len( values ):
+            values = values[:top_k]
+        probs = F.softmax( values.double(), dim=-1 )
+        if 0.0 < top_p < 1.0:
+            probs = probs[( torch.cumsum( probs, dim=-1 ) - probs ) <= top_p]
+            probs = probs / probs.sum()
+        result.append( F.pad( probs, [ 0, len( row ) - len( probs ) ] ) )
+    return torch.stack( result )
+
+def check_filtered( logits, probs, expected ):
+    # same sorted probabilities, and ties are only broken among equal logits
+    torch.testing.assert_close( torch.sort( probs, dim=-1, descending=True ).values.double(), expected, atol=1e-5, rtol=1e-4 )
+    for row_logits, row_probs in zip( logits, probs ):
+        kept = row_probs > 0
+        if not kept.all():
+            assert row_logits[kept].min() >= row_logits[~kept].max()
+
+def make_logits( ties=False ):
+    torch.manual_seed( 0 )
+    if ties:
+        # few distinct values, so ties fall on the top_k and top_p boundaries
+        return torch.randint( 0, 4, ( 6, VOCAB ) ).float()
+    return 3.0 * torch.randn( 6, VOCAB )
+
+@pytest.mark.parametrize( "ties", [ False, True ] )
+@pytest.mark.parametrize( "top_k, top_p", [ ( 0, 0.0 ), ( 0, 1.0 ), ( 10, 0.0 ), ( 0, 0.5 ), ( 0, 0.95 ),
+                                           ( 40, 0.88 ), ( 40, 1.0 ), ( 1, 0.0 ), ( VOCAB, 0.3 ) ] )
+def test_filter_matches_full_sort( ties, top_k, top_p ):
+    logits = make_logits( ties )
+    probs = filtered_probs( logits, temperature=0.7, top_k=top_k, top_p=top_p )
+    check_filtered( logits, probs, reference_probs( logits, temperature=0.7, top_k=top_k, top_p=top_p ) )
+
+def test_nucleus_beyond_candidates():
+    # a flat distribution whose nucleus needs more than num_candidates tokens
+    torch.manual_seed( 1 )
+    logits = 0.01 * torch.randn( 3, VOCAB )
+    cand_inds, cand_probs = filter_candidates( logits, top_p=0.9, num_candidates=16 )
+    probs = torch.zeros_like( logits ).scatter_( 1, cand_inds, cand_probs )
+    check_filtered( logits, probs, reference_probs( logits, top_p=0.9 ) )
+
+def test_per_row_settings():
+    # a row filters the same way whatever else shares its batch
+    logits = make_logits()
+    top_k = torch.tensor( [ 0, 5, 0, 40, 0, 1 ] )
+    top_p = torch.tensor( [ 0.0, 0.0, 0.8, 0.9, 1.0, 0.0 ] )
+    temperature = torch.tensor( [ 1.0, 0.5, 1.5, 1.0, 0.8, 1.0 ] )
+    probs = filtered_probs( logits, temperature=temperature, top_k=top_k, top_p=top_p )
+    for ind in range( logits.shape[0] ):
+        alone = filtered_probs( logits[ind:ind+1], temperature=float( temperature[ind] ),
+                                top_k=int( top_k[ind] ), top_p=float( top_p[ind] ) )
+        torch.testing.assert_close( probs[ind:ind+1], alone )
+
+@pytest.mark.parametrize( "top_k, top_p", [ ( 0, 0.0 ), ( 0, 1.0 ), ( 20, 0.0 ), ( 0, 0.7 ), ( 30, 0.8 ) ] )
+def test_inverse_cdf( top_k, top_p ):
+    # evenly spaced draws hit every token in proportion to its probability
+    logits = make_logits( ties=True )[:2]
+    num_draws = 20000
+    uniforms = ( torch.arange( num_draws ) + 0.5 ) / num_draws
+    probs = filtered_probs( logits, top_k=top_k, top_p=top_p )
+    for ind in range( logits.shape[0] ):
+        tokens, cand_inds, cand_probs = sample_logits( logits[ind:ind+1].expand( num_draws, -1 ), top_k=top_k, top_p=top_p,
+                                                       uniforms=uniforms )
+        counts = torch.bincount( tokens, minlength=VOCAB ).double()
+        assert ( counts[probs[ind] == 0] == 0 ).all()
+        assert ( counts - num_draws * probs[ind].double() ).abs().max() <= 2
+
+def test_last_draw_stays_in_support():
+    # draws just below 1 never land on a token outside the nucleus
+    logits = make_logits()
+    uniforms = torch.full( ( logits.shape[0], ), 1.0 - 1e-7 )
+    tokens, cand_inds, cand_probs = sample_logits( logits, top_k=40, top_p=0.5, uniforms=uniforms )
+    probs = filtered_probs( logits, top_k=40, top_p=0.5 )
+    assert ( probs.gather( 1, tokens.view(-1,1) ) > 0 ).all()
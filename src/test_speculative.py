@@ -0,0 +1,93 @@
+import random
+import argparse
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from common import ( set_args, set_row_settings, set_sample_streams, RowSettings,
+                     gen_completions, gen_speculative_completions )
+from gpt2sp_base import GPT2LMPlus
+from generator import Generator
+
+#
+# ==========================================================================
+#
+
+# With top_k=1 the contrastive distribution is a point mass, so whatever
+# the draft proposes, speculative decoding must give exactly the greedy
+# completions of gen_completions.  Rows use different omegas so that they
+# diverge and finish on EOS at different steps; with omega 0 the draft
+# (the normal model) is always accepted, so those rows run far ahead.
+
+VOCAB = 97
+OMEGAS = [ 0.0, 0.0, 0.0, 3.0, 0.0, 8.0, 0.0, 12.0 ]
+TOK_CNT = 30
+
+class CharTokenizer():
+    # one character per token, so texts map back to tokens
+    eos_token_id = None
+
+    def __call__( self, text, return_tensors=None ):
+        input_ids = torch.tensor( [ [ ord( c ) - 0x100 for c in text ] ] )
+        return { 'input_ids': input_ids, 'attention_mask': torch.ones_like( input_ids ) }
+
+    def decode( self, tokens ):
+        return "".join( chr( 0x100 + t ) for t in tokens )
+
+    def batch_decode( self, rows ):
+        return [ self.decode( row ) for row in rows ]
+
+def make_models( tokenizer ):
+    # a wide initialization, so that greedy decoding doesn't hinge on
+    # near-ties and the rows don't just repeat one token
+    torch.manual_seed( 0 )
+    config = GPT2Config( vocab_size=VOCAB, n_positions=128, n_embd=32, n_layer=2, n_head=4, initializer_range=0.3 )
+    backbone = GPT2LMHeadModel( config ).eval()
+    experts = []
+    for seed in [ 1, 2 ]:
+        random.seed( seed )
+        torch.manual_seed( seed )
+        model = GPT2LMPlus.from_backbone( backbone )
+        model.set_up_prompt_tuning( 4, "before_pe" )
+        model.eval()
+        experts.append( model )
+    return [ Generator( model, tokenizer ) for model in [ backbone ] + experts + [ backbone ] ]
+
+@pytest.fixture
+def decoding():
+    args = argparse.Namespace( stop_string=[], top_k=1, verbose=False, lazy_entropy=0, lazy_divergence=False,
+                               restrict_vocab=False, omega=1.0, tau=1.0, temperature=1.0, top_p=0.0 )
+    set_args( args )
+    set_sample_streams( None )
+    yield
+    set_row_settings( None )
+
+def generate( tokenizer, prompt, spec_len=None ):
+    normodel, posmodel, negmodel, draft = make_models( tokenizer )
+    set_row_settings( RowSettings( [ { 'omega': omega, 'tau': 1.0, 'temperature': 1.0, 'top_p': 0.0 } for omega in OMEGAS ] ) )
+    for m in [ normodel, posmodel, negmodel, draft ]:
+        m.set_prompt( prompt, num_rows=len( OMEGAS ) )
+    with torch.no_grad():
+        if spec_len is None:
+            return gen_completions( normodel, posmodel, negmodel, tokenizer, tok_cnt=TOK_CNT )
+        return gen_speculative_completions( normodel, posmodel, negmodel, draft, tokenizer, tok_cnt=TOK_CNT, spec_len=spec_len )
+
+# EOS tokens that, with these models and spec lengths, end the slowest row
+# while every other row is more than spec_len tokens ahead
+@pytest.mark.parametrize( "spec_len, eos", [ ( 1, 5 ), ( 1, 56 ), ( 2, 56 ), ( 2, 87 ), ( 4, 13 ), ( 4, 94 ) ] )
+def test_speculative_matches_greedy( decoding, spec_len, eos ):
+    tokenizer = CharTokenizer()
+    tokenizer.eos_token_id = eos
+    prompt = tokenizer.decode( [ 5, 17, 33, 2, 60 ] )
+
+    expected = generate( tokenizer, prompt )
+    assert len( set( len( text ) for text in expected ) ) >= 2
+    assert generate( tokenizer, prompt, spec_len=spec_len ) == expected
+
+def test_speculative_without_eos( decoding ):
+    tokenizer = CharTokenizer()
+    prompt = tokenizer.decode( [ 7, 7, 8 ] )
+    expected = generate( tokenizer, prompt )
+    assert all( len( text ) == TOK_CNT for text in expected )
+    assert generate( tokenizer, prompt, spec_len=3 ) == expected
@@ -34,6 +34,7 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, default="gpt2") # gpt2-xl, gpt2-medium
     parser.add_argument('--dim', type=int, default=10)
+    parser.add_argument('--entry_point', type=str, default="before_pe", choices=ENTRY_POINTS) # kv_prefix trains per-layer keys/values
 
     parser.add_argument('--num_epochs', type=int, default=1)
     parser.add_argument('--num_training_steps', type=int, default=20000)
@@ -123,7 +124,7 @@ model_lc.to( device )
 
 # distilled prompt model
 model_dp = GPT2LMPlus.from_pretrained( args.model, cache_dir=args.cache_dir )
-model_dp.set_up_prompt_tuning( args.dim, 'before_pe' )
+model_dp.set_up_prompt_tuning( args.dim, args.entry_point )
 #model_dp.load_prompt_checkpoint( './weights_latest.npy' )
 model_dp.to( device )
 
@@ -142,6 +143,9 @@ lr_scheduler = get_scheduler( name=args.lrs_type, optimizer=optimizer, num_warmu
 
 CONTEXT = KNOWN_TEXTS[ args.context ]
 
+# keep checkpoints of the other entry points apart from before_pe ones
+EP_SUFFIX = "" if args.entry_point == "before_pe" else f"_{args.entry_point}"
+
 #
 # ==========================================================================
 #
@@ -160,7 +164,7 @@ for epoch in range(args.num_epochs):
         if step_ind % 1000 == 0:
             print( "CHECKPOINTING..." )
             #np.save( f"./losses_b_{batch_ind}_e_{epoch}.npy", losses )
-            model_dp.save_prompt_checkpoint( f"./weights_cp_model_{args.model}_context_{args.context}_dim_{args.dim}_e_{epoch}_si_{step_ind}_ts_{args.num_training_steps}_newds_lr_{args.lr}.npy" )
+            model_dp.save_prompt_checkpoint( f"./weights_cp_model_{args.model}_context_{args.context}_dim_{args.dim}{EP_SUFFIX}_e_{epoch}_si_{step_ind}_ts_{args.num_training_steps}_newds_lr_{args.lr}.npy" )
 
         if step_ind > args.num_training_steps:
             break
@@ -214,4 +218,4 @@ for epoch in range(args.num_epochs):
 tmp = np.mean( np.array(losses)[-500:] )
 print( f"MEAN OF LAST 500 LOSSES: {tmp:0.5f}"  )
 
-model_dp.save_prompt_checkpoint( f"./weights_latest_model_{args.model}_context_{args.context}_dim_{args.dim}_ts_{args.num_training_steps}_newds_lr_{args.lr}.npy" )
+model_dp.save_prompt_checkpoint( f"./weights_latest_model_{args.model}_context_{args.context}_dim_{args.dim}{EP_SUFFIX}_ts_{args.num_training_steps}_newds_lr_{args.lr}.npy" )